@@ -0,0 +1,694 @@
+import os
+import logging
+import time
+import signal
+import asyncio
+import queue
+import ujson
+import asyncpg
+import grpc
+import redis
+from google.protobuf.json_format import MessageToDict
+from chirpstack_api import api
+from ChirpHeliumReader import ChirpStreamDispatcher
+from ChirpHeliumCredits import ChirpDcAccumulator, LEDGER_COLUMNS, LEDGER_STAGING, LEDGER_INSERT, ROLLUP, \
+    partition_sql
+from ChirpHeliumGrpc import SERVICE_CONFIG
+from ChirpHeliumKeys import ChirpDeviceKeys, SESSIONS, plan_skfs, session_changes
+from ChirpHeliumRoute import ChirpHprBackend
+from ChirpHeliumSync import ChirpDeviceSync
+from ChirpHeliumLog import report_suppressed
+from ChirpHeliumMetrics import POSTGRES_SECONDS, POSTGRES_ERRORS, GRPC_SECONDS, GRPC_ERRORS, ROUTE_SECONDS, \
+    ROUTE_ERRORS, JOB_SECONDS, JOB_INTERVAL, JOB_ERRORS, ChirpMetricsServer, timed
+
+
+log = logging.getLogger(__name__)
+
+
+class ChirpAsyncStreamDispatcher(ChirpStreamDispatcher):
+    """
+    ChirpStreamDispatcher on redis.asyncio, same registry, checkpoint, ack
+    and retry semantics, the XREADGROUP block parks a coroutine instead of
+    a thread.
+
+    batches of blocking streams are handled on a worker thread while the
+    other streams keep being read, the stream is left out of the reads
+    until its batch has been acknowledged so its order is kept.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.busy = {}
+        # stream_key -> IDs of the batch its busy task is handling.
+        self.busy_ids = {}
+        # acks released by an ack gate, from the loop (dc flushes) or a thread (api coalescer).
+        self.released = queue.SimpleQueue()
+
+    def readable(self, stream_key: str) -> bool:
+        return super().readable(stream_key) and stream_key not in self.busy
+
+    async def create_groups(self):
+        start_id = '$' if self.start == 'checkpoint' else self.start
+        for stream_key in self.registry:
+            try:
+                await self.rdb.xgroup_create(stream_key, self.group, id=start_id, mkstream=True)
+                log.info('created consumer group', extra={'group': self.group, 'stream': stream_key, 'id': start_id})
+            except redis.ResponseError as err:
+                if 'BUSYGROUP' not in str(err):
+                    raise
+                if self.start != 'checkpoint':
+                    await self.rdb.xgroup_setid(stream_key, self.group, id=start_id)
+                    log.info('moved consumer group', extra={'group': self.group, 'stream': stream_key, 'id': start_id})
+
+    async def read(self) -> list[tuple[str, list]]:
+        stream_ids = self.stream_ids()
+        if not stream_ids:
+            if self.busy:
+                await asyncio.wait(list(self.busy.values()), timeout=self.block_ms / 1000)
+            else:
+                await asyncio.sleep(min(self.block_ms, 100) / 1000)
+            return []
+        resp = await self.rdb.xreadgroup(
+            self.group,
+            self.consumer,
+            stream_ids,
+            count=self.batch_size,
+            block=self.block_ms
+        )
+        return self.batches(resp)
+
+    async def ack(self, stream_key: str, messages: list):
+        if messages:
+            msg_ids = [message[0] for message in messages]
+            if stream_key in self.ack_gates:
+                self.ack_gates[stream_key].hold(stream_key, msg_ids)
+            else:
+                await self.rdb.xack(stream_key, self.group, *msg_ids)
+            self.last_ids[stream_key] = messages[-1][0]
+
+    def release(self, acks: dict):
+        self.released.put(acks)
+
+    async def ack_released(self):
+        while True:
+            try:
+                acks = self.released.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                for stream_key, msg_ids in acks.items():
+                    await self.rdb.xack(stream_key, self.group, *msg_ids)
+            except redis.RedisError:
+                # XACK is idempotent, the whole set goes again on the next round.
+                self.released.put(acks)
+                raise
+
+    async def update_lag(self):
+        for stream_key in self.registry:
+            try:
+                self.record_lag(stream_key, await self.rdb.xinfo_groups(stream_key),
+                                await self.rdb.xinfo_stream(stream_key))
+            except redis.RedisError as err:
+                log.warning('stream lag check failed', extra={'stream': stream_key, 'error': str(err)})
+
+    def owned(self) -> dict[str, list]:
+        owned = super().owned()
+        for stream_key, msg_ids in self.busy_ids.items():
+            owned[stream_key] = owned.get(stream_key, []) + msg_ids
+        return owned
+
+    async def touch(self):
+        for stream_key, msg_ids in self.owned().items():
+            try:
+                for i in range(0, len(msg_ids), self.batch_size):
+                    await self.rdb.xclaim(stream_key, self.group, self.consumer, 0, msg_ids[i:i + self.batch_size],
+                                          justid=True)
+            except redis.RedisError as err:
+                log.warning('stream touch failed', extra={'stream': stream_key, 'error': str(err)})
+
+    async def claim(self):
+        for stream_key in self.registry:
+            if not self.readable(stream_key):
+                continue
+            try:
+                self.claimed(stream_key, await self.rdb.xautoclaim(stream_key, self.group, self.consumer,
+                                                                   self.claim_idle_ms, count=self.batch_size,
+                                                                   justid=True))
+            except redis.RedisError as err:
+                log.warning('stream claim failed', extra={'stream': stream_key, 'error': str(err)})
+
+    async def retry(self, batches: list, failures: int) -> int:
+        if batches and failures >= self.max_retries:
+            for stream_key, messages in batches:
+                log.error('dropping messages', extra={'stream': stream_key, 'messages': len(messages),
+                                                      'attempts': failures})
+                try:
+                    await self.ack(stream_key, messages)
+                except redis.RedisError:
+                    self.pending[stream_key] = '0'
+            return 0
+        for stream_key in self.pending:
+            self.pending[stream_key] = '0'
+        return failures
+
+    async def dispatch_blocking(self, stream_key: str, messages: list):
+        try:
+            await asyncio.to_thread(self.dispatch, stream_key, messages)
+            await self.ack(stream_key, messages)
+        except Exception:
+            log.exception('blocking batch failed', extra={'stream': stream_key})
+            self.pending[stream_key] = '0'
+        finally:
+            del self.busy[stream_key]
+            del self.busy_ids[stream_key]
+
+    async def run(self):
+        """
+        after_batch callbacks may be coroutine functions.
+        """
+        await self.create_groups()
+        failures = 0
+        while True:
+            batches = []
+            try:
+                batches = await self.read()
+                for stream_key, messages in batches:
+                    if stream_key in self.blocking:
+                        self.busy_ids[stream_key] = [message[0] for message in messages]
+                        self.busy[stream_key] = asyncio.create_task(self.dispatch_blocking(stream_key, messages))
+                        continue
+                    self.dispatch(stream_key, messages)
+                    await self.ack(stream_key, messages)
+                await self.ack_released()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('stream read failed', extra={'group': self.group})
+                failures = await self.retry([b for b in batches if b[0] not in self.busy], failures + 1)
+                await asyncio.sleep(1)
+                continue
+            for callback in self.after_batch:
+                try:
+                    result = callback()
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception:
+                    log.exception('after batch callback failed', extra={'callback': callback.__name__})
+            if self.lag_due():
+                await self.update_lag()
+            if self.touch_due():
+                await self.touch()
+            if self.claim_due():
+                await self.claim()
+
+
+class ChirpAsyncDcAccumulator(ChirpDcAccumulator):
+    """
+    ChirpDcAccumulator written out over an asyncpg pool.
+
+    handlers keep calling debit_tenant/debit_device, the flush runs on the
+    event loop from flush_async(), the pool is set by ChirpAsyncBridge.
+    on_flushed may be a coroutine function.
+    """
+    data_errors = (asyncpg.exceptions.DataError,)
+
+    def __init__(self, max_pending: int = 1000, flush_interval: float = 5.0, balance_index=None):
+        super().__init__(db_pool=None, max_pending=max_pending, flush_interval=flush_interval,
+                         balance_index=balance_index)
+        self.pg = None
+        # the time trigger and the after batch callback must not flush at once.
+        self.flush_lock = asyncio.Lock()
+
+    def maybe_flush(self):
+        # the stream batch handlers await maybe_flush_async() instead.
+        return
+
+    async def maybe_flush_async(self):
+        if self.due():
+            await self.flush_async()
+
+    async def flush_async(self):
+        async with self.flush_lock:
+            with self.lock:
+                entries, acks = self.drain()
+            self.begin_write()
+            try:
+                if self.failures >= self.max_attempts:
+                    await self.isolate_async(entries)
+                else:
+                    await self.write_async(entries)
+            except Exception:
+                self.end_write([])
+                self.failures += 1
+                self.restore(entries, acks)
+                raise
+            self.end_write(entries)
+            if entries:
+                self.failures = 0
+            await self.release_async(acks)
+
+    async def isolate_async(self, entries: list[tuple]):
+        log.warning('dc flush keeps failing, writing entries one by one', extra={'entries': len(entries)})
+        for entry in entries:
+            try:
+                await self.write_async([entry])
+            except self.data_errors as err:
+                self.rejected(entry, err)
+
+    async def release_async(self, acks: dict):
+        if acks and self.on_flushed is not None:
+            result = self.on_flushed(acks)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def write_async(self, entries: list[tuple]):
+        if not entries:
+            return
+        days = self.new_partitions(entries)
+        with timed(POSTGRES_SECONDS, POSTGRES_ERRORS, 'asyncpg'):
+            async with self.pg.acquire() as con:
+                async with con.transaction():
+                    for day in days:
+                        await con.execute(partition_sql(day))
+                    await con.execute(LEDGER_STAGING)
+                    await con.copy_records_to_table('helium_dc_staging', records=entries, columns=LEDGER_COLUMNS)
+                    inserted = await con.fetchval(LEDGER_INSERT)
+        self.partitions.update(days)
+        self.flushed(entries, inserted)
+
+    async def rollup_async(self):
+        with timed(POSTGRES_SECONDS, POSTGRES_ERRORS, 'asyncpg'):
+            async with self.pg.acquire() as con:
+                row = await con.fetchrow(ROLLUP)
+        log.info('dc rolled up', extra=dict(row))
+
+    async def run_async(self):
+        """
+        flush on the time trigger while the streams are idle.
+        """
+        while True:
+            await asyncio.sleep(min(self.flush_interval, 1))
+            try:
+                await self.maybe_flush_async()
+            except Exception:
+                log.exception('dc flush failed')
+
+
+class ChirpAsyncChirpstackClient:
+    """
+    ChirpstackClient on grpc.aio, same channel options and return values.
+    """
+    def __init__(
+            self,
+            chirpstack_host: str,
+            chirpstack_token: str,
+            timeout: float = 10.0,
+            keepalive_ms: int = 30000,
+    ):
+        self.auth_token = [('authorization', f'Bearer {chirpstack_token}')]
+        self.timeout = timeout
+        self.channel = grpc.aio.insecure_channel(
+            chirpstack_host,
+            options=[
+                ('grpc.keepalive_time_ms', keepalive_ms),
+                ('grpc.keepalive_timeout_ms', 10000),
+                ('grpc.keepalive_permit_without_calls', 1),
+                ('grpc.http2.max_pings_without_data', 0),
+                ('grpc.initial_reconnect_backoff_ms', 1000),
+                ('grpc.max_reconnect_backoff_ms', 30000),
+                ('grpc.enable_retries', 1),
+                ('grpc.service_config', SERVICE_CONFIG),
+            ]
+        )
+        self.device_service = api.DeviceServiceStub(self.channel)
+
+    async def get_device(self, dev_eui: str) -> dict:
+        req = api.GetDeviceRequest()
+        req.dev_eui = dev_eui
+        with timed(GRPC_SECONDS, GRPC_ERRORS, 'Get'):
+            resp = await self.device_service.Get(req, metadata=self.auth_token, timeout=self.timeout)
+        return MessageToDict(resp)['device']
+
+    async def get_device_activation(self, dev_eui: str) -> dict:
+        req = api.GetDeviceActivationRequest()
+        req.dev_eui = dev_eui
+        with timed(GRPC_SECONDS, GRPC_ERRORS, 'GetActivation'):
+            resp = await self.device_service.GetActivation(req, metadata=self.auth_token, timeout=self.timeout)
+        data = MessageToDict(resp)
+        if bool(data):
+            return data['deviceActivation']
+        return data
+
+    async def close(self):
+        await self.channel.close()
+
+
+class ChirpAsyncHprRunner:
+    """
+    ChirpHprRunner on asyncio subprocesses, at most concurrency hpr
+    processes run at once.
+    """
+    def __init__(self, hpr_path: str = 'hpr', timeout: float = 120.0, concurrency: int = 4):
+        self.hpr_path = hpr_path
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(concurrency)
+
+    async def run(self, args: list[str]) -> bytes:
+        async with self.slots:
+            with timed(ROUTE_SECONDS, ROUTE_ERRORS, 'hpr', ' '.join(args[:3])):
+                return await self.run_process(args)
+
+    async def run_process(self, args: list[str]) -> bytes:
+        p = await asyncio.create_subprocess_exec(
+            self.hpr_path, *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(p.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+            raise RuntimeError(f'hpr {" ".join(args[:3])} timed out after {self.timeout}s')
+        if p.returncode != 0:
+            raise RuntimeError(f'hpr {" ".join(args[:3])} failed: {stderr.decode(errors="replace").strip()}')
+        return stdout
+
+    async def run_one(self, args: list[str]) -> int:
+        try:
+            await self.run(args)
+            return 0
+        except Exception as err:
+            log.error('hpr call failed', extra={'error': str(err)})
+            return 1
+
+
+class ChirpAsyncBridge:
+    """
+    Runs the bridge on one asyncio event loop instead of a thread per task.
+
+    the stream reads, dc flushes, device sync grpc calls and hpr
+    subprocesses are coroutines, so thousands of them can be in flight
+    without a thread each. handlers registered on the dispatcher are the
+    threaded runtime's, run inline on the loop unless their stream is
+    registered as blocking (api requests, meta records reading the device
+    cache), those run on a worker thread. the session loader and the grpc
+    route backend are still blocking code and run on the default executor,
+    at most blocking_concurrency at once. join session refreshes, tenant
+    disables and coalesced api batches go through the route updater and
+    the threaded hpr runner on their own thread pools, handlers only
+    submit to them, so none of their postgres or hpr calls run on the loop.
+    """
+    def __init__(
+            self,
+            route_id: str,
+            dispatcher: ChirpAsyncStreamDispatcher,
+            client_keys: ChirpDeviceKeys,
+            device_sync: ChirpDeviceSync,
+            dc_accumulator: ChirpAsyncDcAccumulator,
+            postgres_dsn: str,
+            chirpstack_host: str,
+            chirpstack_token: str,
+            grpc_timeout: float = 10.0,
+            pool_min_size: int = 1,
+            pool_max_size: int = 10,
+            hpr_path: str = 'hpr',
+            hpr_timeout: float = 120.0,
+            hpr_concurrency: int = 4,
+            blocking_concurrency: int = 4,
+            skfs_reconcile_interval: int = 3600,
+            sync_interval: int = 300,
+            dc_rollup_interval: int = 60,
+            metrics_port: int = 0,
+            leader=None,
+    ):
+        self.route_id = route_id
+        self.dispatcher = dispatcher
+        self.keys = client_keys
+        self.device_sync = device_sync
+        self.dc = dc_accumulator
+        self.postgres_dsn = postgres_dsn
+        self.chirpstack_host = chirpstack_host
+        self.chirpstack_token = chirpstack_token
+        self.grpc_timeout = grpc_timeout
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        self.hpr_path = hpr_path
+        self.hpr_timeout = hpr_timeout
+        self.hpr_concurrency = hpr_concurrency
+        self.blocking_concurrency = blocking_concurrency
+        self.skfs_reconcile_interval = skfs_reconcile_interval
+        self.sync_interval = sync_interval
+        self.dc_rollup_interval = dc_rollup_interval
+        self.metrics_port = metrics_port
+        self.leader = leader
+        self.pg = None
+        self.cs = None
+        self.hpr = None
+        self.blocking = None
+
+    async def run_blocking(self, fn, *args):
+        async with self.blocking:
+            return await asyncio.to_thread(fn, *args)
+
+    async def run_every(self, fn, interval: int):
+        name = fn.__name__
+        JOB_INTERVAL.labels(name).set(interval)
+        duration = JOB_SECONDS.labels(name)
+        while True:
+            start = time.time()
+            try:
+                await fn()
+                log.info('job done', extra={'job': name, 'interval': interval,
+                                            'duration': round(time.time() - start, 2)})
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                JOB_ERRORS.labels(name).inc()
+                log.exception('job failed', extra={'job': name})
+            duration.observe(time.time() - start)
+            await asyncio.sleep(max(0, interval - (time.time() - start)))
+
+    async def acquire(self):
+        while wait := self.device_sync.limiter.try_acquire():
+            await asyncio.sleep(wait)
+
+    async def fetch_device(self, dev_eui: str) -> tuple:
+        await self.acquire()
+        device = await self.cs.get_device(dev_eui)
+        await self.acquire()
+        activation = await self.cs.get_device_activation(dev_eui)
+        return self.keys.merge_keys(device, activation)
+
+    async def upsert_devices(self, rows: list[tuple]):
+        rows = list({row[0]: row for row in rows}.values())
+        if not rows:
+            return
+        with timed(POSTGRES_SECONDS, POSTGRES_ERRORS, 'asyncpg'):
+            async with self.pg.acquire() as con:
+                await con.execute("""
+                    INSERT INTO helium_devices
+                    (dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down)
+                    SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::int[], $5::text[],
+                                         $6::text[], $7::text[], $8::bigint[], $9::bigint[])
+                    ON CONFLICT (dev_eui) DO UPDATE
+                    SET join_eui = EXCLUDED.join_eui,
+                        dev_addr = EXCLUDED.dev_addr,
+                        max_copies = EXCLUDED.max_copies,
+                        aps_key = EXCLUDED.aps_key,
+                        nws_key = EXCLUDED.nws_key,
+                        dev_name = EXCLUDED.dev_name,
+                        fcnt_up = EXCLUDED.fcnt_up,
+                        fcnt_down = EXCLUDED.fcnt_down;
+                """, *[list(column) for column in zip(*rows)])
+        if self.keys.devices is not None:
+            await self.run_blocking(self.keys.fill_cache, rows)
+
+    async def apply_sessions(self, changes: dict[str, tuple]) -> dict:
+        """
+        ChirpDeviceKeys.apply_sessions with the hpr calls as subprocess coroutines.
+        """
+        backend = self.keys.route.backend
+        if not isinstance(backend, ChirpHprBackend):
+            return await self.run_blocking(self.keys.apply_sessions, changes)
+        failed = 0
+        for action, entries in (('remove', [old for old, _ in changes.values() if old is not None]),
+                                ('add', [new for _, new in changes.values() if new is not None])):
+            if entries:
+                failed += (await self.update_skfs(backend, action, entries))[1]
+        return {'failed': failed}
+
+    async def upsert_sessions(self, rows: list[tuple]) -> dict:
+        """
+        ChirpDeviceKeys.upsert_sessions over asyncpg.
+        """
+        rows = list({row[0]: row for row in rows}.values())
+        if not rows:
+            return {'changed': 0, 'failed': 0}
+        with timed(POSTGRES_SECONDS, POSTGRES_ERRORS, 'asyncpg'):
+            async with self.pg.acquire() as con:
+                current = {row['dev_eui']: dict(row) for row in await con.fetch(SESSIONS.replace('%s', '$1'),
+                                                                               [row[0] for row in rows])}
+        changes = session_changes(rows, current)
+        failed = 0
+        if changes:
+            if (await self.apply_sessions(changes))['failed']:
+                failed = len(changes)
+                rows = [row for row in rows if row[0] not in changes]
+                log.warning('session route update failed, keeping the old sessions', extra={'devices': failed})
+        await self.upsert_devices(rows)
+        return {'changed': len(changes), 'failed': failed}
+
+    async def sync_devices(self, dev_euis: list[str]) -> dict:
+        """
+        ChirpDeviceSync.sync_devices with sync concurrency coroutines per batch.
+        """
+        start = time.monotonic()
+        slots = asyncio.Semaphore(self.device_sync.concurrency)
+        updated = 0
+        failed = 0
+
+        async def fetch(dev_eui):
+            async with slots:
+                return await self.fetch_device(dev_eui)
+
+        size = self.device_sync.batch_size
+        for i in range(0, len(dev_euis), size):
+            batch = dev_euis[i:i + size]
+            rows = []
+            for dev_eui, result in zip(batch, await asyncio.gather(*[fetch(d) for d in batch], return_exceptions=True)):
+                if isinstance(result, Exception):
+                    failed += 1
+                    log.error('device sync failed', extra={'dev_eui': dev_eui, 'error': str(result)})
+                else:
+                    rows.append(result)
+            pushed = await self.upsert_sessions(rows)
+            updated += len(rows) - pushed['failed']
+            failed += pushed['failed']
+        return {
+            'devices': len(dev_euis),
+            'updated': updated,
+            'failed': failed,
+            'duration': round(time.monotonic() - start, 2),
+        }
+
+    async def sync(self) -> dict:
+        full, since = self.device_sync.begin_pass()
+        devices = await self.run_blocking(self.keys.fetch_changed_devices, since)
+        dev_euis = [dev['dev_eui'] for dev in devices]
+        stats = None
+        if self.device_sync.loader is not None:
+            try:
+                stats = await self.run_blocking(self.device_sync.load_devices, None if full else dev_euis)
+            except Exception:
+                log.exception('session loader failed, falling back to grpc')
+        if stats is None:
+            stats = await self.sync_devices(dev_euis)
+        return self.device_sync.end_pass(full, devices, stats)
+
+    async def update_skfs(self, backend: ChirpHprBackend, action: str, entries: list[tuple]) -> tuple[int, int]:
+        path = backend.skfs_update_file(action, entries)
+        try:
+            await self.hpr.run(backend.skfs_update_args(self.route_id, path))
+            return 1, 0
+        except Exception as err:
+            log.warning('skfs batch rejected, applying entries one by one',
+                        extra={'entries': len(entries), 'error': str(err)})
+        finally:
+            os.unlink(path)
+        results = await asyncio.gather(*[self.hpr.run_one(backend.skfs_args(action, self.route_id, entry))
+                                         for entry in entries])
+        return 1 + len(entries), sum(results)
+
+    async def helium_skfs_update(self) -> dict:
+        """
+        ChirpDeviceKeys.helium_skfs_update with the hpr calls as subprocess
+        coroutines. other route backends run the threaded version.
+        """
+        backend = self.keys.route.backend
+        if not isinstance(backend, ChirpHprBackend):
+            return await self.run_blocking(self.keys.helium_skfs_update)
+
+        start = time.monotonic()
+        skfs_list = ujson.loads(await self.hpr.run(['route', 'skfs', 'list', '--route-id', self.route_id]))
+        with timed(POSTGRES_SECONDS, POSTGRES_ERRORS, 'asyncpg'):
+            async with self.pg.acquire() as con:
+                helium_devices = [dict(row) for row in await con.fetch(
+                    'SELECT dev_addr, nws_key, max_copies FROM helium_devices WHERE is_disabled=false;'
+                )]
+        plan = plan_skfs(skfs_list, helium_devices)
+        stats = {key: len(value) for key, value in plan.items()}
+        log.info('skfs plan', extra={'dry_run': self.keys.skfs_dry_run, **stats})
+        if self.keys.skfs_dry_run:
+            return stats
+
+        size = backend.skfs_batch_size
+        invocations = 0
+        failed = 0
+        for action in ('remove', 'add'):
+            entries = sorted(plan[action])
+            results = await asyncio.gather(*[self.update_skfs(backend, action, entries[i:i + size])
+                                             for i in range(0, len(entries), size)])
+            invocations += sum(calls for calls, _ in results)
+            failed += sum(failures for _, failures in results)
+        stats.update({'invocations': invocations, 'failed': failed, 'duration': round(time.monotonic() - start, 2)})
+        log.info('route update', extra=stats)
+        return stats
+
+    def singleton(self, fn):
+        """
+        jobs only one replica may run go through the leader lease.
+        """
+        return fn if self.leader is None else self.leader.only(fn)
+
+    async def report(self):
+        report_suppressed()
+
+    async def shutdown(self, tasks: list):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await self.dc.flush_async()
+            await self.dc.rollup_async()
+        except Exception:
+            log.exception('dc flush on shutdown failed')
+        try:
+            await self.dispatcher.ack_released()
+        except Exception:
+            log.exception('stream ack on shutdown failed')
+        await self.cs.close()
+        await self.dispatcher.rdb.close()
+        await self.pg.close()
+
+    async def run(self):
+        self.pg = await asyncpg.create_pool(self.postgres_dsn, min_size=self.pool_min_size, max_size=self.pool_max_size)
+        self.dc.pg = self.pg
+        self.cs = ChirpAsyncChirpstackClient(
+            chirpstack_host=self.chirpstack_host,
+            chirpstack_token=self.chirpstack_token,
+            timeout=self.grpc_timeout
+        )
+        self.hpr = ChirpAsyncHprRunner(hpr_path=self.hpr_path, timeout=self.hpr_timeout,
+                                       concurrency=self.hpr_concurrency)
+        self.blocking = asyncio.Semaphore(self.blocking_concurrency)
+        self.dispatcher.on_batch(self.dc.maybe_flush_async)
+        if self.metrics_port:
+            await ChirpMetricsServer(port=self.metrics_port).start()
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+        tasks = [
+            asyncio.create_task(self.dispatcher.run()),
+            asyncio.create_task(self.dc.run_async()),
+            asyncio.create_task(self.run_every(self.singleton(self.helium_skfs_update), self.skfs_reconcile_interval)),
+            asyncio.create_task(self.run_every(self.singleton(self.sync), self.sync_interval)),
+            asyncio.create_task(self.run_every(self.singleton(self.dc.rollup_async), self.dc_rollup_interval)),
+            asyncio.create_task(self.run_every(self.report, 60)),
+        ]
+        await stop.wait()
+        log.info('received shutdown signal, flushing dc debits')
+        await self.shutdown(tasks)
@@ -0,0 +1,74 @@
+import logging
+import threading
+from cachetools import TTLCache
+from ChirpHeliumPool import ChirpPostgresPool
+from ChirpHeliumMetrics import DEVICE_CACHE
+
+
+log = logging.getLogger(__name__)
+
+# helium_devices keys plus the owning tenant from chirpstack's device and application tables,
+# a deleted chirpstack device keeps its helium_devices row without a tenant.
+DEVICES = """
+    SELECT hd.dev_eui, a.tenant_id::text AS tenant_id, hd.join_eui, hd.dev_addr, hd.nws_key, hd.max_copies
+    FROM helium_devices hd
+    LEFT JOIN device d ON d.dev_eui = decode(hd.dev_eui, 'hex')
+    LEFT JOIN application a ON a.id = d.application_id
+    WHERE hd.dev_eui = ANY(%s);
+"""
+
+# cached for devices without a helium_devices row, so unknown devices cost one read per ttl.
+MISSING = {}
+
+
+class ChirpDeviceCache:
+    """
+    Bounded dev_eui -> {tenant_id, join_eui, dev_addr, nws_key, max_copies}
+    cache in front of helium_devices, for handlers that only get a dev_eui.
+
+    entries are filled in bulk by the key sync after each upsert, read
+    through from postgres on a miss and dropped by api Update/Delete
+    events. the least recently used entries go once maxsize is reached,
+    any entry after ttl seconds.
+    """
+    def __init__(
+            self,
+            db_pool: ChirpPostgresPool,
+            maxsize: int = 100_000,
+            ttl: float = 3600.0,
+    ):
+        self.db_pool = db_pool
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def fill(self, dev_euis: list[str]) -> list[dict]:
+        """
+        (re)load dev_euis from helium_devices, returns the rows found.
+        """
+        if not dev_euis:
+            return []
+        rows = self.db_pool.fetch(DEVICES, (list(dev_euis),))
+        found = {row['dev_eui']: {key: value for key, value in row.items() if key != 'dev_eui'} for row in rows}
+        with self.lock:
+            for dev_eui in dev_euis:
+                self.cache[dev_eui] = found.get(dev_eui, MISSING)
+        return rows
+
+    def get(self, dev_eui: str) -> dict:
+        """
+        cached device, None when helium_devices has no row for it.
+        """
+        with self.lock:
+            device = self.cache.get(dev_eui)
+        if device is None:
+            DEVICE_CACHE.labels('miss').inc()
+            self.fill([dev_eui])
+            with self.lock:
+                device = self.cache.get(dev_eui, MISSING)
+        else:
+            DEVICE_CACHE.labels('hit').inc()
+        return device or None
+
+    def invalidate(self, dev_eui: str):
+        with self.lock:
+            self.cache.pop(dev_eui, None)
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from ChirpHeliumMetrics import API_EVENTS, API_CHANGES
+
+
+log = logging.getLogger(__name__)
+
+
+def net_changes(events: dict[str, list[tuple]]) -> dict[str, list[str]]:
+    """
+    collapse each device's (method, is_disabled) api events to its net change.
+
+    a device created and deleted within the window is a no-op, a device
+    deleted and created again is removed (old euis and skfs) and added.
+    enable/disable toggles only count with their final value, an Update
+    with is_disabled None leaves it unchanged. a device created disabled is
+    added to helium_devices but kept off the route. existing devices that
+    were updated without a toggle are listed under update, their keys,
+    dev_addr or max_copies may have changed.
+    """
+    changes = {'remove': [], 'add': [], 'enable': [], 'disable': [], 'update': []}
+    for dev_eui, device_events in events.items():
+        existed = device_events[0][0] != 'Create'
+        exists = True
+        recreated = False
+        disabled = None
+        updated = False
+        for method, is_disabled in device_events:
+            if method == 'Create':
+                recreated = recreated or (existed and not exists)
+                exists = True
+                disabled = None
+            elif method == 'Delete':
+                exists = False
+                disabled = None
+            elif method == 'Update' and exists:
+                updated = True
+                if is_disabled is not None:
+                    disabled = is_disabled
+        if not exists:
+            if existed:
+                changes['remove'].append(dev_eui)
+        elif not existed or recreated:
+            if recreated:
+                changes['remove'].append(dev_eui)
+            changes['add'].append(dev_eui)
+            if disabled:
+                changes['disable'].append(dev_eui)
+        elif disabled is not None:
+            changes['disable' if disabled else 'enable'].append(dev_eui)
+        elif updated:
+            changes['update'].append(dev_eui)
+    return changes
+
+
+class ChirpDeviceCoalescer:
+    """
+    Buffers api DeviceService Create/Update/Delete events per dev_eui and
+    hands their net changes to apply(changes) in one batch, so a bulk import
+    or a burst of enable/disable toggles costs one route update instead of
+    one per event.
+
+    a batch goes out window seconds after the first event it holds, or once
+    max_pending events are buffered.
+
+    the coalescer is the api stream's ack gate: entries held with hold() are
+    handed to on_flushed({stream_key: [msg_id]}) once the batch recorded
+    before them has been applied, a failed batch keeps them held. a crash
+    within the window leaves them pending to be read again.
+    """
+    def __init__(
+            self,
+            apply,
+            window: float = 2.0,
+            max_pending: int = 5000,
+    ):
+        self.apply = apply
+        self.window = window
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        # dev_eui -> [(method, is_disabled)] in stream order.
+        self.events = {}
+        # stream_key -> msg_ids acknowledged once the events before them are applied.
+        self.acks = {}
+        self.on_flushed = None
+        self.count = 0
+        self.first = None
+
+    @property
+    def pending(self) -> int:
+        return self.count
+
+    def record(self, dev_eui: str, method: str, is_disabled: bool = None):
+        API_EVENTS.labels(method).inc()
+        with self.lock:
+            if self.first is None:
+                self.first = time.monotonic()
+            self.events.setdefault(dev_eui, []).append((method, is_disabled))
+            self.count += 1
+        if self.pending >= self.max_pending:
+            self.flush()
+
+    def hold(self, stream_key: str, msg_ids: list):
+        with self.lock:
+            if self.first is None:
+                self.first = time.monotonic()
+            self.acks.setdefault(stream_key, []).extend(msg_ids)
+
+    def held(self, stream_key: str) -> list:
+        with self.lock:
+            return list(self.acks.get(stream_key, ()))
+
+    def due(self) -> bool:
+        first = self.first
+        return self.pending >= self.max_pending or \
+            (first is not None and time.monotonic() - first >= self.window)
+
+    def maybe_flush(self):
+        if self.due():
+            self.flush()
+
+    def drain(self) -> tuple[dict[str, list[tuple]], dict]:
+        """
+        swap out the buffered events and held acks, caller must hold self.lock.
+        """
+        events, self.events = self.events, {}
+        acks, self.acks = self.acks, {}
+        self.count = 0
+        self.first = None
+        return events, acks
+
+    def restore(self, events: dict[str, list[tuple]], acks: dict):
+        """
+        put events and acks from a failed batch back in front of the ones recorded since.
+        """
+        with self.lock:
+            for dev_eui, device_events in events.items():
+                self.events[dev_eui] = device_events + self.events.get(dev_eui, [])
+                self.count += len(device_events)
+            for stream_key, msg_ids in acks.items():
+                self.acks[stream_key] = msg_ids + self.acks.get(stream_key, [])
+            if self.first is None:
+                self.first = time.monotonic()
+
+    def release(self, acks: dict):
+        if acks and self.on_flushed is not None:
+            self.on_flushed(acks)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                events, acks = self.drain()
+            if not events:
+                self.release(acks)
+                return
+            changes = net_changes(events)
+            for action, dev_euis in changes.items():
+                API_CHANGES.labels(action).inc(len(dev_euis))
+            log.info('api device events coalesced', extra={'events': sum(len(e) for e in events.values()),
+                                                           'devices': len(events),
+                                                           **{action: len(dev_euis)
+                                                              for action, dev_euis in changes.items()}})
+            try:
+                self.apply(changes)
+            except Exception:
+                self.restore(events, acks)
+                raise
+            self.release(acks)
+
+    def run(self):
+        """
+        flush on the time trigger while the api stream is idle.
+        """
+        while True:
+            time.sleep(min(self.window, 1))
+            try:
+                self.maybe_flush()
+            except Exception:
+                log.exception('api device batch failed')
+
+    def close(self):
+        """
+        final flush on shutdown.
+        """
+        self.flush()
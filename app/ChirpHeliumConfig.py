@@ -0,0 +1,230 @@
+import time
+import logging
+import grpc
+from nacl.signing import SigningKey
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from ChirpHeliumMetrics import ROUTE_SECONDS, ROUTE_ERRORS, timed
+
+
+log = logging.getLogger(__name__)
+
+# field types used by the route messages below.
+TYPES = {
+    'string': descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    'bytes': descriptor_pb2.FieldDescriptorProto.TYPE_BYTES,
+    'uint32': descriptor_pb2.FieldDescriptorProto.TYPE_UINT32,
+    'uint64': descriptor_pb2.FieldDescriptorProto.TYPE_UINT64,
+}
+
+# subset of helium/proto iot_config.proto used by the route service calls,
+# (name, number, type, repeated). '.' types are messages, 'action_v1' the enum.
+SCHEMA = {
+    'eui_pair_v1': [
+        ('route_id', 1, 'string', False),
+        ('app_eui', 2, 'uint64', False),
+        ('dev_eui', 3, 'uint64', False),
+    ],
+    'route_get_euis_req_v1': [
+        ('route_id', 1, 'string', False),
+        ('timestamp', 2, 'uint64', False),
+        ('signer', 3, 'bytes', False),
+        ('signature', 4, 'bytes', False),
+    ],
+    'route_update_euis_req_v1': [
+        ('action', 1, 'action_v1', False),
+        ('eui_pair', 2, '.eui_pair_v1', False),
+        ('timestamp', 3, 'uint64', False),
+        ('signer', 4, 'bytes', False),
+        ('signature', 5, 'bytes', False),
+    ],
+    'route_euis_res_v1': [],
+    'skf_v1': [
+        ('route_id', 1, 'string', False),
+        ('devaddr', 2, 'uint32', False),
+        ('session_key', 3, 'string', False),
+        ('max_copies', 4, 'uint32', False),
+    ],
+    'route_skf_list_req_v1': [
+        ('route_id', 1, 'string', False),
+        ('timestamp', 2, 'uint64', False),
+        ('signer', 3, 'bytes', False),
+        ('signature', 4, 'bytes', False),
+    ],
+    'route_skf_update_v1': [
+        ('devaddr', 1, 'uint32', False),
+        ('session_key', 2, 'string', False),
+        ('action', 3, 'action_v1', False),
+        ('max_copies', 4, 'uint32', False),
+    ],
+    'route_skf_update_req_v1': [
+        ('route_id', 1, 'string', False),
+        ('updates', 2, '.route_skf_update_v1', True),
+        ('timestamp', 3, 'uint64', False),
+        ('signer', 4, 'bytes', False),
+        ('signature', 5, 'bytes', False),
+    ],
+    'route_skf_update_res_v1': [],
+}
+
+PACKAGE = 'helium.iot_config'
+ROUTE_SERVICE = f'/{PACKAGE}.route'
+ACTIONS = {'add': 0, 'remove': 1}
+
+
+def _route_messages() -> dict:
+    """
+    build the route message classes at runtime, the helium protos are not
+    published as a python package.
+    """
+    f = descriptor_pb2.FieldDescriptorProto
+    fd = descriptor_pb2.FileDescriptorProto(name='helium_iot_config_route.proto', package=PACKAGE, syntax='proto3')
+    action = fd.enum_type.add(name='action_v1')
+    for name, number in ACTIONS.items():
+        action.value.add(name=name, number=number)
+
+    for name, fields in SCHEMA.items():
+        msg = fd.message_type.add(name=name)
+        for field_name, number, field_type, repeated in fields:
+            field = msg.field.add(name=field_name, number=number)
+            field.label = f.LABEL_REPEATED if repeated else f.LABEL_OPTIONAL
+            if field_type.startswith('.'):
+                field.type = f.TYPE_MESSAGE
+                field.type_name = f'.{PACKAGE}{field_type}'
+            elif field_type == 'action_v1':
+                field.type = f.TYPE_ENUM
+                field.type_name = f'.{PACKAGE}.action_v1'
+            else:
+                field.type = TYPES[field_type]
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(fd)
+    return {name: message_factory.GetMessageClass(pool.FindMessageTypeByName(f'{PACKAGE}.{name}'))
+            for name in SCHEMA}
+
+
+messages = _route_messages()
+
+
+class HeliumKeypair:
+    """
+    ed25519 delegate keypair in helium-crypto's binary format,
+    a key tag byte followed by the 32 byte seed and 32 byte public key.
+    """
+    def __init__(self, keypair_path: str):
+        with open(keypair_path, 'rb') as fh:
+            raw = fh.read()
+        if len(raw) != 65 or raw[0] & 0x0F != 1:
+            raise ValueError(f'{keypair_path} is not an ed25519 helium keypair')
+        self.tag = raw[0]
+        self.signing_key = SigningKey(raw[1:33])
+        public = bytes(self.signing_key.verify_key)
+        if public != raw[33:65]:
+            raise ValueError(f'{keypair_path} public key does not match its seed')
+        # helium public key binary, key tag + raw key.
+        self.public_key = bytes([self.tag]) + public
+
+    def sign(self, msg):
+        """
+        fill timestamp, signer and signature, signing the message with an empty signature.
+        """
+        msg.timestamp = int(time.time() * 1000)
+        msg.signer = self.public_key
+        msg.signature = b''
+        msg.signature = self.signing_key.sign(msg.SerializeToString()).signature
+        return msg
+
+
+class ChirpConfigServiceBackend:
+    """
+    Route backend talking to the helium config service directly.
+
+    one persistent grpc channel is signed with the delegate keypair,
+    replacing a process spawn, key load and tls handshake per hpr call.
+    eui changes for a batch go out on one client stream, skfs changes as
+    one update request.
+    """
+    euis_batch_size = 1000
+
+    def __init__(
+            self,
+            config_host: str,
+            keypair_path: str,
+            skfs_batch_size: int = 100,
+            timeout: float = 30.0,
+    ):
+        self.keypair = HeliumKeypair(keypair_path)
+        self.skfs_batch_size = skfs_batch_size
+        self.timeout = timeout
+        target = config_host.split('://', 1)[-1]
+        options = [
+            ('grpc.keepalive_time_ms', 30000),
+            ('grpc.keepalive_permit_without_calls', 1),
+        ]
+        if config_host.startswith('https://'):
+            self.channel = grpc.secure_channel(target, grpc.ssl_channel_credentials(), options=options)
+        else:
+            self.channel = grpc.insecure_channel(target, options=options)
+
+        def method(kind, name, request, response):
+            return getattr(self.channel, kind)(
+                f'{ROUTE_SERVICE}/{name}',
+                request_serializer=messages[request].SerializeToString,
+                response_deserializer=messages[response].FromString,
+            )
+
+        self.get_euis = method('unary_stream', 'get_euis', 'route_get_euis_req_v1', 'eui_pair_v1')
+        self.update_euis_stream = method('stream_unary', 'update_euis', 'route_update_euis_req_v1', 'route_euis_res_v1')
+        self.list_skfs_stream = method('unary_stream', 'list_skfs', 'route_skf_list_req_v1', 'skf_v1')
+        self.update_skfs_call = method('unary_unary', 'update_skfs', 'route_skf_update_req_v1', 'route_skf_update_res_v1')
+
+    def list_euis(self, route_id: str) -> list[dict]:
+        req = self.keypair.sign(messages['route_get_euis_req_v1'](route_id=route_id))
+        with timed(ROUTE_SECONDS, ROUTE_ERRORS, 'config', 'get_euis'):
+            return [{'dev_eui': f'{pair.dev_eui:016x}', 'app_eui': f'{pair.app_eui:016x}'}
+                    for pair in self.get_euis(req, timeout=self.timeout)]
+
+    def list_skfs(self, route_id: str) -> list[dict]:
+        req = self.keypair.sign(messages['route_skf_list_req_v1'](route_id=route_id))
+        with timed(ROUTE_SECONDS, ROUTE_ERRORS, 'config', 'list_skfs'):
+            return [{'devaddr': f'{skf.devaddr:08x}', 'session_key': skf.session_key, 'max_copies': skf.max_copies}
+                    for skf in self.list_skfs_stream(req, timeout=self.timeout)]
+
+    def update_euis(self, route_id: str, action: str, pairs: list[tuple]) -> tuple[int, int]:
+        """
+        returns (invocations, failures), one stream per batch. pairs with an
+        empty or malformed eui are logged and counted as failures, the rest still go out.
+        """
+        valid = []
+        for dev_eui, join_eui in pairs:
+            try:
+                valid.append(messages['eui_pair_v1'](route_id=route_id, dev_eui=int(dev_eui, 16),
+                                                     app_eui=int(join_eui, 16)))
+            except (TypeError, ValueError):
+                log.error('invalid eui pair skipped', extra={'dev_eui': dev_eui, 'join_eui': join_eui,
+                                                             'action': action})
+        if not valid:
+            return 0, len(pairs)
+
+        def requests():
+            for pair in valid:
+                yield self.keypair.sign(messages['route_update_euis_req_v1'](action=ACTIONS[action], eui_pair=pair))
+
+        with timed(ROUTE_SECONDS, ROUTE_ERRORS, 'config', 'update_euis'):
+            self.update_euis_stream(requests(), timeout=self.timeout)
+        return 1, len(pairs) - len(valid)
+
+    def update_skfs(self, route_id: str, action: str, entries: list[tuple]) -> tuple[int, int]:
+        req = messages['route_skf_update_req_v1'](route_id=route_id)
+        for dev_addr, session_key, max_copies in entries:
+            req.updates.add(
+                devaddr=int(dev_addr, 16),
+                session_key=session_key,
+                action=ACTIONS[action],
+                max_copies=int(max_copies or 0)
+            )
+        with timed(ROUTE_SECONDS, ROUTE_ERRORS, 'config', 'update_skfs'):
+            self.update_skfs_call(self.keypair.sign(req), timeout=self.timeout)
+        return 1, 0
+
+    def close(self):
+        self.channel.close()
@@ -0,0 +1,14 @@
+def copy_field(value) -> str:
+    """
+    format a value for postgres COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_row(values) -> str:
+    """
+    one COPY text format line.
+    """
+    return '\t'.join(copy_field(value) for value in values) + '\n'
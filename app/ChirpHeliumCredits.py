@@ -0,0 +1,446 @@
+import io
+import uuid
+import logging
+import time
+import threading
+import psycopg2
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
+from ChirpHeliumPool import ChirpPostgresPool
+from ChirpHeliumCopy import copy_row
+from ChirpHeliumMetrics import record_dc_flush, TENANT_CROSSINGS
+
+
+log = logging.getLogger(__name__)
+
+LEDGER_COLUMNS = ('msg_id', 'kind', 'tenant_id', 'dev_eui', 'dc')
+
+# per session staging table, emptied by every commit so it is only created once per connection.
+LEDGER_STAGING = """
+    CREATE TEMP TABLE IF NOT EXISTS helium_dc_staging (
+        msg_id text, kind text, tenant_id uuid, dev_eui text, dc bigint
+    ) ON COMMIT DELETE ROWS;
+"""
+
+# a (msg_id, kind) already in the ledger is skipped, so replays never charge twice.
+# debits that did go in are summed into helium_dc_pending for the next rollup: event debits and
+# meta downlinks are charged to the tenant, meta debits count as device usage. meta uplinks are
+# not charged to the tenant, the uplink event already is.
+LEDGER_INSERT = """
+    WITH inserted AS (
+        INSERT INTO helium_dc_ledger (msg_id, kind, tenant_id, dev_eui, dc, ts)
+        SELECT msg_id, kind, tenant_id, dev_eui, dc, to_timestamp(split_part(msg_id, '-', 1)::bigint / 1000.0)
+        FROM helium_dc_staging
+        ON CONFLICT DO NOTHING
+        RETURNING kind, tenant_id, dev_eui, dc
+    ), pending AS (
+        INSERT INTO helium_dc_pending (tenant_id, dev_eui, dc)
+        SELECT tenant_id, NULL, sum(dc) FROM inserted
+        WHERE tenant_id IS NOT NULL AND kind <> 'meta_up'
+        GROUP BY tenant_id
+        UNION ALL
+        SELECT NULL, dev_eui, sum(dc) FROM inserted
+        WHERE kind IN ('meta_up', 'meta_down')
+        GROUP BY dev_eui
+    )
+    SELECT count(*) FROM inserted;
+"""
+
+# pending rows are deleted and applied in one statement, rows added meanwhile wait for the next rollup.
+ROLLUP = """
+    WITH moved AS (
+        DELETE FROM helium_dc_pending RETURNING tenant_id, dev_eui, dc
+    ), tenants AS (
+        UPDATE helium_tenant AS t SET dc_balance = (t.dc_balance - v.dc)
+        FROM (SELECT tenant_id, sum(dc) AS dc FROM moved WHERE tenant_id IS NOT NULL GROUP BY tenant_id) AS v
+        WHERE t.tenant_id = v.tenant_id
+        RETURNING t.tenant_id
+    ), devices AS (
+        UPDATE helium_devices AS d SET dc_used = (d.dc_used + v.dc)
+        FROM (SELECT dev_eui, sum(dc) AS dc FROM moved WHERE tenant_id IS NULL GROUP BY dev_eui) AS v
+        WHERE d.dev_eui = v.dev_eui
+        RETURNING d.dev_eui
+    )
+    SELECT (SELECT count(*) FROM tenants) AS tenants, (SELECT count(*) FROM devices) AS devices;
+"""
+
+# rolled up balance minus debits flushed since, debits still in memory are not counted.
+BALANCES = """
+    SELECT t.tenant_id::text AS tenant_id, t.dc_balance - COALESCE(p.dc, 0) AS balance, t.is_disabled
+    FROM helium_tenant t
+    LEFT JOIN (
+        SELECT tenant_id, sum(dc) AS dc FROM helium_dc_pending WHERE tenant_id IS NOT NULL GROUP BY tenant_id
+    ) AS p ON p.tenant_id = t.tenant_id;
+"""
+
+
+def ledger_days(entries: list[tuple]) -> set[int]:
+    """
+    utc days (since the epoch) of the stream IDs in entries.
+    """
+    return {int(entry[0].split('-', 1)[0]) // 86_400_000 for entry in entries}
+
+
+def partition_sql(day: int) -> str:
+    start = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(days=day)
+    end = start + timedelta(days=1)
+    return f"""
+        CREATE TABLE IF NOT EXISTS helium_dc_ledger_{start:%Y%m%d} PARTITION OF helium_dc_ledger
+        FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}');
+    """
+
+
+class ChirpDcAccumulator:
+    """
+    Buffers dc debits as ledger entries and writes them to the append-only
+    helium_dc_ledger with one COPY per flush, instead of an UPDATE per
+    stream message.
+
+    every entry is keyed on the stream message ID it was charged for and its
+    kind, so a re-delivered message is never charged twice. debits that
+    made it into the ledger are summed into helium_dc_pending, rollup()
+    periodically applies those to helium_tenant.dc_balance (event debits
+    and meta downlinks) and helium_devices.dc_used (meta debits).
+
+    flushes happen once max_pending debits have been recorded or
+    flush_interval seconds have passed.
+
+    entries COPY would reject are caught when they are recorded. should a
+    batch still fail max_attempts times in a row, it is written one entry at
+    a time and the entries postgres rejects as data are logged and dropped,
+    so one bad row cannot hold up every later flush.
+
+    stream entries held with hold() are handed to on_flushed({stream_key:
+    [msg_id]}) once the debits recorded before them are in the ledger, so a
+    crash before a flush leaves them pending to be read again instead of
+    losing their debits. the ledger key makes the re-read free.
+    """
+    # errors that reject an entry's values, as opposed to the connection or server.
+    data_errors = (psycopg2.DataError,)
+
+    def __init__(
+            self,
+            db_pool: ChirpPostgresPool,
+            max_pending: int = 1000,
+            flush_interval: float = 5.0,
+            max_attempts: int = 3,
+            balance_index: 'ChirpBalanceIndex' = None,
+    ):
+        self.db_pool = db_pool
+        self.balances = balance_index
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.entries = []
+        # stream_key -> msg_ids acknowledged once the entries before them are flushed.
+        self.acks = {}
+        self.on_flushed = None
+        self.failures = 0
+        self.last_flush = time.monotonic()
+        # ledger partitions known to exist, by utc day.
+        self.partitions = set()
+        # tenant ids already checked, kept off the per debit uuid parse.
+        self.tenants = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self.entries)
+
+    def entry(self, msg_id: str, kind: str, tenant_id: str, dev_eui: str, dc: int):
+        """
+        ledger entry for a debit, None when COPY would reject it. a malformed
+        tenant id is dropped from the entry, the debit itself is kept.
+        """
+        try:
+            int(msg_id.split('-', 1)[0])
+            dc = int(dc)
+        except (AttributeError, TypeError, ValueError):
+            log.error('invalid dc debit dropped', extra={'id': msg_id, 'kind': kind, 'dev_eui': dev_eui, 'dc': dc})
+            return None
+        if not tenant_id:
+            tenant_id = None
+        elif tenant_id not in self.tenants:
+            try:
+                uuid.UUID(tenant_id)
+                self.tenants.add(tenant_id)
+            except (AttributeError, TypeError, ValueError):
+                log.warning('invalid tenant id, debit recorded without it',
+                            extra={'id': msg_id, 'kind': kind, 'tenant_id': str(tenant_id)})
+                tenant_id = None
+        return msg_id, kind, tenant_id, dev_eui or None, dc
+
+    def _debit(self, msg_id: str, kind: str, dev_eui: str, dc: int, tenant_id: str):
+        entry = self.entry(msg_id, kind, tenant_id, dev_eui, dc)
+        if entry is not None:
+            with self.lock:
+                self.entries.append(entry)
+
+    def debit_tenant(self, msg_id: str, kind: str, tenant_id: str, dev_eui: str, dc: int):
+        self._debit(msg_id, kind, dev_eui, dc, tenant_id)
+
+    def debit_device(self, msg_id: str, kind: str, dev_eui: str, dc: int, tenant_id: str = None):
+        self._debit(msg_id, kind, dev_eui, dc, tenant_id)
+
+    def hold(self, stream_key: str, msg_ids: list):
+        """
+        acknowledge msg_ids after the next successful flush, see on_flushed.
+        """
+        with self.lock:
+            self.acks.setdefault(stream_key, []).extend(msg_ids)
+
+    def held(self, stream_key: str) -> list:
+        with self.lock:
+            return list(self.acks.get(stream_key, ()))
+
+    def due(self) -> bool:
+        return self.pending >= self.max_pending or \
+            time.monotonic() - self.last_flush >= self.flush_interval
+
+    def maybe_flush(self):
+        if self.due():
+            self.flush()
+
+    def drain(self) -> tuple[list[tuple], dict]:
+        """
+        swap out the pending entries and held acks, caller must hold self.lock.
+        """
+        entries, self.entries = self.entries, []
+        acks, self.acks = self.acks, {}
+        self.last_flush = time.monotonic()
+        return entries, acks
+
+    def restore(self, entries: list[tuple], acks: dict):
+        """
+        put entries and acks from a failed flush back in front so they go out with the next one.
+        """
+        with self.lock:
+            self.entries[:0] = entries
+            for stream_key, msg_ids in acks.items():
+                self.acks[stream_key] = msg_ids + self.acks.get(stream_key, [])
+
+    def rejected(self, entry: tuple, err: Exception):
+        log.error('dc debit rejected by postgres, dropped', extra={'entry': list(entry), 'error': str(err)})
+
+    def isolate(self, entries: list[tuple]):
+        """
+        write entries one at a time, dropping those rejected as data. other
+        errors (connection, server) still fail the flush, entries written
+        before them are skipped as duplicates on the next attempt.
+        """
+        log.warning('dc flush keeps failing, writing entries one by one', extra={'entries': len(entries)})
+        for entry in entries:
+            try:
+                self.write([entry])
+            except self.data_errors as err:
+                self.rejected(entry, err)
+
+    def begin_write(self):
+        if self.balances is not None:
+            self.balances.flush_started()
+
+    def end_write(self, entries: list[tuple]):
+        """
+        entries are in the ledger now (or were rejected), empty when the flush failed.
+        """
+        if self.balances is not None:
+            self.balances.flush_done(entries)
+
+    def release(self, acks: dict):
+        if acks and self.on_flushed is not None:
+            self.on_flushed(acks)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                entries, acks = self.drain()
+            self.begin_write()
+            try:
+                if self.failures >= self.max_attempts:
+                    self.isolate(entries)
+                else:
+                    self.write(entries)
+            except Exception:
+                self.end_write([])
+                self.failures += 1
+                self.restore(entries, acks)
+                raise
+            self.end_write(entries)
+            if entries:
+                self.failures = 0
+            self.release(acks)
+
+    def new_partitions(self, entries: list[tuple]) -> list[int]:
+        return sorted(ledger_days(entries) - self.partitions)
+
+    def flushed(self, entries: list[tuple], inserted: int):
+        record_dc_flush(entries, len(entries) - inserted)
+        log.info('dc flushed', extra={'entries': len(entries), 'duplicates': len(entries) - inserted})
+
+    def write(self, entries: list[tuple]):
+        if not entries:
+            return
+        buf = io.StringIO()
+        for entry in entries:
+            buf.write(copy_row(entry))
+        buf.seek(0)
+        days = self.new_partitions(entries)
+        with self.db_pool.connection() as con:
+            with con.cursor() as cur:
+                for day in days:
+                    cur.execute(partition_sql(day))
+                cur.execute(LEDGER_STAGING)
+                cur.copy_expert(f'COPY helium_dc_staging ({", ".join(LEDGER_COLUMNS)}) FROM STDIN', buf)
+                cur.execute(LEDGER_INSERT)
+                inserted = cur.fetchone()[0]
+        self.partitions.update(days)
+        self.flushed(entries, inserted)
+
+    def rollup(self):
+        """
+        apply the debits recorded since the last rollup to the balances.
+        """
+        rows = self.db_pool.fetch(ROLLUP)
+        log.info('dc rolled up', extra=rows[0])
+
+    def run(self):
+        """
+        flush on the time trigger while the streams are idle.
+        """
+        while True:
+            time.sleep(min(self.flush_interval, 1))
+            try:
+                self.maybe_flush()
+            except Exception:
+                log.exception('dc flush failed')
+
+    def close(self):
+        """
+        final flush on shutdown, the lock is kept so no debit can land after it.
+        """
+        self.flush_lock.acquire()
+        self.lock.acquire()
+        entries, acks = self.drain()
+        self.begin_write()
+        self.write(entries)
+        self.end_write(entries)
+        self.release(acks)
+        self.rollup()
+
+
+class ChirpBalanceIndex:
+    """
+    Live tenant dc balances, so a threshold check costs no postgres read per uplink.
+
+    load() takes the flushed balances from postgres, debit() lowers them
+    for every tenant debit. debits are keyed on (msg_id, kind) like the
+    ledger: a stream entry read again (retry, claim, restart) is only
+    debited once, and debits not flushed yet are kept across reloads. the
+    accumulator reports flushes through flush_started/flush_done, a load
+    that overlaps a flush is retried so no debit is counted in both.
+
+    a tenant is armed while its balance is above threshold, the debit that
+    takes it to or below the threshold disarms it and calls
+    on_crossing(tenant_id, balance) once, on the debiting thread. tenants
+    found at or below the threshold by load() and not disabled yet fire too.
+    """
+    def __init__(
+            self,
+            db_pool: ChirpPostgresPool,
+            threshold: int = 0,
+            on_crossing=None,
+            seen_size: int = 200_000,
+            seen_ttl: float = 3600.0,
+    ):
+        self.db_pool = db_pool
+        self.threshold = threshold
+        self.on_crossing = on_crossing
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.armed = set()
+        # (msg_id, kind) -> (tenant_id, dc) debited here and not in the ledger yet.
+        self.unflushed = {}
+        # (msg_id, kind) of debits flushed recently, re-reads of those are skipped.
+        self.seen = TTLCache(maxsize=seen_size, ttl=seen_ttl)
+        self.flushing = 0
+        self.generation = 0
+
+    def flush_started(self):
+        with self.lock:
+            self.flushing += 1
+            self.generation += 1
+
+    def flush_done(self, entries: list[tuple]):
+        with self.lock:
+            self.flushing -= 1
+            self.generation += 1
+            for entry in entries:
+                key = (entry[0], entry[1])
+                if self.unflushed.pop(key, None) is not None:
+                    self.seen[key] = True
+
+    def load(self, attempts: int = 3):
+        for _ in range(attempts):
+            with self.lock:
+                generation = self.generation
+            rows = self.db_pool.fetch(BALANCES)
+            with self.lock:
+                if self.flushing or self.generation != generation:
+                    continue
+                crossed = self.apply(rows)
+            log.info('tenant balances loaded', extra={'tenants': len(rows), 'armed': len(self.armed),
+                                                      'unflushed': len(self.unflushed)})
+            for tenant_id, balance in crossed:
+                self.crossed(tenant_id, balance)
+            return
+        log.warning('tenant balances not loaded, every attempt overlapped a dc flush', extra={'attempts': attempts})
+
+    def apply(self, rows: list[dict]) -> list[tuple]:
+        """
+        set the balances from BALANCES rows less the unflushed debits, caller
+        must hold self.lock. returns the (tenant_id, balance) that crossed.
+        """
+        unflushed = {}
+        for tenant_id, dc in self.unflushed.values():
+            unflushed[tenant_id] = unflushed.get(tenant_id, 0) + dc
+        known = set(self.balances)
+        self.balances = {row['tenant_id']: row['balance'] - unflushed.get(row['tenant_id'], 0) for row in rows}
+        crossed = []
+        for row in rows:
+            tenant_id = row['tenant_id']
+            balance = self.balances[tenant_id]
+            if row['is_disabled']:
+                self.armed.discard(tenant_id)
+            elif balance > self.threshold:
+                self.armed.add(tenant_id)
+            elif tenant_id in self.armed or tenant_id not in known:
+                # a tenant that already fired stays disarmed until it is topped up.
+                self.armed.discard(tenant_id)
+                crossed.append((tenant_id, balance))
+        return crossed
+
+    def balance(self, tenant_id: str):
+        return self.balances.get(tenant_id)
+
+    def debit(self, msg_id: str, kind: str, tenant_id: str, dc: int):
+        key = (msg_id, kind)
+        with self.lock:
+            balance = self.balances.get(tenant_id)
+            # tenants created since the last load have no helium_tenant row to charge yet.
+            if balance is None or key in self.unflushed or key in self.seen:
+                return
+            self.unflushed[key] = (tenant_id, dc)
+            balance -= dc
+            self.balances[tenant_id] = balance
+            if balance > self.threshold or tenant_id not in self.armed:
+                return
+            self.armed.discard(tenant_id)
+        self.crossed(tenant_id, balance)
+
+    def crossed(self, tenant_id: str, balance: int):
+        TENANT_CROSSINGS.labels().inc()
+        log.warning('tenant dc balance crossed threshold',
+                    extra={'tenant_id': tenant_id, 'balance': balance, 'threshold': self.threshold})
+        if self.on_crossing is not None:
+            self.on_crossing(tenant_id, balance)
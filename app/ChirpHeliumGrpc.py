@@ -0,0 +1,77 @@
+import ujson
+import grpc
+from google.protobuf.json_format import MessageToDict
+from chirpstack_api import api
+from ChirpHeliumMetrics import GRPC_SECONDS, GRPC_ERRORS, timed
+
+
+# retry calls that fail while the channel is reconnecting.
+SERVICE_CONFIG = ujson.dumps({
+    'methodConfig': [{
+        'name': [{'service': 'api.DeviceService'}],
+        'retryPolicy': {
+            'maxAttempts': 3,
+            'initialBackoff': '0.2s',
+            'maxBackoff': '2s',
+            'backoffMultiplier': 2,
+            'retryableStatusCodes': ['UNAVAILABLE'],
+        },
+    }]
+})
+
+
+class ChirpstackClient:
+    """
+    Long-lived gRPC channel to the chirpstack api, shared by every thread.
+
+    the channel keeps its HTTP/2 connection open with keepalive pings and
+    reconnects on its own, stubs are created once, and every call carries
+    a deadline of timeout seconds.
+    """
+    def __init__(
+            self,
+            chirpstack_host: str,
+            chirpstack_token: str,
+            timeout: float = 10.0,
+            keepalive_ms: int = 30000,
+    ):
+        self.cs_gprc = chirpstack_host
+        self.auth_token = [('authorization', f'Bearer {chirpstack_token}')]
+        self.timeout = timeout
+        self.channel = grpc.insecure_channel(
+            self.cs_gprc,
+            options=[
+                ('grpc.keepalive_time_ms', keepalive_ms),
+                ('grpc.keepalive_timeout_ms', 10000),
+                ('grpc.keepalive_permit_without_calls', 1),
+                ('grpc.http2.max_pings_without_data', 0),
+                ('grpc.initial_reconnect_backoff_ms', 1000),
+                ('grpc.max_reconnect_backoff_ms', 30000),
+                ('grpc.enable_retries', 1),
+                ('grpc.service_config', SERVICE_CONFIG),
+            ]
+        )
+        self.device_service = api.DeviceServiceStub(self.channel)
+
+    def get_device(self, dev_eui: str) -> dict:
+        req = api.GetDeviceRequest()
+        req.dev_eui = dev_eui
+        with timed(GRPC_SECONDS, GRPC_ERRORS, 'Get'):
+            resp = self.device_service.Get(req, metadata=self.auth_token, timeout=self.timeout)
+        return MessageToDict(resp)['device']
+
+    def get_device_activation(self, dev_eui: str) -> dict:
+        """
+        returns an empty dict for devices that have not been activated yet.
+        """
+        req = api.GetDeviceActivationRequest()
+        req.dev_eui = dev_eui
+        with timed(GRPC_SECONDS, GRPC_ERRORS, 'GetActivation'):
+            resp = self.device_service.GetActivation(req, metadata=self.auth_token, timeout=self.timeout)
+        data = MessageToDict(resp)
+        if bool(data):
+            return data['deviceActivation']
+        return data
+
+    def close(self):
+        self.channel.close()
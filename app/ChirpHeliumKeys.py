@@ -1,77 +1,132 @@
-import subprocess
+import logging
+import io
 import psycopg2
 import psycopg2.extras
-import ujson
-import grpc
-from google.protobuf.json_format import MessageToDict
-from chirpstack_api import api
+from ChirpHeliumPool import ChirpPostgresPool
+from ChirpHeliumGrpc import ChirpstackClient
+from ChirpHeliumRoute import ChirpRouteUpdater
+from ChirpHeliumCache import ChirpDeviceCache
+from ChirpHeliumCopy import copy_row
+
+
+log = logging.getLogger(__name__)
+
+
+def skfs_key(dev_addr, session_key, max_copies) -> tuple:
+    return str(dev_addr).lower(), str(session_key).lower(), int(max_copies or 0)
+
+
+# current session of devices about to be upserted, see ChirpDeviceKeys.upsert_sessions.
+SESSIONS = """
+    SELECT dev_eui, dev_addr, nws_key, max_copies, is_disabled
+    FROM helium_devices
+    WHERE dev_eui = ANY(%s);
+"""
+
+
+def session_changes(rows: list[tuple], current: dict[str, dict], disabled=()) -> dict[str, tuple]:
+    """
+    dev_eui -> (old, new) skfs keys for merge_keys rows whose route entry has
+    to move, None standing for no entry. current holds the SESSIONS rows,
+    devices in disabled (chirpstack) or disabled in helium_devices (tenant)
+    have no entry.
+    """
+    changes = {}
+    for row in rows:
+        device = current.get(row[0])
+        held = bool(device and device['is_disabled'])
+        old = None
+        if device and device['dev_addr'] and device['nws_key'] and not held:
+            old = skfs_key(device['dev_addr'], device['nws_key'], device['max_copies'])
+        new = None
+        if row[2] and row[5] and row[0] not in disabled and not held:
+            new = skfs_key(row[2], row[5], row[3])
+        if old != new:
+            changes[row[0]] = (old, new)
+    return changes
+
+
+def plan_skfs(skfs_list: list[dict], helium_devices: list[dict]) -> dict[str, set]:
+    """
+    diff the route's skfs entries against helium_devices rows on
+    (dev_addr, session_key, max_copies) in linear time.
+
+    returns sets of keys to add, remove and leave unchanged, a changed
+    max_copies shows up as a remove of the old entry plus an add.
+    """
+    current = {skfs_key(x['devaddr'], x['session_key'], x['max_copies']) for x in skfs_list}
+    # devices without a session yet have nothing to route.
+    desired = {skfs_key(x['dev_addr'], x['nws_key'], x['max_copies'])
+               for x in helium_devices if x['dev_addr'] and x['nws_key']}
+    return {
+        'add': desired - current,
+        'remove': current - desired,
+        'unchanged': current & desired,
+    }
 
 
 class ChirpDeviceKeys:
     def __init__(
             self,
             route_id: str,
-            postgres_host: str,
-            postgres_user: str,
-            postgres_pass: str,
-            postgres_name: str,
-            chirpstack_host: str,
-            chirpstack_token: str,
+            db_pool: ChirpPostgresPool,
+            chirpstack_client: ChirpstackClient,
+            route_updater: ChirpRouteUpdater,
+            skfs_dry_run: bool = False,
+            device_cache: ChirpDeviceCache = None,
     ):
         self.route_id = route_id
-        self.pg_host = postgres_host
-        self.pg_user = postgres_user
-        self.pg_pass = postgres_pass
-        self.pg_name = postgres_name
-        self.postges = f'postgresql://{self.pg_user}:{self.pg_pass}@{self.pg_host}/{self.pg_name}'
-        self.cs_gprc = chirpstack_host
-        self.auth_token = [('authorization', f'Bearer {chirpstack_token}')]
-
-    def config_service_cli(self, cmd: str):
-        p = subprocess.Popen([cmd], shell=True, stdout=subprocess.PIPE)
-        out, err = p.communicate()
-        if err:
-            return err
-        return out
+        self.db_pool = db_pool
+        self.cs_client = chirpstack_client
+        self.route = route_updater
+        self.skfs_dry_run = skfs_dry_run
+        self.devices = device_cache
 
     def db_fetch(self, query: str):
-        with psycopg2.connect(self.postges) as con:
-            with con.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query)
-                return cur.fetchall()
+        return self.db_pool.fetch(query)
 
     def db_transaction(self, query: str):
-        with psycopg2.connect(self.postges) as con:
-            with con.cursor() as cur:
-                cur.execute(query)
+        self.db_pool.transaction(query)
 
     def fetch_all_devices(self) -> list[str]:
-        with psycopg2.connect(self.postges) as con:
-            with con.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute("SELECT dev_eui FROM device WHERE is_disabled=false;")
-                return [dev['dev_eui'].hex() for dev in cur.fetchall()]
+        devices = self.db_fetch("SELECT dev_eui FROM device WHERE is_disabled=false;")
+        return [dev['dev_eui'].hex() for dev in devices]
+
+    def fetch_changed_devices(self, since=None) -> list[dict]:
+        """
+        enabled devices changed after since, or all of them when since is None.
+        a device counts as changed when its device or device_keys row was updated,
+        it has no helium_devices row yet, or its session dev_addr moved (re-join).
+        """
+        query = """
+            SELECT d.dev_eui, GREATEST(d.updated_at, dk.updated_at) AS changed_at
+            FROM device d
+            LEFT JOIN device_keys dk ON dk.dev_eui = d.dev_eui
+            LEFT JOIN helium_devices hd ON hd.dev_eui = encode(d.dev_eui, 'hex')
+            WHERE d.is_disabled = false
+        """
+        params = None
+        if since is not None:
+            query += """
+                AND (d.updated_at > %(since)s
+                     OR dk.updated_at > %(since)s
+                     OR hd.dev_eui IS NULL
+                     OR COALESCE(encode(d.dev_addr, 'hex'), '') IS DISTINCT FROM COALESCE(hd.dev_addr, ''))
+            """
+            params = {'since': since}
+        devices = self.db_pool.fetch(query, params)
+        return [{'dev_eui': dev['dev_eui'].hex(), 'changed_at': dev['changed_at']} for dev in devices]
 
     def get_device(self, dev_eui: str) -> dict[str]:
-        with grpc.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui = dev_eui
-            resp = client.Get(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['device']
-        return data
+        return self.cs_client.get_device(dev_eui)
 
     def get_device_activation(self, dev_eui: str) -> dict[str]:
-        with grpc.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceActivationRequest()
-            req.dev_eui = dev_eui
-            resp = client.GetActivation(req, metadata=self.auth_token)
-            data = MessageToDict(resp)
-            if bool(data):
-                return data['deviceActivation']
-        return data
-
-    def get_merged_keys(self, dev_eui: str) -> dict[str]:
+        return self.cs_client.get_device_activation(dev_eui)
+
+    def merge_keys(self, device: dict, activation: dict) -> tuple:
+        """
+        build a helium_devices row from a chirpstack device and its activation.
+        """
         devices = {
             'devAddr': '',
             'appSKey': '',
@@ -79,8 +134,8 @@ class ChirpDeviceKeys:
             'name': '',
         }
 
-        devices.update(self.get_device(dev_eui))
-        devices.update(self.get_device_activation(dev_eui))
+        devices.update(device)
+        devices.update(activation)
 
         max_copies = 0
         if devices.get('variables') and 'max_copies' in devices.get('variables'):
@@ -92,78 +147,204 @@ class ChirpDeviceKeys:
         # frame counts not in device activation after a join before a frame is seen.
         # maybe this could be used to trigger a device session key update on hpr?
 
-        query = """
-            INSERT INTO helium_devices
-            (dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down)
-            VALUES ('{0}', '{1}', '{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}')
-            ON CONFLICT (dev_eui) DO UPDATE
-            SET join_eui = '{1}',
-                dev_addr = '{2}',
-                max_copies = '{3}',
-                aps_key = '{4}',
-                nws_key = '{5}',
-                dev_name = '{6}',
-                fcnt_up = '{7}',
-                fcnt_down = '{8}';
-        """.format(devices['devEui'],
-                   devices['joinEui'],
-                   devices['devAddr'],
-                   max_copies,
-                   devices['appSKey'],
-                   devices['nwkSEncKey'],
-                   devices['name'],
-                   devices['fCntUp'],
-                   devices['nFCntDown']
-                   )
-        self.db_transaction(query)
+        return (devices['devEui'],
+                devices['joinEui'],
+                devices['devAddr'],
+                int(max_copies),
+                devices['appSKey'],
+                devices['nwkSEncKey'],
+                devices['name'],
+                devices['fCntUp'],
+                devices['nFCntDown'])
+
+    def fill_cache(self, rows: list[tuple]):
+        """
+        load freshly upserted merge_keys rows into the device cache.
+        """
+        if self.devices is not None:
+            self.devices.fill([row[0] for row in rows])
+
+    def upsert_devices(self, rows: list[tuple]):
+        """
+        write merge_keys rows to helium_devices in one multi-row statement.
+        """
+        # a statement can only touch each dev_eui once.
+        rows = list({row[0]: row for row in rows}.values())
+        if not rows:
+            return
+        with self.db_pool.connection() as con:
+            with con.cursor() as cur:
+                psycopg2.extras.execute_values(
+                    cur,
+                    """
+                        INSERT INTO helium_devices
+                        (dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down)
+                        VALUES %s
+                        ON CONFLICT (dev_eui) DO UPDATE
+                        SET join_eui = EXCLUDED.join_eui,
+                            dev_addr = EXCLUDED.dev_addr,
+                            max_copies = EXCLUDED.max_copies,
+                            aps_key = EXCLUDED.aps_key,
+                            nws_key = EXCLUDED.nws_key,
+                            dev_name = EXCLUDED.dev_name,
+                            fcnt_up = EXCLUDED.fcnt_up,
+                            fcnt_down = EXCLUDED.fcnt_down;
+                    """,
+                    rows,
+                    page_size=len(rows)
+                )
+        self.fill_cache(rows)
+
+    def bulk_upsert_devices(self, rows: list[tuple]):
+        """
+        COPY merge_keys rows into a temp table and upsert them into helium_devices
+        with a single statement, for loads too large for a VALUES list.
+        """
+        rows = list({row[0]: row for row in rows}.values())
+        if not rows:
+            return
+        buf = io.StringIO()
+        for row in rows:
+            buf.write(copy_row(row))
+        buf.seek(0)
+        columns = 'dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down'
+        with self.db_pool.connection() as con:
+            with con.cursor() as cur:
+                cur.execute("""
+                    CREATE TEMP TABLE helium_devices_load
+                    (LIKE helium_devices INCLUDING DEFAULTS) ON COMMIT DROP;
+                """)
+                cur.copy_expert(f'COPY helium_devices_load ({columns}) FROM STDIN', buf)
+                cur.execute(f"""
+                    INSERT INTO helium_devices ({columns})
+                    SELECT {columns} FROM helium_devices_load
+                    ON CONFLICT (dev_eui) DO UPDATE
+                    SET join_eui = EXCLUDED.join_eui,
+                        dev_addr = EXCLUDED.dev_addr,
+                        max_copies = EXCLUDED.max_copies,
+                        aps_key = EXCLUDED.aps_key,
+                        nws_key = EXCLUDED.nws_key,
+                        dev_name = EXCLUDED.dev_name,
+                        fcnt_up = EXCLUDED.fcnt_up,
+                        fcnt_down = EXCLUDED.fcnt_down;
+                """)
+        self.fill_cache(rows)
+
+    def apply_sessions(self, changes: dict[str, tuple]) -> dict:
+        """
+        swap the skfs entries of session_changes in one route batch.
+        """
+        self.route.remove_skfs([old for old, _ in changes.values() if old is not None])
+        self.route.add_skfs([new for _, new in changes.values() if new is not None])
+        return self.route.apply()
+
+    def upsert_sessions(self, rows: list[tuple], bulk: bool = False, disabled=()) -> dict:
+        """
+        upsert merge_keys rows and move the skfs entries of devices whose session
+        changed. the route goes first, if any of its calls fail the changed rows
+        are not upserted, so the next sync pass or refresh sees the change again
+        instead of a helium_devices row that matches a route it never reached.
+        returns {'changed': n, 'failed': n}.
+        """
+        rows = list({row[0]: row for row in rows}.values())
+        if not rows:
+            return {'changed': 0, 'failed': 0}
+        current = {device['dev_eui']: device for device in self.db_pool.fetch(SESSIONS, ([row[0] for row in rows],))}
+        changes = session_changes(rows, current, disabled)
+        failed = 0
+        if changes:
+            if self.apply_sessions(changes)['failed']:
+                failed = len(changes)
+                rows = [row for row in rows if row[0] not in changes]
+                log.warning('session route update failed, keeping the old sessions',
+                            extra={'devices': failed})
+        (self.bulk_upsert_devices if bulk else self.upsert_devices)(rows)
+        return {'changed': len(changes), 'failed': failed}
+
+    def get_merged_keys(self, dev_eui: str) -> str:
+        row = self.merge_keys(self.get_device(dev_eui), self.get_device_activation(dev_eui))
+        self.upsert_devices([row])
         return f'Updated: {dev_eui}'
 
-    def helium_skfs_update(self):
+    def refresh_device_session(self, dev_eui: str) -> str:
         """
-        TODO:
-            run function on a device join success, or on a device update.
+        re-read one device's session from chirpstack and swap its skfs entry on the
+        route if the dev_addr, session key or max_copies changed (join or update),
+        raises when the route update fails, so the refresh can be retried.
         """
+        device = self.get_device(dev_eui)
+        row = self.merge_keys(device, self.get_device_activation(dev_eui))
+        # disabled devices have no entry, neither do devices of a disabled tenant (see session_changes).
+        stats = self.upsert_sessions([row], disabled={dev_eui} if device.get('isDisabled') else ())
+        if stats['failed']:
+            raise RuntimeError(f'route update failed for {dev_eui}')
+        if not stats['changed']:
+            return f'Session current: {dev_eui}'
+        return f'Session refreshed: {dev_eui}'
+
+    def disable_tenant(self, tenant_id: str) -> dict:
+        """
+        mark a tenant and its devices disabled and take the devices' euis and
+        skfs off the route in one batch, e.g. once its dc balance ran out.
+        """
+        query = """
+            WITH tenant AS (
+                UPDATE helium_tenant SET is_disabled = true WHERE tenant_id = %(tenant_id)s
+            )
+            UPDATE helium_devices hd SET is_disabled = true
+            FROM device d
+            JOIN application a ON a.id = d.application_id
+            WHERE a.tenant_id = %(tenant_id)s
+              AND hd.dev_eui = encode(d.dev_eui, 'hex')
+              AND hd.is_disabled = false
+            RETURNING hd.dev_eui, hd.join_eui, hd.dev_addr, hd.nws_key, hd.max_copies;
+        """
+        rows = self.db_pool.fetch(query, {'tenant_id': tenant_id})
+        pairs = [(row['dev_eui'], row['join_eui']) for row in rows if row['join_eui']]
+        entries = [skfs_key(row['dev_addr'], row['nws_key'], row['max_copies'])
+                   for row in rows if row['dev_addr'] and row['nws_key']]
+        self.route.remove_euis(pairs)
+        self.route.remove_skfs(entries)
+        stats = self.route.apply()
+        if self.devices is not None:
+            for row in rows:
+                self.devices.invalidate(row['dev_eui'])
+        log.warning('tenant disabled', extra={'tenant_id': tenant_id, 'devices': len(rows), **stats})
+        return stats
+
+    def helium_skfs_update(self, dry_run: bool = None) -> dict:
+        """
+        reconcile the route's skfs with helium_devices.
+        with dry_run the plan is printed and hpr is not called.
+        joins and device updates are handled as they happen by
+        refresh_device_session and the device sync (upsert_sessions),
+        this full pass is the safety net.
+        """
+        if dry_run is None:
+            dry_run = self.skfs_dry_run
+
         helium_devices = """
             SELECT dev_addr, nws_key, max_copies FROM helium_devices WHERE is_disabled=false;
         """
         all_helium_devices = self.db_fetch(helium_devices)
 
-        cmd = f'hpr route skfs list --route-id {self.route_id}'
-        skfs_list = ujson.loads(self.config_service_cli(cmd))
-
-        for device in skfs_list:
-            dev_addr = device['devaddr']
-            nws_key = device['session_key']
-            max_copies = device['max_copies']
-            # print(dev_addr, nws_key, max_copies)
-            if any(x['dev_addr'] == dev_addr and
-                   x['nws_key'] == nws_key and
-                   x['max_copies'] == max_copies
-                   for x in all_helium_devices
-                   ):
-                print(f'DEVICE CURRENT -> d {dev_addr} -> s {nws_key} -> m {max_copies} Skipping...')
-                continue
-            else:
-                remove_skfs = f'hpr route skfs remove -r {self.route_id} -d {dev_addr} -s {nws_key} -c'
-                print(f'DEVICE STALE REMOVING -> d {dev_addr} -> s {nws_key} -> m {max_copies}')
-                self.config_service_cli(remove_skfs)
-
-        for devices in all_helium_devices:
-            dev_addr = devices['dev_addr']
-            nws_key = devices['nws_key']
-            max_copies = devices['max_copies']
-            # print(dev_addr, nws_key, max_copies)
-            if any(x['devaddr'] == dev_addr and
-                   x['session_key'] == nws_key and
-                   x['max_copies'] == max_copies
-                   for x in skfs_list
-                   ):
-                print(f'DEVICE CURRENT -> d {dev_addr} -> s {nws_key} -> m {max_copies} Skipping...')
-                continue
-
-            remove_skfs = f'hpr route skfs remove -r {self.route_id} -d {dev_addr} -s {nws_key} -c'
-            print(f'DEVICE NOT FOUND -> {remove_skfs}')
-            self.config_service_cli(remove_skfs)
-            add_skfs = f'hpr route skfs add -r {self.route_id} -d {dev_addr} -s {nws_key} -m {max_copies} -c'
-            print(f'ADDING DEVICE -> {add_skfs}')
-            self.config_service_cli(add_skfs)
+        skfs_list = self.route.list_skfs()
+
+        plan = plan_skfs(skfs_list, all_helium_devices)
+        stats = {key: len(value) for key, value in plan.items()}
+        log.info('skfs plan', extra={'dry_run': dry_run, **stats})
+
+        # a dry run is for reading the plan, otherwise entries are only logged at DEBUG.
+        level = logging.INFO if dry_run else logging.DEBUG
+        if log.isEnabledFor(level):
+            for action in ('remove', 'add'):
+                for dev_addr, nws_key, max_copies in sorted(plan[action]):
+                    log.log(level, f'skfs {action}', extra={'dev_addr': dev_addr, 'session_key': nws_key,
+                                                            'max_copies': max_copies})
+        if dry_run:
+            return stats
+
+        self.route.remove_skfs(sorted(plan['remove']))
+        self.route.add_skfs(sorted(plan['add']))
+        stats.update(self.route.apply())
+        return stats
@@ -0,0 +1,96 @@
+import time
+import logging
+import functools
+import inspect
+import redis
+from ChirpHeliumMetrics import LEADER
+
+
+log = logging.getLogger(__name__)
+
+# only the holder may extend or drop the lease.
+RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class ChirpLeaderLock:
+    """
+    Redis lease electing one replica to run the singleton jobs and read the
+    singleton streams.
+
+    acquire() takes the lease with SET NX PX or renews it when this replica
+    already holds it, run() does so every ttl / 3 seconds. the local lease
+    is counted from before the round trip, so a replica that cannot renew
+    stops leading before redis lets another one take over.
+    """
+    def __init__(self, rdb, key: str, holder: str, ttl: float = 30.0):
+        self.rdb = rdb
+        self.key = key
+        self.holder = holder
+        self.ttl = ttl
+        self.expires = 0.0
+        self.renew_script = rdb.register_script(RENEW)
+        self.release_script = rdb.register_script(RELEASE)
+        self.gauge = LEADER.labels()
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.expires
+
+    def acquire(self) -> bool:
+        """
+        take or renew the lease, returns whether this replica leads.
+        """
+        start = time.monotonic()
+        ttl_ms = int(self.ttl * 1000)
+        try:
+            held = bool(self.rdb.set(self.key, self.holder, nx=True, px=ttl_ms) or
+                        self.renew_script(keys=[self.key], args=[self.holder, ttl_ms]))
+        except redis.RedisError as err:
+            log.warning('leader lease check failed', extra={'key': self.key, 'error': str(err)})
+            held = False
+        if held != self.is_leader:
+            log.info('leadership acquired' if held else 'leadership lost',
+                     extra={'key': self.key, 'holder': self.holder})
+        self.expires = start + self.ttl if held else 0.0
+        self.gauge.set(1 if held else 0)
+        return held
+
+    def release(self):
+        self.expires = 0.0
+        self.gauge.set(0)
+        try:
+            self.release_script(keys=[self.key], args=[self.holder])
+        except redis.RedisError as err:
+            log.warning('leader lease release failed', extra={'key': self.key, 'error': str(err)})
+
+    def run(self):
+        while True:
+            self.acquire()
+            time.sleep(self.ttl / 3)
+
+    def only(self, fn):
+        """
+        wrap a job (function or coroutine function) so it is skipped unless this replica leads.
+        """
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def leader_job(*args, **kwargs):
+                if self.is_leader:
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def leader_job(*args, **kwargs):
+                if self.is_leader:
+                    return fn(*args, **kwargs)
+        return leader_job
@@ -0,0 +1,169 @@
+import sys
+import copy
+import time
+import queue
+import random
+import logging
+import threading
+import logging.handlers
+import ujson
+
+
+log = logging.getLogger(__name__)
+
+# attributes every LogRecord has, anything else came in through extra=.
+RECORD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime'}
+
+
+def record_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in record.__dict__.items() if key not in RECORD_ATTRS}
+
+
+class ChirpJsonFormatter(logging.Formatter):
+    """
+    one compact json object per line, extra= fields are kept as keys.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        line.update(record_fields(record))
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line['exc'] = record.exc_text
+        return ujson.dumps(line, default=str, escape_forward_slashes=False)
+
+
+class ChirpTextFormatter(logging.Formatter):
+    """
+    plain text lines for a terminal, extra= fields appended as key=value.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        line = f'{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}'
+        fields = record_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class ChirpQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that keeps tracebacks in exc_text instead of folding them
+    into the message, so the json formatter can write them as their own key.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class ChirpLogSampler:
+    """
+    Per event type sampling and rate limits for hot path log lines.
+
+    sample maps an event type to the fraction of its lines kept, rate_limits
+    to the max lines per second, '*' applies to every event type without
+    its own entry. callers check allow(event) before building the line, so
+    dropped lines cost no formatting.
+    """
+    def __init__(self, sample: dict = None, rate_limits: dict = None):
+        self.lock = threading.Lock()
+        self.configure(sample, rate_limits)
+
+    def configure(self, sample: dict = None, rate_limits: dict = None):
+        with self.lock:
+            self.sample = sample or {}
+            self.rate_limits = rate_limits or {}
+            # event -> (tokens, updated)
+            self.buckets = {}
+            self.suppressed = {}
+
+    def allow(self, event: str) -> bool:
+        fraction = self.sample.get(event, self.sample.get('*', 1.0))
+        if fraction < 1.0 and random.random() >= fraction:
+            return False
+        rate = self.rate_limits.get(event, self.rate_limits.get('*'))
+        if not rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(event, (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self.buckets[event] = (tokens, now)
+                self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                return False
+            self.buckets[event] = (tokens - 1, now)
+            return True
+
+    def take_suppressed(self) -> dict:
+        with self.lock:
+            suppressed, self.suppressed = self.suppressed, {}
+        return suppressed
+
+
+sampler = ChirpLogSampler()
+
+
+def sampled(logger: logging.Logger, event: str, level: int = logging.INFO) -> bool:
+    """
+    true when logger would emit level and event is within its sample and rate limit.
+    """
+    return logger.isEnabledFor(level) and sampler.allow(event)
+
+
+def parse_event_rates(value: str) -> dict:
+    """
+    'up=0.1,join=1' -> {'up': 0.1, 'join': 1.0}
+    """
+    rates = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        event, rate = item.split('=', 1)
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(
+        level: str = 'INFO',
+        fmt: str = 'json',
+        sample: dict = None,
+        rate_limits: dict = None,
+) -> logging.handlers.QueueListener:
+    """
+    route every logger through a queue, stdout writes happen on the listener
+    thread so the stream threads never block on io. returns the listener,
+    stop() it on shutdown to drain the queue.
+    """
+    sampler.configure(sample, rate_limits)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(ChirpJsonFormatter() if fmt == 'json' else ChirpTextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(ChirpQueueHandler(log_queue))
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    listener.start()
+    return listener
+
+
+def report_suppressed():
+    suppressed = sampler.take_suppressed()
+    if suppressed:
+        log.info('log lines suppressed by rate limits', extra={'suppressed': suppressed})
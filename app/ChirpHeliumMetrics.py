@@ -0,0 +1,258 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from aiohttp import web
+
+
+log = logging.getLogger(__name__)
+
+# every metric created below, in render order.
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class ChirpMetric:
+    """
+    Minimal prometheus metric with labels, children are created on first use
+    and cached, so hot paths can hold on to labels(...) results.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.children = {}
+        REGISTRY.append(self)
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines += self.samples()
+        return '\n'.join(lines)
+
+
+class ChirpValue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class ChirpCounter(ChirpMetric):
+    kind = 'counter'
+
+    def new_child(self):
+        return ChirpValue()
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{format_labels(self.label_names, values)} {format_value(child.value)}'
+                for values, child in list(self.children.items())]
+
+
+class ChirpGauge(ChirpCounter):
+    kind = 'gauge'
+
+
+class ChirpHistogramValue:
+    def __init__(self, buckets: tuple):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class ChirpHistogram(ChirpMetric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        super().__init__(name, description, labels)
+
+    def new_child(self):
+        return ChirpHistogramValue(self.buckets)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for values, child in list(self.children.items()):
+            with child.lock:
+                counts, count, total = list(child.counts), child.count, child.sum
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = format_labels(self.label_names, values, f'le="{format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = format_labels(self.label_names, values)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+STREAM_MESSAGES = ChirpCounter(
+    'chirpstack_hpr_stream_messages_total', 'stream messages dispatched per event type', ('stream', 'event'))
+STREAM_LAG_MESSAGES = ChirpGauge(
+    'chirpstack_hpr_stream_lag_messages', 'entries added to the stream not yet delivered to the group', ('stream',))
+STREAM_LAG_SECONDS = ChirpGauge(
+    'chirpstack_hpr_stream_lag_seconds', 'stream tip id time minus last processed id time', ('stream',))
+HANDLER_SECONDS = ChirpHistogram(
+    'chirpstack_hpr_handler_seconds', 'stream handler latency', ('handler',),
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+HANDLER_ERRORS = ChirpCounter('chirpstack_hpr_handler_errors_total', 'stream handler exceptions', ('handler',))
+STREAM_CLAIMED = ChirpCounter(
+    'chirpstack_hpr_stream_claimed_total', 'entries taken over from idle consumers', ('stream',))
+LEADER = ChirpGauge('chirpstack_hpr_leader', '1 while this replica holds the leader lease')
+QUEUE_DEPTH = ChirpGauge(
+    'chirpstack_hpr_queue_depth', 'stream entries waiting for a worker, spilled ones included', ('stream', 'worker'))
+QUEUE_SPILLED = ChirpCounter('chirpstack_hpr_queue_spilled_total', 'stream entries spilled to redis', ('stream',))
+POSTGRES_SECONDS = ChirpHistogram(
+    'chirpstack_hpr_postgres_seconds', 'postgres unit of work duration, checkout to commit', ('client',))
+POSTGRES_ERRORS = ChirpCounter('chirpstack_hpr_postgres_errors_total', 'postgres units of work rolled back', ('client',))
+POOL_SIZE = ChirpGauge('chirpstack_hpr_postgres_pool_size', 'psycopg2 pool max connections')
+POOL_IN_USE = ChirpGauge('chirpstack_hpr_postgres_pool_in_use', 'psycopg2 pool connections checked out')
+POOL_CHECKOUTS = ChirpCounter('chirpstack_hpr_postgres_pool_checkouts_total', 'psycopg2 pool checkouts')
+POOL_WAITS = ChirpCounter('chirpstack_hpr_postgres_pool_waits_total', 'psycopg2 pool checkouts that waited for a slot')
+POOL_WAIT_SECONDS = ChirpCounter(
+    'chirpstack_hpr_postgres_pool_wait_seconds_total', 'time psycopg2 pool checkouts waited for a slot')
+POOL_REPLACED = ChirpCounter('chirpstack_hpr_postgres_pool_replaced_total', 'broken psycopg2 pool connections replaced')
+GRPC_SECONDS = ChirpHistogram('chirpstack_hpr_grpc_seconds', 'chirpstack grpc call duration', ('method',))
+GRPC_ERRORS = ChirpCounter('chirpstack_hpr_grpc_errors_total', 'chirpstack grpc call failures', ('method',))
+ROUTE_SECONDS = ChirpHistogram(
+    'chirpstack_hpr_route_call_seconds', 'hpr process or config service call duration', ('backend', 'command'))
+ROUTE_ERRORS = ChirpCounter(
+    'chirpstack_hpr_route_call_errors_total', 'hpr process or config service call failures', ('backend', 'command'))
+JOB_SECONDS = ChirpHistogram(
+    'chirpstack_hpr_job_seconds', 'periodic job duration', ('job',),
+    buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0))
+JOB_INTERVAL = ChirpGauge('chirpstack_hpr_job_interval_seconds', 'periodic job interval', ('job',))
+JOB_ERRORS = ChirpCounter('chirpstack_hpr_job_errors_total', 'periodic job failures', ('job',))
+DC_FLUSHED = ChirpCounter('chirpstack_hpr_dc_flushed_total', 'dc debits written to postgres', ('kind',))
+DC_FLUSHES = ChirpCounter('chirpstack_hpr_dc_flushes_total', 'dc flushes written to postgres')
+DC_DUPLICATES = ChirpCounter('chirpstack_hpr_dc_duplicates_total', 'dc debits already in the ledger, not charged again')
+DEVICE_CACHE = ChirpCounter('chirpstack_hpr_device_cache_total', 'device cache lookups', ('result',))
+TENANT_CROSSINGS = ChirpCounter(
+    'chirpstack_hpr_tenant_threshold_crossings_total', 'tenants whose dc balance crossed the disable threshold')
+API_EVENTS = ChirpCounter(
+    'chirpstack_hpr_api_device_events_total', 'api device events buffered for coalescing', ('method',))
+API_CHANGES = ChirpCounter(
+    'chirpstack_hpr_api_device_changes_total', 'net device changes applied after coalescing', ('action',))
+
+
+@contextmanager
+def timed(histogram: ChirpHistogram, errors: ChirpCounter, *labels):
+    """
+    observe the block's duration, counting it in errors when it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        errors.labels(*labels).inc()
+        raise
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - start)
+
+
+def stream_id_seconds(stream_id) -> float:
+    if isinstance(stream_id, bytes):
+        stream_id = stream_id.decode()
+    return int(str(stream_id).split('-', 1)[0]) / 1000
+
+
+def record_dc_flush(entries: list[tuple], duplicates: int):
+    """
+    entries are ledger rows (msg_id, kind, tenant_id, dev_eui, dc), see LEDGER_INSERT for which are
+    charged to the tenant and which count as device usage.
+    """
+    DC_FLUSHES.labels().inc()
+    DC_FLUSHED.labels('tenant').inc(sum(entry[4] for entry in entries
+                                        if entry[2] is not None and entry[1] != 'meta_up'))
+    DC_FLUSHED.labels('device').inc(sum(entry[4] for entry in entries if entry[1].startswith('meta_')))
+    DC_DUPLICATES.labels().inc(duplicates)
+
+
+class ChirpMetricsServer:
+    """
+    Serves /metrics in the prometheus text format with aiohttp.
+    start() runs on an existing event loop, run() on a thread of its own.
+    """
+    def __init__(self, host: str = '0.0.0.0', port: int = 9102):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info('metrics endpoint listening', extra={'host': self.host, 'port': self.port})
+
+    async def serve(self):
+        await self.start()
+        await asyncio.Event().wait()
+
+    def run(self):
+        asyncio.run(self.serve())
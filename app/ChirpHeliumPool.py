@@ -0,0 +1,127 @@
+import time
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from ChirpHeliumMetrics import POSTGRES_SECONDS, POSTGRES_ERRORS, POOL_SIZE, POOL_IN_USE, POOL_CHECKOUTS, POOL_WAITS, \
+    POOL_WAIT_SECONDS, POOL_REPLACED
+
+
+class ChirpPostgresPool:
+    """
+    Thread-safe postgres connection pool shared by every component.
+
+    checkouts block once max_size connections are in use instead of raising,
+    connections idle for longer than check_interval seconds are tested with a
+    SELECT 1 before being handed out, and broken ones are replaced.
+    """
+    def __init__(
+            self,
+            postgres_host: str,
+            postgres_user: str,
+            postgres_pass: str,
+            postgres_name: str,
+            min_size: int = 1,
+            max_size: int = 10,
+            check_interval: float = 30.0,
+    ):
+        self.pg_host = postgres_host
+        self.pg_user = postgres_user
+        self.pg_pass = postgres_pass
+        self.pg_name = postgres_name
+        self.postges = f'postgresql://{self.pg_user}:{self.pg_pass}@{self.pg_host}/{self.pg_name}'
+        self.min_size = min_size
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size, self.postges)
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.last_used = {}
+        POOL_SIZE.labels().set(max_size)
+        self.in_use = POOL_IN_USE.labels()
+        self.checkouts = POOL_CHECKOUTS.labels()
+        self.waits = POOL_WAITS.labels()
+        self.wait_time = POOL_WAIT_SECONDS.labels()
+        self.replaced = POOL_REPLACED.labels()
+
+    def healthy(self, con) -> bool:
+        if con.closed:
+            return False
+        if con.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            con.rollback()
+        if time.monotonic() - self.last_used.get(id(con), 0) < self.check_interval:
+            return True
+        try:
+            with con.cursor() as cur:
+                cur.execute('SELECT 1;')
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        while True:
+            con = self.pool.getconn()
+            try:
+                if self.healthy(con):
+                    return con
+            except psycopg2.Error:
+                pass
+            self.pool.putconn(con, close=True)
+            self.replaced.inc()
+
+    def putconn(self, con):
+        if con.closed:
+            self.pool.putconn(con, close=True)
+            return
+        self.last_used[id(con)] = time.monotonic()
+        self.pool.putconn(con)
+
+    @contextmanager
+    def connection(self):
+        """
+        check out a connection, commit on success and roll back on error.
+        """
+        start = time.monotonic()
+        waited = not self.slots.acquire(blocking=False)
+        if waited:
+            self.slots.acquire()
+        self.checkouts.inc()
+        self.in_use.inc()
+        if waited:
+            self.waits.inc()
+            self.wait_time.inc(time.monotonic() - start)
+        try:
+            con = self.getconn()
+        except Exception:
+            self.in_use.inc(-1)
+            self.slots.release()
+            raise
+        try:
+            yield con
+            con.commit()
+        except Exception:
+            POSTGRES_ERRORS.labels('psycopg2').inc()
+            if not con.closed:
+                con.rollback()
+            raise
+        finally:
+            self.putconn(con)
+            POSTGRES_SECONDS.labels('psycopg2').observe(time.monotonic() - start)
+            self.in_use.inc(-1)
+            self.slots.release()
+
+    def transaction(self, query: str, params=None):
+        with self.connection() as con:
+            with con.cursor() as cur:
+                cur.execute(query, params)
+
+    def fetch(self, query: str, params=None) -> list[dict]:
+        with self.connection() as con:
+            with con.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(query, params)
+                return cur.fetchall()
+
+    def close(self):
+        self.pool.closeall()
@@ -0,0 +1,359 @@
+import logging
+import time
+import redis
+from google.protobuf.message import DecodeError
+from ChirpHeliumMetrics import STREAM_MESSAGES, STREAM_LAG_MESSAGES, STREAM_LAG_SECONDS, STREAM_CLAIMED, \
+    HANDLER_SECONDS, HANDLER_ERRORS, stream_id_seconds
+
+
+log = logging.getLogger(__name__)
+
+
+class ChirpStreamDispatcher:
+    """
+    Batched consumer group reader for every registered chirpstack redis stream.
+
+    Each call to read() costs one XREADGROUP round trip across all streams
+    and returns up to batch_size messages per stream, waiting at most
+    block_ms once every stream has been drained. Each message field is
+    looked up in the registry, parsed into its protobuf type and passed to
+    the handlers registered for it. Messages are acknowledged after their
+    handlers return, so the group's last delivered ID is the checkpoint a
+    restart resumes from.
+
+    start policy:
+        checkpoint - resume from the group's checkpoint, new groups start at '$'
+        $          - skip anything added while the reader was down
+        <id>       - reposition the group at an explicit stream ID (e.g. '0')
+
+    replicas share the load by reading the same group under their own
+    consumer names. entries another consumer left pending for longer than
+    claim_idle_ms (a replica that died) are claimed every claim_interval
+    seconds. a live consumer resets the idle time of the entries it still
+    owns (queued, held by an ack gate) every claim_idle_ms / 3, so they are
+    never claimed from it. singleton streams are only read while leader
+    holds the lease.
+    """
+    def __init__(
+            self,
+            rdb,
+            group: str,
+            consumer: str,
+            start: str = 'checkpoint',
+            batch_size: int = 100,
+            block_ms: int = 1000,
+            max_retries: int = 3,
+            lag_interval: float = 15.0,
+            leader=None,
+            claim_idle_ms: int = 60000,
+            claim_interval: float = 30.0,
+    ):
+        self.rdb = rdb
+        self.group = group
+        self.consumer = consumer
+        self.start = start
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.max_retries = max_retries
+        self.lag_interval = lag_interval
+        self.lag_checked = 0.0
+        self.leader = leader
+        self.claim_idle_ms = claim_idle_ms
+        self.claim_interval = claim_interval
+        self.claim_checked = 0.0
+        self.touch_checked = time.monotonic()
+        # stream_key -> {field: (message type, [handlers])}
+        self.registry = {}
+        # metric children looked up once at register time, kept off the hot path.
+        self.counters = {}
+        self.timers = {}
+        # (stream_key, field) -> key(message), see register.
+        self.keys = {}
+        # stream_key -> ID of the last acknowledged message, for the lag gauges.
+        self.last_ids = {}
+        # streams whose handlers block on io, see ChirpAsyncStreamDispatcher.
+        self.blocking = set()
+        # streams only the leader reads.
+        self.singletons = set()
+        # stream_key -> holder acknowledging its entries later, see defer_acks.
+        self.ack_gates = {}
+        self.after_batch = []
+        # stream_key -> ID to re-read this consumer's pending list from, False once it is drained.
+        self.pending = {}
+
+    def register(self, stream_key: str, field: str, message_type, handler, blocking: bool = False, key=None,
+                 singleton: bool = False):
+        """
+        call handler(message, msg_id) for every stream_key entry carrying field,
+        field values are parsed into message_type first, msg_id is the entry's stream ID.
+        key(message) names what the entry belongs to (e.g. its dev_eui), entries
+        with the same key are handled in order when they go through worker queues.
+        singleton streams are read by the leader only, for handlers that need
+        the whole stream in order.
+        """
+        fields = self.registry.setdefault(stream_key, {})
+        name = field.encode()
+        if name in fields and fields[name][0] is not message_type:
+            raise ValueError(f'{stream_key} {field} is already registered as {fields[name][0].__name__}')
+        fields.setdefault(name, (message_type, []))[1].append(handler)
+        self.counters[(stream_key, name)] = STREAM_MESSAGES.labels(stream_key, field)
+        self.timers[handler] = HANDLER_SECONDS.labels(handler.__qualname__)
+        if key is not None:
+            self.keys[(stream_key, name)] = key
+        self.pending[stream_key] = '0'
+        if blocking:
+            self.blocking.add(stream_key)
+        if singleton:
+            self.singletons.add(stream_key)
+
+    def on_batch(self, callback):
+        """
+        call callback() after every dispatched read, e.g. to flush accumulated writes.
+        """
+        self.after_batch.append(callback)
+
+    def defer_acks(self, stream_key: str, holder):
+        """
+        hand stream_key's handled entries to holder.hold(stream_key, msg_ids)
+        instead of acknowledging them, holder passes them back to release()
+        once their side effects are stored (e.g. dc debits in the ledger).
+        """
+        self.ack_gates[stream_key] = holder
+        holder.on_flushed = self.release
+
+    def release(self, acks: dict):
+        for stream_key, msg_ids in acks.items():
+            self.rdb.xack(stream_key, self.group, *msg_ids)
+
+    def readable(self, stream_key: str) -> bool:
+        return stream_key not in self.singletons or self.leader is None or self.leader.is_leader
+
+    def stream_ids(self) -> dict:
+        return {key: self.pending[key] or '>' for key in self.registry if self.readable(key)}
+
+    def create_groups(self):
+        start_id = '$' if self.start == 'checkpoint' else self.start
+        for stream_key in self.registry:
+            try:
+                self.rdb.xgroup_create(stream_key, self.group, id=start_id, mkstream=True)
+                log.info('created consumer group', extra={'group': self.group, 'stream': stream_key, 'id': start_id})
+            except redis.ResponseError as err:
+                if 'BUSYGROUP' not in str(err):
+                    raise
+                if self.start != 'checkpoint':
+                    self.rdb.xgroup_setid(stream_key, self.group, id=start_id)
+                    log.info('moved consumer group', extra={'group': self.group, 'stream': stream_key, 'id': start_id})
+
+    def batches(self, resp) -> list[tuple[str, list]]:
+        """
+        (stream_key, messages) pairs from an XREADGROUP reply. re-reads page
+        through the pending list from the last ID they returned, a stream is
+        back on '>' once a re-read comes back empty.
+        """
+        batches = []
+        for stream_key, messages in resp or []:
+            if isinstance(stream_key, bytes):
+                stream_key = stream_key.decode()
+            if self.pending[stream_key]:
+                self.pending[stream_key] = messages[-1][0] if messages else False
+            if messages:
+                batches.append((stream_key, messages))
+        return batches
+
+    def read(self) -> list[tuple[str, list]]:
+        stream_ids = self.stream_ids()
+        if not stream_ids:
+            time.sleep(min(self.block_ms, 100) / 1000)
+            return []
+        resp = self.rdb.xreadgroup(
+            self.group,
+            self.consumer,
+            stream_ids,
+            count=self.batch_size,
+            block=self.block_ms
+        )
+        return self.batches(resp)
+
+    def ack(self, stream_key: str, messages: list):
+        if messages:
+            msg_ids = [message[0] for message in messages]
+            if stream_key in self.ack_gates:
+                self.ack_gates[stream_key].hold(stream_key, msg_ids)
+            else:
+                self.rdb.xack(stream_key, self.group, *msg_ids)
+            self.last_ids[stream_key] = messages[-1][0]
+
+    def record_lag(self, stream_key: str, groups: list, stream: dict):
+        """
+        set the lag gauges from XINFO GROUPS and XINFO STREAM replies. lag in
+        entries needs redis 7, lag in seconds compares the ID timestamps of
+        the stream tip and the last message this reader acknowledged.
+        """
+        group = next((g for g in groups if g['name'] in (self.group, self.group.encode())), None)
+        if group is None:
+            return
+        if group.get('lag') is not None:
+            STREAM_LAG_MESSAGES.labels(stream_key).set(group['lag'])
+        last_id = self.last_ids.get(stream_key, group['last-delivered-id'])
+        tip = stream_id_seconds(stream['last-generated-id'])
+        STREAM_LAG_SECONDS.labels(stream_key).set(max(0.0, tip - stream_id_seconds(last_id)))
+
+    def lag_due(self) -> bool:
+        if time.monotonic() - self.lag_checked < self.lag_interval:
+            return False
+        self.lag_checked = time.monotonic()
+        return True
+
+    def update_lag(self):
+        for stream_key in self.registry:
+            try:
+                self.record_lag(stream_key, self.rdb.xinfo_groups(stream_key), self.rdb.xinfo_stream(stream_key))
+            except redis.RedisError as err:
+                log.warning('stream lag check failed', extra={'stream': stream_key, 'error': str(err)})
+
+    def claim_due(self) -> bool:
+        if time.monotonic() - self.claim_checked < self.claim_interval:
+            return False
+        self.claim_checked = time.monotonic()
+        return True
+
+    def claimed(self, stream_key: str, resp):
+        """
+        claimed entries are now in this consumer's pending list, the next read re-reads it.
+        """
+        if resp and resp[1]:
+            STREAM_CLAIMED.labels(stream_key).inc(len(resp[1]))
+            log.info('claimed idle entries', extra={'stream': stream_key, 'entries': len(resp[1])})
+            self.pending[stream_key] = '0'
+
+    def touch_due(self) -> bool:
+        if time.monotonic() - self.touch_checked < self.claim_idle_ms / 3000:
+            return False
+        self.touch_checked = time.monotonic()
+        return True
+
+    def owned(self) -> dict[str, list]:
+        """
+        stream_key -> IDs read by this consumer that stay unacknowledged past the batch.
+        """
+        return {stream_key: holder.held(stream_key) for stream_key, holder in self.ack_gates.items()}
+
+    def touch(self):
+        """
+        XCLAIM JUSTID the owned entries to this consumer again, which resets
+        their idle time without counting a delivery, so the other consumers'
+        XAUTOCLAIM leaves slow or held entries of a live consumer alone.
+        """
+        for stream_key, msg_ids in self.owned().items():
+            try:
+                for i in range(0, len(msg_ids), self.batch_size):
+                    self.rdb.xclaim(stream_key, self.group, self.consumer, 0, msg_ids[i:i + self.batch_size],
+                                    justid=True)
+            except redis.RedisError as err:
+                log.warning('stream touch failed', extra={'stream': stream_key, 'error': str(err)})
+
+    def claim(self):
+        """
+        take over entries left pending by other consumers (XAUTOCLAIM, redis 6.2+).
+        """
+        for stream_key in self.registry:
+            if not self.readable(stream_key):
+                continue
+            try:
+                self.claimed(stream_key, self.rdb.xautoclaim(stream_key, self.group, self.consumer, self.claim_idle_ms,
+                                                             count=self.batch_size, justid=True))
+            except redis.RedisError as err:
+                log.warning('stream claim failed', extra={'stream': stream_key, 'error': str(err)})
+
+    def parse(self, stream_key: str, message, count: bool = True) -> list[tuple]:
+        """
+        (field, parsed message) for every registered field of a stream entry.
+        """
+        fields = self.registry[stream_key]
+        parsed = []
+        for field, value in message[1].items():
+            entry = fields.get(field)
+            if entry is None:
+                continue
+            if count:
+                self.counters[(stream_key, field)].inc()
+            try:
+                parsed.append((field, entry[0].FromString(value)))
+            except DecodeError as err:
+                log.error('undecodable message', extra={'stream': stream_key, 'id': message[0].decode(),
+                                                        'field': field.decode(), 'error': str(err)})
+        return parsed
+
+    def handle(self, stream_key: str, msg_id: str, parsed: list[tuple]):
+        """
+        call the handlers of every parsed field, a failing handler is reported
+        and does not stop the others.
+        """
+        fields = self.registry[stream_key]
+        for field, pl in parsed:
+            for handler in fields[field][1]:
+                start = time.perf_counter()
+                try:
+                    handler(pl, msg_id)
+                except Exception:
+                    HANDLER_ERRORS.labels(handler.__qualname__).inc()
+                    log.exception('handler failed', extra={'handler': handler.__name__})
+                self.timers[handler].observe(time.perf_counter() - start)
+
+    def dispatch(self, stream_key: str, messages: list):
+        """
+        hand every registered field of every message to its handlers, in stream order.
+        """
+        for message in messages:
+            self.handle(stream_key, message[0].decode(), self.parse(stream_key, message))
+
+    def retry(self, batches: list, failures: int) -> int:
+        """
+        re-read the failed batches from the pending list, dropping them after max_retries.
+        returns the new failure count.
+        """
+        if batches and failures >= self.max_retries:
+            for stream_key, messages in batches:
+                log.error('dropping messages', extra={'stream': stream_key, 'messages': len(messages),
+                                                      'attempts': failures})
+                try:
+                    self.ack(stream_key, messages)
+                except redis.RedisError:
+                    self.pending[stream_key] = '0'
+            return 0
+        for stream_key in self.pending:
+            self.pending[stream_key] = '0'
+        return failures
+
+    def run(self):
+        """
+        read batches forever, dispatch and acknowledge them. the lag gauges
+        are refreshed every lag_interval seconds and idle entries claimed
+        every claim_interval seconds between batches.
+        """
+        self.create_groups()
+        failures = 0
+        while True:
+            batches = []
+            try:
+                batches = self.read()
+                for stream_key, messages in batches:
+                    self.dispatch(stream_key, messages)
+                    self.ack(stream_key, messages)
+                failures = 0
+            except Exception:
+                log.exception('stream read failed', extra={'group': self.group})
+                failures = self.retry(batches, failures + 1)
+                time.sleep(1)
+                continue
+            for callback in self.after_batch:
+                try:
+                    callback()
+                except Exception:
+                    log.exception('after batch callback failed', extra={'callback': callback.__name__})
+            if self.lag_due():
+                self.update_lag()
+            if self.touch_due():
+                self.touch()
+            if self.claim_due():
+                self.claim()
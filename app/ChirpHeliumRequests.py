@@ -1,12 +1,20 @@
 import os
-import subprocess
-import psycopg2
-import psycopg2.extras
-import time
+import logging
 import redis
-import grpc
-from google.protobuf.json_format import MessageToJson, MessageToDict
-from chirpstack_api import api, meta, integration
+from concurrent.futures import ThreadPoolExecutor
+from google.protobuf.json_format import MessageToDict
+from chirpstack_api import api
+from ChirpHeliumReader import ChirpStreamDispatcher
+from ChirpHeliumPool import ChirpPostgresPool
+from ChirpHeliumGrpc import ChirpstackClient
+from ChirpHeliumRoute import ChirpRouteUpdater
+from ChirpHeliumSync import ChirpSessionRefresher
+from ChirpHeliumCredits import ChirpBalanceIndex
+from ChirpHeliumCache import ChirpDeviceCache
+from ChirpHeliumCoalesce import ChirpDeviceCoalescer
+
+
+log = logging.getLogger(__name__)
 
 
 # -----------------------------------------------------------------------------
@@ -17,82 +25,96 @@ rpool = redis.ConnectionPool(host=redis_server, port=6379, db=0)
 rdb = redis.Redis(connection_pool=rpool, decode_responses=True)
 
 
+def api_key(pl) -> str:
+    """
+    device requests are ordered per dev_eui, tenant requests per tenant.
+    """
+    return pl.metadata.get('dev_eui') or pl.metadata.get('tenant_id')
+
+
+DEVICE_ROWS = """
+    SELECT dev_eui, join_eui, dev_addr, nws_key, max_copies
+    FROM helium_devices
+    WHERE dev_eui = ANY(%s);
+"""
+
+INSERT_DEVICES = """
+    INSERT INTO helium_devices (dev_eui, join_eui)
+    SELECT * FROM unnest(%s::text[], %s::text[])
+    ON CONFLICT (dev_eui) DO UPDATE SET join_eui = EXCLUDED.join_eui;
+"""
+
+SET_DISABLED = """
+    UPDATE helium_devices hd SET is_disabled = v.is_disabled
+    FROM unnest(%s::text[], %s::bool[]) AS v(dev_eui, is_disabled)
+    WHERE hd.dev_eui = v.dev_eui;
+"""
+
+
 class ChirpstackStreams:
     def __init__(
             self,
             route_id: str,
-            postgres_host: str,
-            postgres_user: str,
-            postgres_pass: str,
-            postgres_name: str,
-            chirpstack_host: str,
-            chirpstack_token: str,
+            db_pool: ChirpPostgresPool,
+            chirpstack_client: ChirpstackClient,
+            route_updater: ChirpRouteUpdater,
+            session_refresher: ChirpSessionRefresher = None,
+            balance_index: ChirpBalanceIndex = None,
+            device_cache: ChirpDeviceCache = None,
+            coalesce_window: float = 0,
+            coalesce_size: int = 5000,
+            lookup_concurrency: int = 8,
     ):
         self.route_id = route_id
-        self.pg_host = postgres_host
-        self.pg_user = postgres_user
-        self.pg_pass = postgres_pass
-        self.pg_name = postgres_name
-        self.postges = f'postgresql://{self.pg_user}:{self.pg_pass}@{self.pg_host}/{self.pg_name}'
-        self.cs_gprc = chirpstack_host
-        self.auth_token = [('authorization', f'Bearer {chirpstack_token}')]
-
-    def config_service_cli(self, cmd: str):
-        p = subprocess.Popen([cmd], shell=True, stdout=subprocess.PIPE)
-        out, err = p.communicate()
-        if err:
-            return err
-        print(out)
-        return out
+        self.db_pool = db_pool
+        self.cs_client = chirpstack_client
+        self.route = route_updater
+        self.session_refresher = session_refresher
+        self.balances = balance_index
+        self.devices = device_cache
+        self.lookup_concurrency = lookup_concurrency
+        # device api events are applied in batches of net changes, or one by one without a window.
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = ChirpDeviceCoalescer(
+                apply=self.apply_device_changes,
+                window=coalesce_window,
+                max_pending=coalesce_size
+            )
 
     def db_transaction(self, query):
-        with psycopg2.connect(self.postges) as con:
-            with con.cursor() as cur:
-                cur.execute(query)
+        self.db_pool.transaction(query)
 
     def db_fetch(self, query):
-        with psycopg2.connect(self.postges) as con:
-            with con.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query)
-                return cur.fetchall()
+        return self.db_pool.fetch(query)
 
     def db_test_query(self, query):
-        with psycopg2.connect(self.postges) as con:
-            with con.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query)
-                result = cur.fetchall()
-                if len(result) > 0:
-                    for row in result:
-                        print(row)
-                else:
-                    print('No Results')
+        result = self.db_fetch(query)
+        if len(result) > 0:
+            for row in result:
+                log.info('query row', extra={'row': row})
+        else:
+            log.info('query returned no results')
 
     def get_device_request(self, dev_eui: str):
-        with grpc.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui = dev_eui
-            resp = client.Get(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['device']
+        data = self.cs_client.get_device(dev_eui)
         return data['devEui'], data['joinEui']
 
+    def get_device_euis(self, dev_eui: str):
+        """
+        (dev_eui, join_eui) from the device cache, over grpc when it has no join_eui.
+        """
+        if self.devices is not None:
+            device = self.devices.get(dev_eui)
+            if device and device['join_eui']:
+                return dev_eui, device['join_eui']
+        return self.get_device_request(dev_eui)
+
     def get_device_request_data(self, dev_eui: str):
-        with grpc.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui = dev_eui
-            resp = client.Get(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['device']
-        return data
+        return self.cs_client.get_device(dev_eui)
 
     def get_device_activation(self, dev_eui: str):
-        with grpc.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceActivationRequest()
-            req.dev_eui = dev_eui
-            resp = client.GetActivation(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['deviceActivation']
-        return data
+        return self.cs_client.get_device_activation(dev_eui)
 
     def create_tables(self):
         query = """
@@ -116,8 +138,24 @@ class ChirpstackStreams:
                 dc_balance bigint default 1000,
                 is_disabled bool default false
             );
+            -- one row per debited stream message, daily partitions are created as debits arrive.
+            CREATE TABLE IF NOT EXISTS helium_dc_ledger (
+                msg_id text not null,               -- redis stream message id
+                kind text not null,                 -- up, join, status, meta_up, meta_down
+                tenant_id uuid,                     -- owning tenant, meta debits of uncached devices have none
+                dev_eui text,
+                dc bigint not null,
+                ts timestamptz not null,            -- from the stream message id
+                primary key (msg_id, kind, ts)
+            ) PARTITION BY RANGE (ts);
+            -- ledger debits not yet applied to the balances, see ChirpDcAccumulator.rollup.
+            CREATE TABLE IF NOT EXISTS helium_dc_pending (
+                tenant_id uuid,
+                dev_eui text,
+                dc bigint not null
+            );
         """
-        print('Run create tables...')
+        log.info('creating tables')
         self.db_transaction(query)
 
     def update_tenant_table(self):
@@ -127,8 +165,11 @@ class ChirpstackStreams:
             FROM tenant
             ON CONFLICT (tenant_id) DO NOTHING;
         """
-        print(f'Updated tenant table... {time.ctime()}')
+        log.info('updating tenant table')
         self.db_transaction(query)
+        # new tenants join the balance index.
+        if self.balances is not None:
+            self.balances.load()
         return
 
     def disable_tenant(self, tenant_id):
@@ -140,60 +181,56 @@ class ChirpstackStreams:
         result = [device['dev_eui'].hex() for device in self.db_fetch(query)]
         return result
 
-    def api_stream_requests(self):
-        stream_key = "api:stream:request"
-        last_id = '0'
-        while True:
-            try:
-                resp = rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
-
-                    if b'request' in message[1]:
-                        msg = message[1][b'request']
-                        pl = api.request_log_pb2.RequestLog()
-                        pl.ParseFromString(msg)
-                        req = MessageToDict(pl)
-                        if 'method' not in req.keys():
-                            continue
-
-                        match req['service']:
-                            case 'api.TenantService':
-
-                                if req['method'] == 'Create':
-                                    print('========== API Create Tenant ==========>')
-                                    self.update_tenant_table()
-
-                                if req['method'] == 'Delete':
-                                    print('========== API Delete Tenant ==========>')
-                                    # currently just disables tenant...
-                                    tenant_id = req['metadata']['tenant_id']
-                                    self.disable_tenant(tenant_id)
-
-                                if req['method'] == 'Update':
-                                    print('========== API Update Tenant ==========>')
-                                    self.update_tenant_table()
-
-                            case 'api.DeviceService':
-                                if req['method'] == 'Create':
-                                    print('========== API Create Euis ==========>')
-                                    print(MessageToJson(pl))
-                                    self.add_device_euis(req['metadata'])
-
-                                if req['method'] == 'Delete':
-                                    print('========== API Delete Euis ==========>')
-                                    print(MessageToJson(pl))
-                                    self.remove_device_euis(req['metadata'])
-
-                                if req['method'] == 'Update':
-                                    print('========== API Update Euis ==========>')
-                                    print(MessageToJson(pl))
-                                    self.update_device_euis(req['metadata'])
+    def register(self, dispatcher: ChirpStreamDispatcher):
+        """
+        api requests are read by the leader replica only, so a device's create,
+        update and delete are applied in order by one process. with a
+        coalescer the stream is acknowledged after each applied batch.
+        """
+        dispatcher.register('api:stream:request', 'request', api.request_log_pb2.RequestLog, self.api_request,
+                            blocking=True, key=api_key, singleton=True)
+        # buffered device events are acknowledged once the coalescer applied them.
+        if self.coalescer is not None:
+            dispatcher.defer_acks('api:stream:request', self.coalescer)
+
+    def api_request(self, pl, msg_id: str):
+        req = MessageToDict(pl)
+        if 'method' not in req.keys():
+            return
+        log.info('api request', extra={'service': req['service'], 'method': req['method']})
+        log.debug('api request payload', extra={'payload': req})
 
-            except Exception as err:
-                print(f'api_stream_requests: {err}')
-                pass
+        match req['service']:
+            case 'api.TenantService':
+
+                if req['method'] == 'Create':
+                    self.update_tenant_table()
+
+                if req['method'] == 'Delete':
+                    # currently just disables tenant...
+                    tenant_id = req['metadata']['tenant_id']
+                    self.disable_tenant(tenant_id)
+
+                if req['method'] == 'Update':
+                    self.update_tenant_table()
+
+            case 'api.DeviceService':
+                if self.coalescer is not None:
+                    if req['method'] in ('Create', 'Delete', 'Update') and 'dev_eui' in req['metadata']:
+                        # an update without is_disabled leaves the device's enablement as it is.
+                        is_disabled = req['metadata'].get('is_disabled')
+                        self.coalescer.record(req['metadata']['dev_eui'], req['method'],
+                                              None if is_disabled is None else is_disabled == 'true')
+                    return
+
+                if req['method'] == 'Create':
+                    self.add_device_euis(req['metadata'])
+
+                if req['method'] == 'Delete':
+                    self.remove_device_euis(req['metadata'])
+
+                if req['method'] == 'Update':
+                    self.update_device_euis(req['metadata'])
 
     def add_device_euis(self, data: dict):
         """
@@ -206,7 +243,7 @@ class ChirpstackStreams:
 
         device = data['dev_eui']
         dev_eui, join_eui = self.get_device_request(device)
-        print(f'Add Device EUIs: {dev_eui}, {join_eui}')
+        log.info('adding device euis', extra={'dev_eui': dev_eui, 'join_eui': join_eui})
 
         query = """
             INSERT INTO helium_devices (dev_eui, join_eui)
@@ -215,10 +252,11 @@ class ChirpstackStreams:
             -- UPDATE SET join_eui='{1}' WHERE dev_eui='{0}';
         """.format(dev_eui, join_eui)
         self.db_transaction(query)
+        if self.devices is not None:
+            self.devices.fill([dev_eui])
 
-        cmd = f'hpr route euis add -d {dev_eui} -a {join_eui} --route-id {self.route_id} --commit'
-        self.config_service_cli(cmd)
-        print('==[ ADD EUIS debug... ]==>')
+        self.route.add_euis([(dev_eui, join_eui)])
+        self.route.apply()
         return
 
     def remove_device_euis(self, data: dict):
@@ -230,27 +268,31 @@ class ChirpstackStreams:
         if 'dev_eui' not in data.keys():
             return
 
-        device = data['dev_eui']
-        print(f'Remove Device: {device}')
+        dev_eui = data['dev_eui']    # this should be a string
 
-        query = "SELECT * FROM helium_devices WHERE dev_eui='{}';".format(device)
-        # print(query)
-        data = self.db_fetch(query)[0]
+        if self.devices is not None:
+            data = self.devices.get(dev_eui)
+            self.devices.invalidate(dev_eui)
+        else:
+            query = "SELECT * FROM helium_devices WHERE dev_eui='{}';".format(dev_eui)
+            rows = self.db_fetch(query)
+            data = rows[0] if rows else None
+        if data is None:
+            log.warning('device not in helium_devices, nothing to remove', extra={'dev_eui': dev_eui})
+            return
 
-        if data['dev_addr'] is not None and data['nws_key'] is not None:
+        if data['dev_addr'] and data['nws_key']:
             dev_addr = data['dev_addr']  # this should be a string
             nws_key = data['nws_key']    # this should be a string
             # if set remove dev_addr and nws_key from skfs's
-            cmd = f'hpr route skfs remove -r {self.route_id} -d {dev_addr} -s {nws_key} -c'
-            self.config_service_cli(cmd)
-            print(f'Removing SKFS -> {cmd}')
+            self.route.remove_skfs([(dev_addr, nws_key, data['max_copies'])])
+            log.info('removing device skfs', extra={'dev_addr': dev_addr, 'session_key': nws_key})
 
-        dev_eui = data['dev_eui']    # this should be a string
         join_eui = data['join_eui']  # this should be a string
         # remove euis, device eui and join eui for device from router
-        cmd = f'hpr route euis remove -d {dev_eui} -a {join_eui} --route-id {self.route_id} -c'
-        self.config_service_cli(cmd)
-        print(f'Removing EUIS -> {cmd}')
+        self.route.remove_euis([(dev_eui, join_eui)])
+        self.route.apply()
+        log.info('removing device euis', extra={'dev_eui': dev_eui, 'join_eui': join_eui})
         # delete or disable device in helium_device table.
         return
 
@@ -260,119 +302,105 @@ class ChirpstackStreams:
             - remove device euis on disable toggle from hpr
             - add device euis to hpr on enable toggle
             - update device device status to is_disabled in helium_devices
+            - refresh the device session and swap its skfs entry
         """
         if 'dev_eui' not in data.keys():
             return
 
         device = data['dev_eui']
-        is_disabled = data['is_disabled']
-        dev_eui, join_eui = self.get_device_request(device)
+        # an update without is_disabled leaves the device's enablement as it is.
+        is_disabled = data.get('is_disabled')
+        dev_eui, join_eui = self.get_device_euis(device)
         if is_disabled == 'true':
-            cmd = f'hpr route euis remove -d {dev_eui} -a {join_eui} --route-id {self.route_id} -c'
+            self.route.remove_euis([(dev_eui, join_eui)])
             query = "UPDATE helium_devices SET is_disabled=true WHERE dev_eui='{}';".format(dev_eui)
             self.db_transaction(query)
-        else:
-            cmd = f'hpr route euis add -d {dev_eui} -a {join_eui} --route-id {self.route_id} -c'
+        elif is_disabled is not None:
+            self.route.add_euis([(dev_eui, join_eui)])
             query = "UPDATE helium_devices SET is_disabled=false WHERE dev_eui='{}';".format(dev_eui)
             self.db_transaction(query)
-        self.config_service_cli(cmd)
-        print('==[ UPDATE EUIS debug... ]==>')
+        self.route.apply()
+        if self.devices is not None:
+            self.devices.invalidate(dev_eui)
+        # enable/disable also adds or drops the device's skfs entry, other updates may change its session.
+        if self.session_refresher is not None:
+            self.session_refresher.submit(dev_eui)
+        log.info('device updated', extra={'dev_eui': dev_eui, 'is_disabled': is_disabled})
         return
 
-    def device_stream_event(self):
-        stream_key = "device:stream:event"
-        last_id = '0'
-        while True:
+    def lookup_euis(self, dev_euis: list[str]) -> dict[str, str]:
+        """
+        dev_eui -> join_eui over grpc, devices that fail the lookup (e.g. deleted since) are left out.
+        """
+        def lookup(dev_eui):
             try:
-                resp = rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
-
-                    if b"up" in message[1]:
-                        b = message[1][b"up"]
-                        pl = integration.UplinkEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE UP Event]==========')
-                        print(MessageToJson(pl))
-
-                    if b"join" in message[1]:
-                        b = message[1][b"join"]
-                        pl = integration.JoinEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE JOIN Event]==========')
-                        print(MessageToJson(pl))
-
-                    if b"ack" in message[1]:
-                        b = message[1][b"ack"]
-                        pl = integration.AckEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE ACK Event]==========')
-                        print(MessageToJson(pl))
-
-                    if b"txack" in message[1]:
-                        b = message[1][b"txack"]
-                        pl = integration.TxAckEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE TXACK Event]==========')
-                        print(MessageToJson(pl))
-
-                    if b"log" in message[1]:
-                        b = message[1][b"log"]
-                        pl = integration.LogEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE LOG Event]==========')
-                        print(MessageToJson(pl))
-
-                    if b"status" in message[1]:
-                        b = message[1][b"status"]
-                        pl = integration.StatusEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE STATUS Event]==========')
-                        print(MessageToJson(pl))
-
-                    if b"location" in message[1]:
-                        b = message[1][b"location"]
-                        pl = integration.LocationEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE LOCATION Event]==========')
-                        print(MessageToJson(pl))
-
-                    if b"integration" in message[1]:
-                        b = message[1][b"integration"]
-                        pl = integration.IntegrationEvent()
-                        pl.ParseFromString(b)
-                        print('==========[DEVICE INTEGRATION Event]==========')
-                        print(MessageToJson(pl))
-
+                return self.get_device_request(dev_eui)
             except Exception as err:
-                print(f'event_log_stream: {err}')
-                pass
-
-    def stream_meta(self):
-        stream_key = 'stream:meta'
-        last_id = '0'
-        try:
-            while True:
-                resp = rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
-
-                    if b"up" in message[1]:
-                        b = message[1][b"up"]
-                        pl = meta.meta_pb2.UplinkMeta()
-                        pl.ParseFromString(b)
-                        print('==========[META = UPLINK]==========')
-                        print(MessageToJson(pl))
-
-                    if b"down" in message[1]:
-                        b = message[1][b"down"]
-                        pl = meta.meta_pb2.DownlinkMeta()
-                        pl.ParseFromString(b)
-                        print('==========[META = DOWNLINK]==========')
-                        print(MessageToJson(pl))
-        except Exception as err:
-            print(f'stream_meta: {err}')
-            pass
+                log.warning('device lookup failed', extra={'dev_eui': dev_eui, 'error': str(err)})
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.lookup_concurrency) as executor:
+            return dict(pair for pair in executor.map(lookup, dev_euis) if pair is not None)
 
+    def apply_device_changes(self, changes: dict[str, list[str]]) -> dict:
+        """
+        apply net device changes from the coalescer, see net_changes.
+            - one helium_devices read for the removed and toggled devices
+            - a grpc lookup per added device for its join_eui
+            - one postgres transaction for the inserts and is_disabled flags
+            - one route batch: removed and disabled euis (and removed skfs) out, added and enabled euis in
+            - a session refresh per toggled or updated device
+        """
+        known = changes['remove'] + [dev_eui for dev_eui in changes['enable'] + changes['disable']
+                                     if dev_eui not in changes['add']]
+        rows = {row['dev_eui']: row for row in self.db_pool.fetch(DEVICE_ROWS, (known,))} if known else {}
+        added = self.lookup_euis(changes['add'])
+        # added devices whose lookup failed are left out.
+        toggled = {dev_eui: dev_eui in changes['enable'] for dev_eui in changes['enable'] + changes['disable']
+                   if dev_eui in added or dev_eui not in changes['add']}
+        missing = [dev_eui for dev_eui in toggled
+                   if dev_eui not in added and not (dev_eui in rows and rows[dev_eui]['join_eui'])]
+        join_euis = {dev_eui: row['join_eui'] for dev_eui, row in rows.items() if row['join_eui']}
+        join_euis.update(self.lookup_euis(missing))
+
+        with self.db_pool.connection() as con:
+            with con.cursor() as cur:
+                if added:
+                    cur.execute(INSERT_DEVICES, (list(added), list(added.values())))
+                if toggled:
+                    cur.execute(SET_DISABLED, (list(toggled), [not enabled for enabled in toggled.values()]))
+
+        for dev_eui in changes['remove']:
+            row = rows.get(dev_eui)
+            if row is None:
+                log.warning('device not in helium_devices, nothing to remove', extra={'dev_eui': dev_eui})
+                continue
+            if row['dev_addr'] and row['nws_key']:
+                self.route.remove_skfs([(row['dev_addr'], row['nws_key'], row['max_copies'])])
+            if row['join_eui']:
+                self.route.remove_euis([(dev_eui, row['join_eui'])])
+        for dev_eui, enabled in toggled.items():
+            join_eui = join_euis.get(dev_eui)
+            if dev_eui in added or not join_eui:
+                continue
+            if enabled:
+                self.route.add_euis([(dev_eui, join_eui)])
+            else:
+                self.route.remove_euis([(dev_eui, join_eui)])
+        # devices created disabled stay off the route.
+        self.route.add_euis([(dev_eui, join_eui) for dev_eui, join_eui in added.items()
+                             if dev_eui not in changes['disable']])
+        stats = self.route.apply()
+
+        if self.devices is not None:
+            for dev_eui in known + changes['update']:
+                self.devices.invalidate(dev_eui)
+            self.devices.fill(list(added))
+        # enable/disable also adds or drops the device's skfs entry, other updates may change its session.
+        if self.session_refresher is not None:
+            for dev_eui in [dev_eui for dev_eui in toggled if dev_eui not in added] + changes['update']:
+                self.session_refresher.submit(dev_eui)
+        log.info('device changes applied', extra={'added': len(added), 'removed': len(changes['remove']),
+                                                  'toggled': len(toggled), 'updated': len(changes['update']),
+                                                  **stats})
+        return stats
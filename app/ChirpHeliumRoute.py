@@ -0,0 +1,221 @@
+import logging
+import os
+import time
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import ujson
+from ChirpHeliumMetrics import ROUTE_SECONDS, ROUTE_ERRORS, timed
+
+
+log = logging.getLogger(__name__)
+
+
+class ChirpHprRunner:
+    """
+    Runs the hpr cli directly, without a /bin/sh per call.
+    """
+    def __init__(self, hpr_path: str = 'hpr', timeout: float = 120.0):
+        self.hpr_path = hpr_path
+        self.timeout = timeout
+
+    def run(self, args: list[str]) -> bytes:
+        with timed(ROUTE_SECONDS, ROUTE_ERRORS, 'hpr', ' '.join(args[:3])):
+            p = subprocess.run(
+                [self.hpr_path, *args],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.timeout
+            )
+            if p.returncode != 0:
+                raise RuntimeError(f'hpr {" ".join(args[:3])} failed: {p.stderr.decode(errors="replace").strip()}')
+        return p.stdout
+
+
+class ChirpHprBackend:
+    """
+    Route backend driving the hpr cli.
+
+    skfs changes are written to an update file and committed with one
+    `hpr route skfs update` call, falling back to one call per entry if the
+    batch is rejected. eui changes have no batch form in the cli and run
+    one call per pair.
+    """
+    euis_batch_size = 1
+
+    def __init__(self, runner: ChirpHprRunner, skfs_batch_size: int = 500):
+        self.runner = runner
+        self.skfs_batch_size = skfs_batch_size
+
+    def list_skfs(self, route_id: str) -> list[dict]:
+        out = self.runner.run(['route', 'skfs', 'list', '--route-id', route_id])
+        return ujson.loads(out)
+
+    def list_euis(self, route_id: str) -> list[dict]:
+        out = self.runner.run(['route', 'euis', 'list', '--route-id', route_id])
+        return ujson.loads(out)
+
+    def euis_args(self, action: str, route_id: str, pair: tuple) -> list[str]:
+        dev_eui, join_eui = pair
+        return ['route', 'euis', action, '-d', dev_eui, '-a', join_eui, '--route-id', route_id, '--commit']
+
+    def skfs_args(self, action: str, route_id: str, entry: tuple) -> list[str]:
+        dev_addr, session_key, max_copies = entry
+        args = ['route', 'skfs', action, '-r', route_id, '-d', dev_addr, '-s', session_key]
+        if action == 'add':
+            args += ['-m', str(max_copies)]
+        return args + ['--commit']
+
+    def run_one(self, args: list[str]) -> int:
+        try:
+            self.runner.run(args)
+            return 0
+        except Exception as err:
+            log.error('hpr call failed', extra={'error': str(err)})
+            return 1
+
+    def update_euis(self, route_id: str, action: str, pairs: list[tuple]) -> tuple[int, int]:
+        """
+        returns (invocations, failures).
+        """
+        failures = sum(self.run_one(self.euis_args(action, route_id, pair)) for pair in pairs)
+        return len(pairs), failures
+
+    def skfs_update_file(self, action: str, entries: list[tuple]) -> str:
+        """
+        write an update file for `hpr route skfs update`, the caller removes it.
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as fh:
+            fh.write('action,devaddr,session_key,max_copies\n')
+            for dev_addr, session_key, max_copies in entries:
+                fh.write(f'{action},{dev_addr},{session_key},{max_copies}\n')
+            return fh.name
+
+    def skfs_update_args(self, route_id: str, path: str) -> list[str]:
+        return ['route', 'skfs', 'update', '--route-id', route_id, '--path', path, '--commit']
+
+    def update_skfs(self, route_id: str, action: str, entries: list[tuple]) -> tuple[int, int]:
+        path = self.skfs_update_file(action, entries)
+        try:
+            self.runner.run(self.skfs_update_args(route_id, path))
+            return 1, 0
+        except Exception as err:
+            log.warning('skfs batch rejected, applying entries one by one',
+                        extra={'entries': len(entries), 'error': str(err)})
+        finally:
+            os.unlink(path)
+        failures = sum(self.run_one(self.skfs_args(action, route_id, entry)) for entry in entries)
+        return 1 + len(entries), failures
+
+
+class ChirpRouteUpdater:
+    """
+    Mutation queue for route euis and skfs.
+
+    changes are queued per route and applied by apply(): all removes first,
+    then all adds, so a changed entry is never removed after its
+    replacement went in. the backend (hpr cli or the config service over
+    grpc) sets how many changes fit in one committed batch, and at most
+    concurrency batches run at once.
+    """
+    def __init__(
+            self,
+            route_id: str,
+            backend,
+            concurrency: int = 4,
+    ):
+        self.route_id = route_id
+        self.backend = backend
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        # one apply at a time, so removes and adds of concurrent callers never interleave.
+        self.apply_lock = threading.Lock()
+        self.queue = {}
+
+    def route_queue(self, route_id: str = None) -> dict:
+        route_id = route_id or self.route_id
+        if route_id not in self.queue:
+            self.queue[route_id] = {
+                'euis_remove': [],
+                'euis_add': [],
+                'skfs_remove': [],
+                'skfs_add': [],
+            }
+        return self.queue[route_id]
+
+    def add_euis(self, pairs: list[tuple], route_id: str = None):
+        """
+        queue (dev_eui, join_eui) pairs to add.
+        """
+        with self.lock:
+            self.route_queue(route_id)['euis_add'].extend(pairs)
+
+    def remove_euis(self, pairs: list[tuple], route_id: str = None):
+        with self.lock:
+            self.route_queue(route_id)['euis_remove'].extend(pairs)
+
+    def add_skfs(self, entries: list[tuple], route_id: str = None):
+        """
+        queue (dev_addr, session_key, max_copies) entries to add.
+        """
+        with self.lock:
+            self.route_queue(route_id)['skfs_add'].extend(entries)
+
+    def remove_skfs(self, entries: list[tuple], route_id: str = None):
+        with self.lock:
+            self.route_queue(route_id)['skfs_remove'].extend(entries)
+
+    def list_skfs(self, route_id: str = None) -> list[dict]:
+        return self.backend.list_skfs(route_id or self.route_id)
+
+    def list_euis(self, route_id: str = None) -> list[dict]:
+        return self.backend.list_euis(route_id or self.route_id)
+
+    def run_phase(self, executor, route_id: str, action: str, euis: list[tuple], skfs: list[tuple]) -> tuple[int, int]:
+        euis_size = self.backend.euis_batch_size
+        skfs_size = self.backend.skfs_batch_size
+        jobs = [executor.submit(self.backend.update_euis, route_id, action, euis[i:i + euis_size])
+                for i in range(0, len(euis), euis_size)]
+        jobs += [executor.submit(self.backend.update_skfs, route_id, action, skfs[i:i + skfs_size])
+                 for i in range(0, len(skfs), skfs_size)]
+        invocations = 0
+        failures = 0
+        for job in jobs:
+            try:
+                calls, failed = job.result()
+            except Exception:
+                log.exception('route update failed', extra={'action': action})
+                calls, failed = 1, 1
+            invocations += calls
+            failures += failed
+        return invocations, failures
+
+    def apply(self) -> dict:
+        """
+        drain the queue and apply it, removes before adds. a call made while
+        another apply runs waits for it, then applies what was queued since.
+        """
+        with self.apply_lock:
+            with self.lock:
+                queue, self.queue = self.queue, {}
+
+            start = time.monotonic()
+            stats = {'euis_added': 0, 'euis_removed': 0, 'skfs_added': 0, 'skfs_removed': 0,
+                     'invocations': 0, 'failed': 0}
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for route_id, changes in queue.items():
+                    # duplicates would only cost extra calls.
+                    changes = {key: list(dict.fromkeys(value)) for key, value in changes.items()}
+                    for action, done in (('remove', 'removed'), ('add', 'added')):
+                        invocations, failures = self.run_phase(
+                            executor, route_id, action, changes[f'euis_{action}'], changes[f'skfs_{action}']
+                        )
+                        stats['invocations'] += invocations
+                        stats['failed'] += failures
+                        stats[f'euis_{done}'] += len(changes[f'euis_{action}'])
+                        stats[f'skfs_{done}'] += len(changes[f'skfs_{action}'])
+            stats['duration'] = round(time.monotonic() - start, 2)
+        if stats['invocations']:
+            log.info('route update', extra=stats)
+        return stats
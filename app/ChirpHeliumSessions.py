@@ -0,0 +1,139 @@
+import psycopg2.extras
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from ChirpHeliumPool import ChirpPostgresPool
+
+
+def _session_message():
+    """
+    the subset of chirpstack's internal.DeviceSession needed for helium_devices,
+    built at runtime as chirpstack_api does not ship the internal protos.
+    unknown fields are skipped when parsing.
+    """
+    f = descriptor_pb2.FieldDescriptorProto
+    fd = descriptor_pb2.FileDescriptorProto(name='chirpstack_hpr_session.proto', package='chirpstack_hpr', syntax='proto3')
+
+    envelope = fd.message_type.add(name='KeyEnvelope')
+    envelope.field.add(name='kek_label', number=1, type=f.TYPE_STRING, label=f.LABEL_OPTIONAL)
+    envelope.field.add(name='aes_key', number=2, type=f.TYPE_BYTES, label=f.LABEL_OPTIONAL)
+
+    session = fd.message_type.add(name='DeviceSession')
+    session.field.add(name='dev_addr', number=2, type=f.TYPE_BYTES, label=f.LABEL_OPTIONAL)
+    session.field.add(name='nwk_s_enc_key', number=5, type=f.TYPE_BYTES, label=f.LABEL_OPTIONAL)
+    session.field.add(name='app_s_key', number=6, type=f.TYPE_MESSAGE, label=f.LABEL_OPTIONAL,
+                      type_name='.chirpstack_hpr.KeyEnvelope')
+    session.field.add(name='f_cnt_up', number=7, type=f.TYPE_UINT32, label=f.LABEL_OPTIONAL)
+    session.field.add(name='n_f_cnt_down', number=8, type=f.TYPE_UINT32, label=f.LABEL_OPTIONAL)
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(fd)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName('chirpstack_hpr.DeviceSession'))
+
+
+DeviceSession = _session_message()
+
+
+class ChirpSessionLoader:
+    """
+    Bulk loader for helium_devices straight from chirpstack's own database.
+
+    one server-side cursor walks the device table, session blobs are read
+    from device.device_session (chirpstack >= 4.7) or from the redis
+    device:{dev_eui}:ds keys (older releases) and decoded in process, so
+    the whole fleet costs no grpc calls. available() is false when the
+    schema lacks the columns needed, callers then fall back to grpc.
+    """
+    def __init__(
+            self,
+            db_pool: ChirpPostgresPool,
+            rdb,
+            fetch_size: int = 2000,
+    ):
+        self.db_pool = db_pool
+        self.rdb = rdb
+        self.fetch_size = fetch_size
+        self.columns = None
+
+    def device_columns(self) -> set[str]:
+        if self.columns is None:
+            rows = self.db_pool.fetch("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'device';
+            """)
+            self.columns = {row['column_name'] for row in rows}
+        return self.columns
+
+    def available(self) -> bool:
+        return 'join_eui' in self.device_columns()
+
+    def decode_session(self, blob: bytes) -> dict:
+        session = {
+            'dev_addr': '',
+            'app_s_key': '',
+            'nwk_s_enc_key': '',
+            'f_cnt_up': 0,
+            'n_f_cnt_down': 0,
+        }
+        if not blob:
+            return session
+        ds = DeviceSession()
+        ds.ParseFromString(blob)
+        session['dev_addr'] = ds.dev_addr.hex()
+        session['nwk_s_enc_key'] = ds.nwk_s_enc_key.hex()
+        # wrapped (kek) app keys are useless here, only keep plain ones.
+        if not ds.app_s_key.kek_label:
+            session['app_s_key'] = ds.app_s_key.aes_key.hex()
+        session['f_cnt_up'] = ds.f_cnt_up
+        session['n_f_cnt_down'] = ds.n_f_cnt_down
+        return session
+
+    def redis_sessions(self, dev_euis: list[str]) -> list:
+        pipe = self.rdb.pipeline(transaction=False)
+        for dev_eui in dev_euis:
+            pipe.get(f'device:{{{dev_eui}}}:ds')
+        return pipe.execute()
+
+    def build_rows(self, devices: list[dict], blobs: list) -> list[tuple]:
+        rows = []
+        for device, blob in zip(devices, blobs):
+            session = self.decode_session(blob)
+            variables = device['variables'] or {}
+            rows.append((device['dev_eui'].hex(),
+                         device['join_eui'].hex() if device['join_eui'] else '',
+                         session['dev_addr'],
+                         int(variables.get('max_copies', 0)),
+                         session['app_s_key'],
+                         session['nwk_s_enc_key'],
+                         device['name'],
+                         session['f_cnt_up'],
+                         session['n_f_cnt_down']))
+        return rows
+
+    def load(self, dev_euis: list[str] = None) -> list[tuple]:
+        """
+        helium_devices rows for every enabled device, or only for dev_euis.
+        """
+        in_postgres = 'device_session' in self.device_columns()
+        query = """
+            SELECT dev_eui, join_eui, name, variables, {} AS device_session
+            FROM device WHERE is_disabled = false
+        """.format('device_session' if in_postgres else 'NULL::bytea')
+        params = None
+        if dev_euis is not None:
+            query += " AND dev_eui = ANY(%s)"
+            params = ([bytes.fromhex(dev_eui) for dev_eui in dev_euis],)
+
+        rows = []
+        with self.db_pool.connection() as con:
+            with con.cursor(name='chirpstack_hpr_sessions', cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.itersize = self.fetch_size
+                cur.execute(query, params)
+                while True:
+                    devices = cur.fetchmany(self.fetch_size)
+                    if not devices:
+                        break
+                    if in_postgres:
+                        blobs = [device['device_session'] for device in devices]
+                    else:
+                        blobs = self.redis_sessions([device['dev_eui'].hex() for device in devices])
+                    rows.extend(self.build_rows(devices, blobs))
+        return rows
@@ -0,0 +1,235 @@
+import logging
+import time
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ChirpHeliumKeys import ChirpDeviceKeys
+from ChirpHeliumSessions import ChirpSessionLoader
+
+
+log = logging.getLogger(__name__)
+
+
+class ChirpRateLimiter:
+    """
+    Token bucket shared by the sync workers, caps calls to rate per second.
+    a rate of 0 disables the limit.
+    """
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """
+        take a token, returns 0 on success or the seconds to wait before retrying.
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class ChirpDeviceSync:
+    """
+    Parallel device key sync from chirpstack into helium_devices.
+
+    devices are fetched by up to concurrency workers, every grpc call goes
+    through the shared rate limiter, and results are upserted batch_size
+    rows at a time.
+
+    passes are incremental, only devices changed since the high-water mark
+    (latest device/device_keys updated_at seen) are re-fetched. every
+    full_every passes, and on the first pass, all devices are reconciled.
+
+    with a session loader, devices are read straight from chirpstack's
+    database in bulk, grpc remains the fallback when it is unavailable.
+    """
+    def __init__(
+            self,
+            client_keys: ChirpDeviceKeys,
+            concurrency: int = 8,
+            rate_limit: float = 50.0,
+            batch_size: int = 500,
+            full_every: int = 12,
+            overlap: int = 60,
+            loader: ChirpSessionLoader = None,
+    ):
+        self.keys = client_keys
+        self.concurrency = concurrency
+        self.limiter = ChirpRateLimiter(rate_limit)
+        self.batch_size = batch_size
+        self.full_every = full_every
+        # re-check a window before the mark for rows committed after it was taken.
+        self.overlap = timedelta(seconds=overlap)
+        self.high_water_mark = None
+        self.passes = 0
+        self.loader = loader
+
+    def fetch(self, dev_eui: str) -> tuple:
+        self.limiter.acquire()
+        device = self.keys.get_device(dev_eui)
+        self.limiter.acquire()
+        activation = self.keys.get_device_activation(dev_eui)
+        return self.keys.merge_keys(device, activation)
+
+    def sync_devices(self, dev_euis: list[str]) -> dict:
+        start = time.monotonic()
+        rows = []
+        updated = 0
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            jobs = {executor.submit(self.fetch, dev_eui): dev_eui for dev_eui in dev_euis}
+            for job in as_completed(jobs):
+                try:
+                    rows.append(job.result())
+                except Exception as err:
+                    failed += 1
+                    log.error('device sync failed', extra={'dev_eui': jobs[job], 'error': str(err)})
+                    continue
+                if len(rows) >= self.batch_size:
+                    pushed = self.keys.upsert_sessions(rows)
+                    updated += len(rows) - pushed['failed']
+                    failed += pushed['failed']
+                    rows = []
+        if rows:
+            pushed = self.keys.upsert_sessions(rows)
+            updated += len(rows) - pushed['failed']
+            failed += pushed['failed']
+        return {
+            'devices': len(dev_euis),
+            'updated': updated,
+            'failed': failed,
+            'duration': round(time.monotonic() - start, 2),
+        }
+
+    def load_devices(self, dev_euis: list[str] = None) -> dict:
+        """
+        bulk path, dev_euis None loads the whole fleet. returns None when the
+        loader cannot be used with this chirpstack schema.
+        """
+        if not self.loader.available():
+            return None
+        start = time.monotonic()
+        rows = self.loader.load(dev_euis) if dev_euis != [] else []
+        pushed = self.keys.upsert_sessions(rows, bulk=True)
+        return {
+            'devices': len(rows),
+            'updated': len(rows) - pushed['failed'],
+            'failed': pushed['failed'],
+            'duration': round(time.monotonic() - start, 2),
+        }
+
+    def begin_pass(self) -> tuple[bool, object]:
+        """
+        returns (full, since) for the next pass.
+        """
+        full = self.high_water_mark is None or self.passes % self.full_every == 0
+        since = None if full else self.high_water_mark - self.overlap
+        return full, since
+
+    def end_pass(self, full: bool, devices: list[dict], stats: dict) -> dict:
+        stats['mode'] = 'full' if full else 'delta'
+        self.passes += 1
+        changed = [dev['changed_at'] for dev in devices if dev['changed_at'] is not None]
+        # hold the mark on failures so those devices are picked up by the next pass.
+        if stats['failed'] == 0 and changed:
+            self.high_water_mark = max(changed + ([self.high_water_mark] if self.high_water_mark else []))
+        log.info('device sync', extra=stats)
+        return stats
+
+    def sync(self) -> dict:
+        full, since = self.begin_pass()
+        devices = self.keys.fetch_changed_devices(since)
+        dev_euis = [dev['dev_eui'] for dev in devices]
+        stats = None
+        if self.loader is not None:
+            try:
+                stats = self.load_devices(None if full else dev_euis)
+            except Exception:
+                log.exception('session loader failed, falling back to grpc')
+        if stats is None:
+            stats = self.sync_devices(dev_euis)
+        return self.end_pass(full, devices, stats)
+
+
+class ChirpSessionRefresher:
+    """
+    Runs ChirpDeviceKeys.refresh_device_session off the stream threads.
+    a device already waiting for a refresh is not queued twice. failed
+    refreshes are retried after retry_delay seconds, doubling per attempt,
+    up to retries times before the skfs reconcile is left to pick them up.
+    """
+    def __init__(self, client_keys: ChirpDeviceKeys, workers: int = 2, retries: int = 5, retry_delay: float = 5.0):
+        self.keys = client_keys
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def submit(self, dev_eui: str, attempt: int = 0):
+        with self.lock:
+            if dev_eui in self.pending:
+                return
+            self.pending.add(dev_eui)
+        self.executor.submit(self.refresh, dev_eui, attempt)
+
+    def refresh(self, dev_eui: str, attempt: int = 0):
+        with self.lock:
+            self.pending.discard(dev_eui)
+        try:
+            log.info(self.keys.refresh_device_session(dev_eui), extra={'dev_eui': dev_eui})
+        except Exception:
+            if attempt >= self.retries:
+                log.exception('session refresh failed, giving up', extra={'dev_eui': dev_eui, 'attempts': attempt + 1})
+                return
+            delay = self.retry_delay * 2 ** attempt
+            log.warning('session refresh failed, retrying', extra={'dev_eui': dev_eui, 'attempt': attempt + 1,
+                                                                   'delay': delay}, exc_info=True)
+            timer = threading.Timer(delay, self.submit, args=(dev_eui, attempt + 1))
+            timer.daemon = True
+            timer.start()
+
+
+class ChirpTenantDisabler:
+    """
+    Runs ChirpDeviceKeys.disable_tenant off the stream threads, used as the
+    balance index's on_crossing callback. a tenant is only queued once.
+    """
+    def __init__(self, client_keys: ChirpDeviceKeys):
+        self.keys = client_keys
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def submit(self, tenant_id: str, balance: int = None):
+        with self.lock:
+            if tenant_id in self.pending:
+                return
+            self.pending.add(tenant_id)
+        self.executor.submit(self.disable, tenant_id)
+
+    def disable(self, tenant_id: str):
+        try:
+            self.keys.disable_tenant(tenant_id)
+        except Exception:
+            log.exception('tenant disable failed', extra={'tenant_id': tenant_id})
+        finally:
+            with self.lock:
+                self.pending.discard(tenant_id)
@@ -1,14 +1,19 @@
 import os
-from concurrent.futures import ThreadPoolExecutor
-import psycopg2
-import psycopg2.extras
+import logging
 import redis
 from math import ceil
-import base64
 # import grpc
 from google.protobuf.json_format import MessageToDict  # MessageToJson
-import ujson
-from chirpstack_api import api, gw, integration, meta
+from chirpstack_api import integration, meta
+from ChirpHeliumReader import ChirpStreamDispatcher
+from ChirpHeliumCredits import ChirpDcAccumulator, ChirpBalanceIndex
+from ChirpHeliumSync import ChirpSessionRefresher
+from ChirpHeliumPool import ChirpPostgresPool
+from ChirpHeliumCache import ChirpDeviceCache
+from ChirpHeliumLog import sampled
+
+
+log = logging.getLogger(__name__)
 
 
 # -----------------------------------------------------------------------------
@@ -19,229 +24,173 @@ rpool = redis.ConnectionPool(host=redis_server, port=6379, db=0)
 rdb = redis.Redis(connection_pool=rpool, decode_responses=True)
 
 
+def event_key(pl) -> str:
+    return pl.device_info.dev_eui
+
+
+def meta_key(pl) -> str:
+    return pl.dev_eui
+
+
 class ChirpstackTenant:
     def __init__(
             self,
             route_id: str,
-            postgres_host: str,
-            postgres_user: str,
-            postgres_pass: str,
-            postgres_name: str,
-            chirpstack_host: str,
-            chirpstack_token: str,
+            db_pool: ChirpPostgresPool,
+            dc_accumulator: ChirpDcAccumulator,
+            session_refresher: ChirpSessionRefresher = None,
+            balance_index: ChirpBalanceIndex = None,
+            device_cache: ChirpDeviceCache = None,
     ):
         self.route_id = route_id
-        self.pg_host = postgres_host
-        self.pg_user = postgres_user
-        self.pg_pass = postgres_pass
-        self.pg_name = postgres_name
-        self.postges = f'postgresql://{self.pg_user}:{self.pg_pass}@{self.pg_host}/{self.pg_name}'
-        self.cs_gprc = chirpstack_host
-        self.auth_token = [('authorization', f'Bearer {chirpstack_token}')]
+        self.db_pool = db_pool
+        self.dc = dc_accumulator
+        self.session_refresher = session_refresher
+        self.balances = balance_index
+        self.devices = device_cache
+        # payload dumps and the print-only event types are only handled at DEBUG.
+        self.debug = log.isEnabledFor(logging.DEBUG)
 
     def db_transaction(self, query):
-        with psycopg2.connect(self.postges) as con:
-            with con.cursor() as cur:
-                cur.execute(query)
-
-    def stream_meta(self):
-        stream_key = 'stream:meta'
-        last_id = '0'
-        try:
-            while True:
-                resp = rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
-
-                    if b"up" in message[1]:
-                        b = message[1][b"up"]
-                        pl = meta.meta_pb2.UplinkMeta()
-                        pl.ParseFromString(b)
-                        data = MessageToDict(pl)
-                        self.meta_up(data)
-
-                    if b"down" in message[1]:
-                        b = message[1][b"down"]
-                        pl = meta.meta_pb2.DownlinkMeta()
-                        pl.ParseFromString(b)
-                        data = MessageToDict(pl)
-                        self.meta_down(data)
-
-        except Exception as exc:
-            print(f'Error: {exc}')
-            # log exception error here when adding logger
-            pass
-
-    def meta_up(self, data: dict):
-        print('========== [ META = UPLINK ] ==========')
-        print(ujson.dumps(data, indent=4))
-        dev_eui = data['devEui']
-        dupes = len(data['rxInfo'])
-        dc = ceil(data['phyPayloadByteCount'] / 24)
+        self.db_pool.transaction(query)
+
+    def debit_tenant(self, msg_id: str, kind: str, tenant_id: str, dev_eui: str, dc: int):
+        self.dc.debit_tenant(msg_id, kind, tenant_id, dev_eui, dc)
+        if self.balances is not None:
+            self.balances.debit(msg_id, kind, tenant_id, dc)
+
+    def device_tenant(self, dev_eui: str):
+        """
+        tenant_id for meta records, which only carry the dev_eui.
+        """
+        if self.devices is None:
+            return None
+        device = self.devices.get(dev_eui)
+        return device['tenant_id'] if device else None
+
+    def register(self, dispatcher: ChirpStreamDispatcher):
+        """
+        route device events and meta records to their handlers, handlers record
+        their dc debits in the accumulator which is flushed after each read
+        once its size or time trigger is due. events that carry no dc are only
+        parsed when logging at DEBUG. meta records look their tenant up in the
+        device cache, whose misses read postgres, so with a cache they count
+        as blocking and stay off the asyncio event loop.
+        """
+        events = [
+            ('up', integration.UplinkEvent, self.event_up),
+            ('join', integration.JoinEvent, self.event_join),
+            ('status', integration.StatusEvent, self.event_status),
+        ]
+        if self.debug:
+            events += [
+                ('ack', integration.AckEvent, self.event_ack),
+                ('txack', integration.TxAckEvent, self.event_txack),
+                ('log', integration.LogEvent, self.event_log),
+                ('location', integration.LocationEvent, self.event_location),
+                ('integration', integration.IntegrationEvent, self.event_integration),
+            ]
+        for field, message_type, handler in events:
+            dispatcher.register('device:stream:event', field, message_type, handler, key=event_key)
+        blocking = self.devices is not None
+        dispatcher.register('stream:meta', 'up', meta.meta_pb2.UplinkMeta, self.meta_up, blocking=blocking,
+                            key=meta_key)
+        dispatcher.register('stream:meta', 'down', meta.meta_pb2.DownlinkMeta, self.meta_down, blocking=blocking,
+                            key=meta_key)
+        dispatcher.on_batch(self.dc.maybe_flush)
+        # entries are acknowledged once their debits are in the ledger.
+        dispatcher.defer_acks('device:stream:event', self.dc)
+        dispatcher.defer_acks('stream:meta', self.dc)
+
+    def dump(self, event: str, pl):
+        if self.debug:
+            log.debug('payload', extra={'event': event, 'payload': MessageToDict(pl)})
+
+    def meta_up(self, pl, msg_id: str):
+        dev_eui = pl.dev_eui
+        dupes = len(pl.rx_info)
+        dc = ceil(pl.phy_payload_byte_count / 24)
         total_dc = dupes * dc
-        query = """
-            UPDATE helium_devices SET dc_used = (dc_used + {}) WHERE dev_eui='{}';
-        """.format(total_dc, dev_eui)
-        print(f'UPLINK DC USED: {query}')
-        self.db_transaction(query)
+        if sampled(log, 'meta_up'):
+            log.info('uplink dc used', extra={'event': 'meta_up', 'dev_eui': dev_eui, 'dupes': dupes, 'dc': total_dc})
+            self.dump('meta_up', pl)
+        # recorded against the tenant, the uplink event is what charges it.
+        self.dc.debit_device(msg_id, 'meta_up', dev_eui, total_dc, self.device_tenant(dev_eui))
         return
 
-    def meta_down(self, data: dict):
-        print('========== [ META = DOWNLINK ] ==========')
-        print(ujson.dumps(data, indent=4))
-        dev_eui = data['devEui']
-        total_dc = ceil(data['phyPayloadByteCount'] / 24)
-        query = """
-            UPDATE helium_devices SET dc_used = (dc_used + {}) WHERE dev_eui='{}';
-        """.format(total_dc, dev_eui)
-        print(f'DOWNLINK DC USED: {query}')
-        self.db_transaction(query)
+    def meta_down(self, pl, msg_id: str):
+        dev_eui = pl.dev_eui
+        total_dc = ceil(pl.phy_payload_byte_count / 24)
+        if sampled(log, 'meta_down'):
+            log.info('downlink dc used', extra={'event': 'meta_down', 'dev_eui': dev_eui, 'dc': total_dc})
+            self.dump('meta_down', pl)
+        tenant_id = self.device_tenant(dev_eui)
+        self.dc.debit_device(msg_id, 'meta_down', dev_eui, total_dc, tenant_id)
+        # no event carries downlinks, the tenant is charged here.
+        if tenant_id is not None and self.balances is not None:
+            self.balances.debit(msg_id, 'meta_down', tenant_id, total_dc)
         return
 
-    def device_stream_event(self):
-        stream_key = "device:stream:event"
-        last_id = '0'
-        while True:
-            try:
-                resp = rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
-
-                    if b"up" in message[1]:
-                        b = message[1][b"up"]
-                        pl = integration.UplinkEvent()
-                        pl.ParseFromString(b)
-                        self.event_up(MessageToDict(pl))
-
-                    if b"join" in message[1]:
-                        b = message[1][b"join"]
-                        pl = integration.JoinEvent()
-                        pl.ParseFromString(b)
-                        self.event_join(MessageToDict(pl))
-
-                    if b"ack" in message[1]:
-                        b = message[1][b"ack"]
-                        pl = integration.AckEvent()
-                        pl.ParseFromString(b)
-                        print('========== [ device ACK Event] ==========')
-                        self.event_ack(MessageToDict(pl))
-
-                    if b"txack" in message[1]:
-                        b = message[1][b"txack"]
-                        pl = integration.TxAckEvent()
-                        pl.ParseFromString(b)
-                        print('========== [ device TXACK Event] ==========')
-                        self.event_txack(MessageToDict(pl))
-
-                    if b"log" in message[1]:
-                        b = message[1][b"log"]
-                        pl = integration.LogEvent()
-                        pl.ParseFromString(b)
-                        print('========== [ device LOG Event] ==========')
-                        self.event_log(MessageToDict(pl))
-
-                    if b"status" in message[1]:
-                        b = message[1][b"status"]
-                        pl = integration.StatusEvent()
-                        pl.ParseFromString(b)
-                        self.event_status(MessageToDict(pl))
-
-                    if b"location" in message[1]:
-                        b = message[1][b"location"]
-                        pl = integration.LocationEvent()
-                        pl.ParseFromString(b)
-                        print('========== [ device LOCATION Event] ==========')
-                        self.event_location(MessageToDict(pl))
-
-                    if b"integration" in message[1]:
-                        b = message[1][b"integration"]
-                        pl = integration.IntegrationEvent()
-                        pl.ParseFromString(b)
-                        print('========== [ device INTEGRATION Event] ==========')
-                        self.event_integration(MessageToDict(pl))
-
-            except Exception as err:
-                print(f'ERROR device_stream_event: {err}')
-                pass
-
-    def event_up(self, data: dict):
-        print('========== [ device UP Event] ==========')
-        tenant_id = data['deviceInfo']['tenantId']
-        tenant_name = data['deviceInfo']['tenantName']
-        device_name = data['deviceInfo']['deviceName']
-        num_dupes = len(data['rxInfo'])
-        msg_bytes = ceil(len(base64.b64decode(data['data'])) / 24)
+    def event_up(self, pl, msg_id: str):
+        tenant_id = pl.device_info.tenant_id
+        num_dupes = len(pl.rx_info)
+        msg_bytes = ceil(len(pl.data) / 24)
         total_dc = num_dupes * msg_bytes
-        print('Tenant:', tenant_id, '\n' +
-              'Name:', tenant_name, '\n' +
-              'Device:', device_name, '\n' +
-              'Dupes:', num_dupes, '\n' +
-              'DC:', msg_bytes, '\n' +
-              'Total DC:', total_dc)
-        query = """
-            UPDATE helium_tenant SET dc_balance = (dc_balance - {}) WHERE tenant_id = '{}';
-        """.format(total_dc, tenant_id)
-        self.db_transaction(query)
+        if sampled(log, 'up'):
+            log.info('device uplink', extra={'event': 'up', 'tenant_id': tenant_id,
+                                             'dev_eui': pl.device_info.dev_eui, 'dupes': num_dupes, 'dc': total_dc})
+            self.dump('up', pl)
+        self.debit_tenant(msg_id, 'up', tenant_id, pl.device_info.dev_eui, total_dc)
         return
 
-    def event_join(self, data: dict):
-        print('========== [ device JOIN Event] ==========')
-        tenant_id = data['deviceInfo']['tenantId']
-        tenant_name = data['deviceInfo']['tenantName']
-        device_name = data['deviceInfo']['deviceName']
-        dev_eui = data['deviceInfo']['devEui']
+    def event_join(self, pl, msg_id: str):
+        tenant_id = pl.device_info.tenant_id
+        dev_eui = pl.device_info.dev_eui
         total_dc = 1
-        print('Tenant:', tenant_id, '\n' +
-              'Name:', tenant_name, '\n' +
-              'Device:', device_name, '\n' +
-              'Dev_Eui:', dev_eui, '\n' +
-              'Total DC:', total_dc)
-        query = """
-            UPDATE helium_tenant SET dc_balance = (dc_balance - {}) WHERE tenant_id = '{}';
-        """.format(total_dc, tenant_id)
-        self.db_transaction(query)
-        # print(ujson.dumps(data, indent=4))
+        if sampled(log, 'join'):
+            log.info('device join', extra={'event': 'join', 'tenant_id': tenant_id,
+                                           'dev_eui': dev_eui, 'dc': total_dc})
+            self.dump('join', pl)
+        self.debit_tenant(msg_id, 'join', tenant_id, dev_eui, total_dc)
+        # new session keys, get them onto the route now rather than at the next reconcile.
+        if self.session_refresher is not None:
+            self.session_refresher.submit(dev_eui)
         return
 
-    def event_ack(self, data: dict):
-        print(ujson.dumps(data, indent=4))
+    def event_ack(self, pl, msg_id: str):
+        if sampled(log, 'ack', logging.DEBUG):
+            self.dump('ack', pl)
         return
 
-    def event_txack(self, data: dict):
-        print(ujson.dumps(data, indent=4))
+    def event_txack(self, pl, msg_id: str):
+        if sampled(log, 'txack', logging.DEBUG):
+            self.dump('txack', pl)
         return
 
-    def event_log(self, data: dict):
-        print(ujson.dumps(data, indent=4))
+    def event_log(self, pl, msg_id: str):
+        if sampled(log, 'log', logging.DEBUG):
+            self.dump('log', pl)
         return
 
-    def event_status(self, data: dict):
-        print('========== [ device STATUS Event] ==========')
-        tenant_id = data['deviceInfo']['tenantId']
-        tenant_name = data['deviceInfo']['tenantName']
-        device_name = data['deviceInfo']['deviceName']
-        dev_eui = data['deviceInfo']['devEui']
+    def event_status(self, pl, msg_id: str):
+        tenant_id = pl.device_info.tenant_id
+        dev_eui = pl.device_info.dev_eui
         total_dc = 1
-        print('Tenant:', tenant_id, '\n' +
-              'Name:', tenant_name, '\n' +
-              'Device:', device_name, '\n' +
-              'Dev_Eui:', dev_eui, '\n' +
-              'Total DC:', total_dc)
-        query = """
-            UPDATE helium_tenant SET dc_balance = (dc_balance - {}) WHERE tenant_id = '{}';
-        """.format(total_dc, tenant_id)
-        self.db_transaction(query)
-        # print(ujson.dumps(data, indent=4))
+        if sampled(log, 'status'):
+            log.info('device status', extra={'event': 'status', 'tenant_id': tenant_id,
+                                             'dev_eui': dev_eui, 'dc': total_dc})
+            self.dump('status', pl)
+        self.debit_tenant(msg_id, 'status', tenant_id, dev_eui, total_dc)
         return
 
-    def event_location(self, data: dict):
-        print(ujson.dumps(data, indent=4))
+    def event_location(self, pl, msg_id: str):
+        if sampled(log, 'location', logging.DEBUG):
+            self.dump('location', pl)
         return
 
-    def event_integration(self, data: dict):
-        print(ujson.dumps(data, indent=4))
+    def event_integration(self, pl, msg_id: str):
+        if sampled(log, 'integration', logging.DEBUG):
+            self.dump('integration', pl)
         return
 
     """
@@ -0,0 +1,331 @@
+import base64
+import logging
+import queue
+import threading
+import time
+import zlib
+import redis
+import ujson
+from ChirpHeliumReader import ChirpStreamDispatcher
+from ChirpHeliumMetrics import QUEUE_DEPTH, QUEUE_SPILLED, stream_id_seconds
+
+
+log = logging.getLogger(__name__)
+
+
+class ChirpWorkerPool:
+    """
+    Worker threads fed by bounded queues, one queue per worker.
+
+    items are assigned to a worker by hashing their key, so items with the
+    same key are handled one at a time in the order they were submitted.
+    once a queue holds depth items the policy applies:
+        block - submit() waits for room
+        spill - the item is pushed to a redis list that the worker drains
+                once its queue is empty. later items for that worker follow
+                it to the list until the list is empty, so order is kept.
+    spill lists only extend the queues, they are cleared on start.
+    """
+    def __init__(
+            self,
+            name: str,
+            handler,
+            workers: int = 4,
+            depth: int = 1000,
+            policy: str = 'block',
+            rdb=None,
+            spill_prefix: str = 'chirpstack-hpr:spill',
+            encode=None,
+            decode=None,
+    ):
+        if policy not in ('block', 'spill'):
+            raise ValueError(f'unknown queue policy {policy}')
+        if policy == 'spill' and rdb is None:
+            raise ValueError('the spill policy needs a redis connection')
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.depth = depth
+        self.policy = policy
+        self.rdb = rdb
+        self.spill_prefix = spill_prefix
+        self.encode = encode
+        self.decode = decode
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(workers)]
+        self.locks = [threading.Lock() for _ in range(workers)]
+        # items waiting in each worker's spill list.
+        self.spilled = [0] * workers
+        self.gauges = [QUEUE_DEPTH.labels(name, i) for i in range(workers)]
+        self.spills = QUEUE_SPILLED.labels(name)
+
+    def spill_key(self, worker: int) -> str:
+        return f'{self.spill_prefix}:{self.name}:{worker}'
+
+    def worker(self, key) -> int:
+        if isinstance(key, str):
+            key = key.encode()
+        return zlib.crc32(key or b'') % self.workers
+
+    def full(self) -> bool:
+        return any(q.full() for q in self.queues)
+
+    def update_gauge(self, i: int):
+        self.gauges[i].set(self.queues[i].qsize() + self.spilled[i])
+
+    def submit(self, key, item):
+        i = self.worker(key)
+        if self.policy == 'block':
+            self.queues[i].put(item)
+            self.update_gauge(i)
+            return
+        with self.locks[i]:
+            if not self.spilled[i]:
+                try:
+                    self.queues[i].put_nowait(item)
+                    self.update_gauge(i)
+                    return
+                except queue.Full:
+                    log.warning('worker queue full, spilling to redis', extra={'stream': self.name, 'worker': i})
+            self.rdb.rpush(self.spill_key(i), self.encode(item))
+            self.spilled[i] += 1
+            self.spills.inc()
+        self.update_gauge(i)
+
+    def unspill(self, i: int):
+        """
+        next spilled item of worker i, None when there is none.
+        """
+        with self.locks[i]:
+            if not self.spilled[i]:
+                return None
+            raw = self.rdb.lpop(self.spill_key(i))
+            if raw is None:
+                log.error('spill list lost, entries are re-read from the pending list on restart',
+                          extra={'stream': self.name, 'worker': i, 'spilled': self.spilled[i]})
+                self.spilled[i] = 0
+                return None
+            self.spilled[i] -= 1
+        return self.decode(raw)
+
+    def next_item(self, i: int):
+        try:
+            if self.spilled[i]:
+                return self.queues[i].get_nowait()
+            return self.queues[i].get(timeout=1)
+        except queue.Empty:
+            return self.unspill(i)
+
+    def work(self, i: int):
+        while True:
+            try:
+                item = self.next_item(i)
+            except redis.RedisError:
+                log.exception('spill read failed', extra={'stream': self.name, 'worker': i})
+                time.sleep(1)
+                continue
+            if item is None:
+                continue
+            self.update_gauge(i)
+            try:
+                self.handler(item)
+            except Exception:
+                log.exception('worker failed', extra={'stream': self.name, 'worker': i})
+
+    def start(self):
+        if self.policy == 'spill':
+            self.rdb.delete(*[self.spill_key(i) for i in range(self.workers)])
+        for i in range(self.workers):
+            threading.Thread(target=self.work, args=(i,), name=f'{self.name}-{i}', daemon=True).start()
+
+
+class ChirpQueuedStreamDispatcher(ChirpStreamDispatcher):
+    """
+    ChirpStreamDispatcher with the handlers moved off the reader thread.
+
+    the reader only reads, parses and hands entries to a ChirpWorkerPool per
+    stream, keyed by the key registered for the field (the dev_eui), so a
+    slow handler (postgres, grpc, hpr) only holds up entries of its own
+    worker. entries are acknowledged by the reader once a worker has handled
+    them. with the block policy a stream is left out of the reads while any
+    of its queues is full.
+    """
+    def __init__(
+            self,
+            *args,
+            workers: int = 4,
+            depth: int = 1000,
+            policy: str = 'block',
+            **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.workers = workers
+        self.depth = depth
+        self.policy = policy
+        self.pools = {}
+        # stream_key -> IDs handed to a worker and not acknowledged yet.
+        self.inflight = {}
+        self.done = queue.SimpleQueue()
+        # acks released by an ack gate, sent from the reader thread.
+        self.released = queue.SimpleQueue()
+
+    def start_pools(self):
+        for stream_key in self.registry:
+            self.inflight[stream_key] = set()
+            self.pools[stream_key] = ChirpWorkerPool(
+                name=stream_key,
+                handler=self.work,
+                workers=self.workers,
+                depth=self.depth,
+                policy=self.policy,
+                rdb=self.rdb,
+                spill_prefix=f'{self.group}:spill:{self.consumer}',
+                encode=self.encode,
+                decode=self.decode
+            )
+            self.pools[stream_key].start()
+
+    def encode(self, item: tuple) -> str:
+        stream_key, msg_id, fields, _ = item
+        return ujson.dumps([stream_key, msg_id.decode(),
+                            {field.decode(): base64.b64encode(value).decode() for field, value in fields.items()}])
+
+    def decode(self, raw) -> tuple:
+        stream_key, msg_id, fields = ujson.loads(raw)
+        return stream_key, msg_id.encode(), {field.encode(): base64.b64decode(value)
+                                             for field, value in fields.items()}, None
+
+    def readable(self, stream_key: str) -> bool:
+        return super().readable(stream_key) and (self.policy != 'block' or not self.pools[stream_key].full())
+
+    def batches(self, resp) -> list[tuple[str, list]]:
+        """
+        re-reads of the pending list also return entries still queued for a
+        worker or held by an ack gate, those are skipped. the re-read goes on
+        from the last ID returned, so pending entries behind a full page of
+        in-flight ones are still reached.
+        """
+        batches = []
+        for stream_key, messages in super().batches(resp):
+            inflight = self.inflight[stream_key]
+            fresh = [message for message in messages if message[0] not in inflight]
+            if fresh:
+                batches.append((stream_key, fresh))
+        return batches
+
+    def retry(self, batches: list, failures: int) -> int:
+        """
+        entries that reached a worker are acknowledged by ack_done, only the
+        rest of the failed batches is dropped after max_retries.
+        """
+        batches = [(stream_key, [message for message in messages if message[0] not in self.inflight[stream_key]])
+                   for stream_key, messages in batches]
+        return super().retry([(stream_key, messages) for stream_key, messages in batches if messages], failures)
+
+    def message_key(self, stream_key: str, parsed: list[tuple]):
+        for field, pl in parsed:
+            key = self.keys.get((stream_key, field))
+            if key is not None:
+                return key(pl)
+        return None
+
+    def submit(self, stream_key: str, messages: list):
+        pool = self.pools[stream_key]
+        inflight = self.inflight[stream_key]
+        for message in messages:
+            parsed = self.parse(stream_key, message)
+            inflight.add(message[0])
+            try:
+                pool.submit(self.message_key(stream_key, parsed), (stream_key, message[0], message[1], parsed))
+            except Exception:
+                inflight.discard(message[0])
+                raise
+
+    def work(self, item: tuple):
+        stream_key, msg_id, fields, parsed = item
+        try:
+            if parsed is None:
+                parsed = self.parse(stream_key, (msg_id, fields), count=False)
+            self.handle(stream_key, msg_id.decode(), parsed)
+        finally:
+            self.done.put((stream_key, msg_id))
+
+    def release(self, acks: dict):
+        self.released.put(acks)
+
+    def owned(self) -> dict[str, list]:
+        # in flight covers queued, spilled, running and held entries.
+        return {stream_key: list(inflight) for stream_key, inflight in self.inflight.items() if inflight}
+
+    def ack_done(self):
+        """
+        acknowledge every entry the workers finished, one XACK per stream.
+        entries of gated streams are held and stay in flight until released.
+        """
+        done = {}
+        while True:
+            try:
+                stream_key, msg_id = self.done.get_nowait()
+            except queue.Empty:
+                break
+            done.setdefault(stream_key, []).append(msg_id)
+        done = list(done.items())
+        for i, (stream_key, msg_ids) in enumerate(done):
+            self.last_ids[stream_key] = max(msg_ids, key=stream_id_seconds)
+            if stream_key in self.ack_gates:
+                self.ack_gates[stream_key].hold(stream_key, msg_ids)
+                continue
+            try:
+                self.rdb.xack(stream_key, self.group, *msg_ids)
+            except redis.RedisError:
+                # this and the following streams go back on the done queue for the next round.
+                for key, ids in done[i:]:
+                    for msg_id in ids:
+                        self.done.put((key, msg_id))
+                raise
+            self.inflight[stream_key].difference_update(msg_ids)
+        while True:
+            try:
+                acks = self.released.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                for stream_key, msg_ids in acks.items():
+                    self.rdb.xack(stream_key, self.group, *msg_ids)
+                    self.inflight[stream_key].difference_update(msg_ids)
+            except redis.RedisError:
+                # XACK is idempotent, the whole set goes again on the next round.
+                self.released.put(acks)
+                raise
+
+    def run(self):
+        """
+        read, queue and acknowledge forever, after_batch callbacks, the lag
+        gauges and claims run on the reader thread as in ChirpStreamDispatcher.run.
+        """
+        self.create_groups()
+        self.start_pools()
+        failures = 0
+        while True:
+            batches = []
+            try:
+                batches = self.read()
+                for stream_key, messages in batches:
+                    self.submit(stream_key, messages)
+                self.ack_done()
+                failures = 0
+            except Exception:
+                log.exception('stream read failed', extra={'group': self.group})
+                failures = self.retry(batches, failures + 1)
+                time.sleep(1)
+                continue
+            for callback in self.after_batch:
+                try:
+                    callback()
+                except Exception:
+                    log.exception('after batch callback failed', extra={'callback': callback.__name__})
+            if self.lag_due():
+                self.update_lag()
+            if self.touch_due():
+                self.touch()
+            if self.claim_due():
+                self.claim()
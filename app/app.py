@@ -1,9 +1,29 @@
 import os
+import asyncio
+import logging
+import redis.asyncio as aioredis
+import signal
+import socket
 import time
+import threading
 from concurrent.futures import ThreadPoolExecutor
-from ChirpHeliumRequests import ChirpstackStreams
+from ChirpHeliumRequests import ChirpstackStreams, rdb
 from ChirpHeliumKeys import ChirpDeviceKeys
 from ChirpHeliumTenant import ChirpstackTenant
+from ChirpHeliumCredits import ChirpDcAccumulator, ChirpBalanceIndex
+from ChirpHeliumPool import ChirpPostgresPool
+from ChirpHeliumGrpc import ChirpstackClient
+from ChirpHeliumSync import ChirpDeviceSync, ChirpSessionRefresher, ChirpTenantDisabler
+from ChirpHeliumSessions import ChirpSessionLoader
+from ChirpHeliumCache import ChirpDeviceCache
+from ChirpHeliumRoute import ChirpHprRunner, ChirpHprBackend, ChirpRouteUpdater
+from ChirpHeliumConfig import ChirpConfigServiceBackend
+from ChirpHeliumReader import ChirpStreamDispatcher
+from ChirpHeliumWorkers import ChirpQueuedStreamDispatcher
+from ChirpHeliumLeader import ChirpLeaderLock
+from ChirpHeliumAsync import ChirpAsyncBridge, ChirpAsyncDcAccumulator, ChirpAsyncStreamDispatcher
+from ChirpHeliumLog import setup_logging, parse_event_rates, report_suppressed
+from ChirpHeliumMetrics import ChirpMetricsServer, JOB_SECONDS, JOB_INTERVAL, JOB_ERRORS
 
 
 if __name__ == '__main__':
@@ -12,65 +32,313 @@ if __name__ == '__main__':
     postgres_user = os.getenv('POSTGRES_USER')
     postgres_pass = os.getenv('POSTGRES_PASS')
     postgres_name = os.getenv('POSTGRES_DB')
+    redis_host = os.getenv('REDIS_HOST')
     chirpstack_host = os.getenv('CHIRPSTACK_SERVER')
     chirpstack_token = os.getenv('CS_APIKEY')
+    stream_batch_size = int(os.getenv('STREAM_BATCH_SIZE', 100))
+    stream_block_ms = int(os.getenv('STREAM_BLOCK_MS', 1000))
+    stream_group = os.getenv('STREAM_GROUP', 'chirpstack-hpr')
+    stream_consumer = os.getenv('STREAM_CONSUMER') or socket.gethostname()
+    stream_start = os.getenv('STREAM_START', 'checkpoint')
+    stream_lag_interval = float(os.getenv('STREAM_LAG_INTERVAL', 15))
+    stream_workers = int(os.getenv('STREAM_WORKERS', 4))
+    stream_queue_depth = int(os.getenv('STREAM_QUEUE_DEPTH', 1000))
+    stream_queue_policy = os.getenv('STREAM_QUEUE_POLICY', 'block')
+    stream_claim_idle_ms = int(os.getenv('STREAM_CLAIM_IDLE_MS', 60000))
+    leader_ttl = float(os.getenv('LEADER_TTL', 30))
+    dc_flush_size = int(os.getenv('DC_FLUSH_SIZE', 1000))
+    dc_flush_interval = float(os.getenv('DC_FLUSH_INTERVAL', 5))
+    dc_rollup_interval = int(os.getenv('DC_ROLLUP_INTERVAL', 60))
+    dc_disable_tenants = os.getenv('DC_DISABLE_TENANTS', 'false').lower() == 'true'
+    dc_disable_threshold = int(os.getenv('DC_DISABLE_THRESHOLD', 0))
+    dc_balance_refresh = int(os.getenv('DC_BALANCE_REFRESH', 60))
+    pool_min_size = int(os.getenv('POSTGRES_POOL_MIN', 1))
+    pool_max_size = int(os.getenv('POSTGRES_POOL_MAX', 10))
+    pool_check_interval = float(os.getenv('POSTGRES_POOL_CHECK', 30))
+    grpc_timeout = float(os.getenv('CHIRPSTACK_TIMEOUT', 10))
+    sync_concurrency = int(os.getenv('SYNC_CONCURRENCY', 8))
+    sync_rate_limit = float(os.getenv('SYNC_RATE_LIMIT', 50))
+    sync_batch_size = int(os.getenv('SYNC_BATCH_SIZE', 500))
+    sync_full_every = int(os.getenv('SYNC_FULL_EVERY', 12))
+    sync_loader = os.getenv('SYNC_LOADER', 'grpc')
+    skfs_dry_run = os.getenv('SKFS_DRY_RUN', 'false').lower() == 'true'
+    skfs_reconcile_interval = int(os.getenv('SKFS_RECONCILE_INTERVAL', 3600))
+    hpr_path = os.getenv('HPR_PATH', 'hpr')
+    hpr_timeout = float(os.getenv('HPR_TIMEOUT', 120))
+    hpr_batch_size = int(os.getenv('HPR_BATCH_SIZE', 500))
+    hpr_concurrency = int(os.getenv('HPR_CONCURRENCY', 4))
+    route_backend = os.getenv('HELIUM_ROUTE_BACKEND', 'cli')
+    helium_config_host = os.getenv('HELIUM_CONFIG_HOST')
+    helium_keypair = os.getenv('HELIUM_KEYPAIR_BIN')
+    bridge_runtime = os.getenv('BRIDGE_RUNTIME', 'threads')
+    blocking_concurrency = int(os.getenv('BLOCKING_CONCURRENCY', 4))
+    log_level = os.getenv('LOG_LEVEL', 'INFO')
+    log_format = os.getenv('LOG_FORMAT', 'json')
+    log_sample = parse_event_rates(os.getenv('LOG_SAMPLE', ''))
+    log_rate_limit = parse_event_rates(os.getenv('LOG_RATE_LIMIT', '*=10'))
+    metrics_port = int(os.getenv('METRICS_PORT', 9102))
+    device_cache_size = int(os.getenv('DEVICE_CACHE_SIZE', 100000))
+    device_cache_ttl = float(os.getenv('DEVICE_CACHE_TTL', 3600))
+    api_coalesce_window = float(os.getenv('API_COALESCE_WINDOW', 2))
+    api_coalesce_size = int(os.getenv('API_COALESCE_SIZE', 5000))
 
-    client_streams = ChirpstackStreams(
-        route_id=route_id,
+    log_listener = setup_logging(
+        level=log_level,
+        fmt=log_format,
+        sample=log_sample,
+        rate_limits=log_rate_limit
+    )
+    log = logging.getLogger('app')
+
+    db_pool = ChirpPostgresPool(
         postgres_host=postgres_host,
         postgres_user=postgres_user,
         postgres_pass=postgres_pass,
         postgres_name=postgres_name,
+        min_size=pool_min_size,
+        max_size=pool_max_size,
+        check_interval=pool_check_interval
+    )
+
+    cs_client = ChirpstackClient(
         chirpstack_host=chirpstack_host,
-        chirpstack_token=chirpstack_token
+        chirpstack_token=chirpstack_token,
+        timeout=grpc_timeout
+    )
+
+    if route_backend == 'grpc':
+        backend = ChirpConfigServiceBackend(
+            config_host=helium_config_host,
+            keypair_path=helium_keypair,
+            timeout=hpr_timeout
+        )
+    else:
+        backend = ChirpHprBackend(
+            runner=ChirpHprRunner(hpr_path=hpr_path, timeout=hpr_timeout),
+            skfs_batch_size=hpr_batch_size
+        )
+
+    route_updater = ChirpRouteUpdater(
+        route_id=route_id,
+        backend=backend,
+        concurrency=hpr_concurrency
+    )
+
+    device_cache = ChirpDeviceCache(
+        db_pool=db_pool,
+        maxsize=device_cache_size,
+        ttl=device_cache_ttl
     )
 
     client_keys = ChirpDeviceKeys(
         route_id=route_id,
-        postgres_host=postgres_host,
-        postgres_user=postgres_user,
-        postgres_pass=postgres_pass,
-        postgres_name=postgres_name,
-        chirpstack_host=chirpstack_host,
-        chirpstack_token=chirpstack_token
+        db_pool=db_pool,
+        chirpstack_client=cs_client,
+        route_updater=route_updater,
+        skfs_dry_run=skfs_dry_run,
+        device_cache=device_cache
+    )
+
+    session_refresher = ChirpSessionRefresher(client_keys=client_keys)
+
+    balance_index = None
+    if dc_disable_tenants:
+        balance_index = ChirpBalanceIndex(
+            db_pool=db_pool,
+            threshold=dc_disable_threshold,
+            on_crossing=ChirpTenantDisabler(client_keys=client_keys).submit
+        )
+
+    client_streams = ChirpstackStreams(
+        route_id=route_id,
+        db_pool=db_pool,
+        chirpstack_client=cs_client,
+        route_updater=route_updater,
+        session_refresher=session_refresher,
+        balance_index=balance_index,
+        device_cache=device_cache,
+        coalesce_window=api_coalesce_window,
+        coalesce_size=api_coalesce_size,
+        lookup_concurrency=sync_concurrency
+    )
+
+    session_loader = None
+    if sync_loader == 'sql':
+        session_loader = ChirpSessionLoader(db_pool=db_pool, rdb=rdb)
+
+    device_sync = ChirpDeviceSync(
+        client_keys=client_keys,
+        concurrency=sync_concurrency,
+        rate_limit=sync_rate_limit,
+        batch_size=sync_batch_size,
+        full_every=sync_full_every,
+        loader=session_loader
     )
 
+    if bridge_runtime == 'asyncio':
+        dc_accumulator = ChirpAsyncDcAccumulator(
+            max_pending=dc_flush_size,
+            flush_interval=dc_flush_interval,
+            balance_index=balance_index
+        )
+    else:
+        dc_accumulator = ChirpDcAccumulator(
+            db_pool=db_pool,
+            max_pending=dc_flush_size,
+            flush_interval=dc_flush_interval,
+            balance_index=balance_index
+        )
+
     tenant = ChirpstackTenant(
         route_id=route_id,
-        postgres_host=postgres_host,
-        postgres_user=postgres_user,
-        postgres_pass=postgres_pass,
-        postgres_name=postgres_name,
-        chirpstack_host=chirpstack_host,
-        chirpstack_token=chirpstack_token
+        db_pool=db_pool,
+        dc_accumulator=dc_accumulator,
+        session_refresher=session_refresher,
+        balance_index=balance_index,
+        device_cache=device_cache
     )
 
-    def run_every(fn: str, interval: int):
-        name = str(fn)
+    # replicas share the stream consumer group, one of them runs the singleton jobs.
+    leader = ChirpLeaderLock(
+        rdb=rdb,
+        key=f'{stream_group}:leader',
+        holder=stream_consumer,
+        ttl=leader_ttl
+    )
+
+    if bridge_runtime == 'asyncio':
+        dispatcher = ChirpAsyncStreamDispatcher(
+            rdb=aioredis.Redis(host=redis_host, port=6379, db=0),
+            group=stream_group,
+            consumer=stream_consumer,
+            start=stream_start,
+            batch_size=stream_batch_size,
+            block_ms=stream_block_ms,
+            lag_interval=stream_lag_interval,
+            leader=leader,
+            claim_idle_ms=stream_claim_idle_ms
+        )
+    elif stream_workers:
+        dispatcher = ChirpQueuedStreamDispatcher(
+            rdb=rdb,
+            group=stream_group,
+            consumer=stream_consumer,
+            start=stream_start,
+            batch_size=stream_batch_size,
+            block_ms=stream_block_ms,
+            lag_interval=stream_lag_interval,
+            leader=leader,
+            claim_idle_ms=stream_claim_idle_ms,
+            workers=stream_workers,
+            depth=stream_queue_depth,
+            policy=stream_queue_policy
+        )
+    else:
+        dispatcher = ChirpStreamDispatcher(
+            rdb=rdb,
+            group=stream_group,
+            consumer=stream_consumer,
+            start=stream_start,
+            batch_size=stream_batch_size,
+            block_ms=stream_block_ms,
+            lag_interval=stream_lag_interval,
+            leader=leader,
+            claim_idle_ms=stream_claim_idle_ms
+        )
+    tenant.register(dispatcher)
+    client_streams.register(dispatcher)
+
+    def run_every(fn, interval: int):
+        name = fn.__name__
+        JOB_INTERVAL.labels(name).set(interval)
+        duration = JOB_SECONDS.labels(name)
         while True:
             try:
                 start = time.time()
                 fn()
-                print(f'{time.ctime()} Executing: {name}, sleeping: {interval} seconds.')
                 stop = time.time()
-                time.sleep(interval - (stop - start))
-            except Exception as err:
-                print(f'{name} Error: {err}')
-                pass
+                duration.observe(stop - start)
+                log.info('job done', extra={'job': name, 'interval': interval, 'duration': round(stop - start, 2)})
+                time.sleep(max(0, interval - (stop - start)))
+            except Exception:
+                JOB_ERRORS.labels(name).inc()
+                log.exception('job failed', extra={'job': name})
 
     def update_device_status():
-        updates = list(map(client_keys.get_merged_keys, client_keys.fetch_all_devices()))
-        print('\n'.join(updates))
+        device_sync.sync()
         return
 
+    def close_coalescer():
+        if client_streams.coalescer is None:
+            return
+        try:
+            client_streams.coalescer.close()
+        except Exception:
+            log.exception('api device batch on shutdown failed')
+
+    def shutdown(signum, frame):
+        log.info('received shutdown signal, flushing dc debits', extra={'signal': signum})
+        close_coalescer()
+        try:
+            dc_accumulator.close()
+        except Exception:
+            log.exception('dc flush on shutdown failed')
+        leader.release()
+        log_listener.stop()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
     interval = 60 * 30  # 30 minutes
 
     client_streams.create_tables()
     client_streams.update_tenant_table()
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        executor.submit(client_streams.api_stream_requests)
-        executor.submit(tenant.device_stream_event)
-        executor.submit(tenant.stream_meta)
-        executor.submit(run_every, client_keys.helium_skfs_update, 600)
-        executor.submit(run_every, update_device_status, 300)
+    # take the lease before the jobs start, so a single replica runs them right away.
+    leader.acquire()
+    threading.Thread(target=leader.run, daemon=True).start()
+    if balance_index is not None:
+        # other replicas' debits only reach this index through postgres.
+        threading.Thread(target=run_every, args=(balance_index.load, dc_balance_refresh), daemon=True).start()
+    if client_streams.coalescer is not None:
+        threading.Thread(target=client_streams.coalescer.run, daemon=True).start()
+
+    if bridge_runtime == 'asyncio':
+        bridge = ChirpAsyncBridge(
+            route_id=route_id,
+            dispatcher=dispatcher,
+            client_keys=client_keys,
+            device_sync=device_sync,
+            dc_accumulator=dc_accumulator,
+            postgres_dsn=db_pool.postges,
+            chirpstack_host=chirpstack_host,
+            chirpstack_token=chirpstack_token,
+            grpc_timeout=grpc_timeout,
+            pool_min_size=pool_min_size,
+            pool_max_size=pool_max_size,
+            hpr_path=hpr_path,
+            hpr_timeout=hpr_timeout,
+            hpr_concurrency=hpr_concurrency,
+            blocking_concurrency=blocking_concurrency,
+            skfs_reconcile_interval=skfs_reconcile_interval,
+            sync_interval=300,
+            dc_rollup_interval=dc_rollup_interval,
+            metrics_port=metrics_port,
+            leader=leader
+        )
+        asyncio.run(bridge.run())
+        close_coalescer()
+        leader.release()
+        log_listener.stop()
+        os._exit(0)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        if metrics_port:
+            executor.submit(ChirpMetricsServer(port=metrics_port).run)
+        executor.submit(dispatcher.run)
+        executor.submit(dc_accumulator.run)
+        executor.submit(run_every, leader.only(dc_accumulator.rollup), dc_rollup_interval)
+        executor.submit(run_every, leader.only(client_keys.helium_skfs_update), skfs_reconcile_interval)
+        executor.submit(run_every, leader.only(update_device_status), 300)
+        executor.submit(run_every, report_suppressed, 60)
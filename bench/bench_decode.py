@@ -0,0 +1,155 @@
+"""
+stream message decode + handle cost per message type, MessageToDict vs
+reading the parsed protobuf directly.
+
+builds realistic device:stream:event and stream:meta payloads and runs them
+through the previous dict based handlers and the ChirpstackTenant ones.
+
+    python bench/bench_decode.py --messages 20000
+"""
+import os
+import sys
+import time
+import base64
+import argparse
+from math import ceil
+from google.protobuf.json_format import MessageToDict
+from chirpstack_api import integration, meta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from ChirpHeliumTenant import ChirpstackTenant  # noqa: E402
+
+
+class NullAccumulator:
+    def debit_tenant(self, msg_id: str, kind: str, tenant_id: str, dev_eui: str, dc: int):
+        pass
+
+    def debit_device(self, msg_id: str, kind: str, dev_eui: str, dc: int, tenant_id: str = None):
+        pass
+
+
+def device_info(pl):
+    pl.device_info.tenant_id = '52f14cd4-c6f1-4fbd-8f87-4025e1d49242'
+    pl.device_info.tenant_name = 'bench tenant'
+    pl.device_info.application_id = '8b8c0c5c-7e4a-4b0e-9b4a-6ad1a1a6a0f1'
+    pl.device_info.device_name = 'bench device'
+    pl.device_info.dev_eui = '0102030405060708'
+    pl.device_info.tags['site'] = 'bench'
+
+
+def uplink_event() -> bytes:
+    pl = integration.UplinkEvent()
+    device_info(pl)
+    pl.dev_addr = '48000001'
+    pl.f_cnt = 42
+    pl.f_port = 1
+    pl.data = os.urandom(32)
+    for i in range(3):
+        rx = pl.rx_info.add()
+        rx.gateway_id = f'{i:016x}'
+        rx.rssi = -80 - i
+        rx.snr = 7.5
+        rx.metadata['region_common_name'] = 'EU868'
+    pl.tx_info.frequency = 868100000
+    return pl.SerializeToString()
+
+
+def join_event() -> bytes:
+    pl = integration.JoinEvent()
+    device_info(pl)
+    pl.dev_addr = '48000001'
+    return pl.SerializeToString()
+
+
+def status_event() -> bytes:
+    pl = integration.StatusEvent()
+    device_info(pl)
+    pl.margin = 10
+    pl.battery_level = 87.5
+    return pl.SerializeToString()
+
+
+def uplink_meta() -> bytes:
+    pl = meta.meta_pb2.UplinkMeta()
+    pl.dev_eui = '0102030405060708'
+    pl.phy_payload_byte_count = 45
+    pl.mac_command_byte_count = 0
+    pl.application_payload_byte_count = 32
+    for i in range(3):
+        rx = pl.rx_info.add()
+        rx.gateway_id = f'{i:016x}'
+        rx.rssi = -80 - i
+    return pl.SerializeToString()
+
+
+def downlink_meta() -> bytes:
+    pl = meta.meta_pb2.DownlinkMeta()
+    pl.dev_eui = '0102030405060708'
+    pl.phy_payload_byte_count = 25
+    pl.mac_command_byte_count = 0
+    pl.application_payload_byte_count = 12
+    pl.gateway_id = f'{0:016x}'
+    pl.tx_info.frequency = 869525000
+    pl.tx_info.power = 27
+    return pl.SerializeToString()
+
+
+# the previous handlers, every message converted with MessageToDict first.
+def dict_event_up(pl, msg_id: str) -> int:
+    data = MessageToDict(pl)
+    tenant_id = data['deviceInfo']['tenantId']
+    total_dc = len(data['rxInfo']) * ceil(len(base64.b64decode(data['data'])) / 24)
+    return tenant_id and total_dc
+
+
+def dict_event_join(pl, msg_id: str) -> int:
+    data = MessageToDict(pl)
+    return data['deviceInfo']['tenantId'] and 1
+
+
+def dict_event_status(pl, msg_id: str) -> int:
+    data = MessageToDict(pl)
+    return data['deviceInfo']['tenantId'] and 1
+
+
+def dict_meta_up(pl, msg_id: str) -> int:
+    data = MessageToDict(pl)
+    return len(data['rxInfo']) * ceil(data['phyPayloadByteCount'] / 24)
+
+
+def dict_meta_down(pl, msg_id: str) -> int:
+    data = MessageToDict(pl)
+    return data['devEui'] and ceil(data['phyPayloadByteCount'] / 24)
+
+
+def run(name: str, message_type, raw: bytes, handler, messages: int) -> float:
+    start = time.perf_counter()
+    for _ in range(messages):
+        handler(message_type.FromString(raw), '1700000000000-0')
+    elapsed = time.perf_counter() - start
+    return elapsed / messages * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000, help='messages per type')
+    args = parser.parse_args()
+
+    tenant = ChirpstackTenant(route_id='bench', db_pool=None, dc_accumulator=NullAccumulator())
+    cases = [
+        ('event up', integration.UplinkEvent, uplink_event(), dict_event_up, tenant.event_up),
+        ('event join', integration.JoinEvent, join_event(), dict_event_join, tenant.event_join),
+        ('event status', integration.StatusEvent, status_event(), dict_event_status, tenant.event_status),
+        ('meta up', meta.meta_pb2.UplinkMeta, uplink_meta(), dict_meta_up, tenant.meta_up),
+        ('meta down', meta.meta_pb2.DownlinkMeta, downlink_meta(), dict_meta_down, tenant.meta_down),
+    ]
+    print(f'{args.messages} messages per type, usec per message')
+    print(f'{"type":<13} {"MessageToDict":>14} {"protobuf":>10} {"speedup":>8}')
+    for name, message_type, raw, dict_handler, handler in cases:
+        before = run(name, message_type, raw, dict_handler, args.messages)
+        after = run(name, message_type, raw, handler, args.messages)
+        print(f'{name:<13} {before:>14.2f} {after:>10.2f} {before / after:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
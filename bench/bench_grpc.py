@@ -0,0 +1,90 @@
+"""
+chirpstack grpc call rate, a channel per call vs the shared ChirpstackClient.
+
+starts an in-process DeviceService on localhost and times Get + GetActivation
+pairs (what get_merged_keys makes per device) from one or more threads.
+
+    python bench/bench_grpc.py --calls 2000 --threads 8
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent import futures
+import grpc
+from chirpstack_api import api
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from ChirpHeliumGrpc import ChirpstackClient  # noqa: E402
+
+
+class DeviceService(api.DeviceServiceServicer):
+    def Get(self, request, context):
+        resp = api.GetDeviceResponse()
+        resp.device.dev_eui = request.dev_eui
+        resp.device.join_eui = '0000000000000000'
+        resp.device.name = f'bench-{request.dev_eui}'
+        return resp
+
+    def GetActivation(self, request, context):
+        resp = api.GetDeviceActivationResponse()
+        resp.device_activation.dev_eui = request.dev_eui
+        resp.device_activation.dev_addr = '48000001'
+        resp.device_activation.nwk_s_enc_key = '00' * 16
+        return resp
+
+
+def per_call_channel(host: str, auth_token: list, dev_eui: str):
+    # the previous pattern, a new channel (and HTTP/2 connection) for every call.
+    with grpc.insecure_channel(host) as channel:
+        client = api.DeviceServiceStub(channel)
+        req = api.GetDeviceRequest()
+        req.dev_eui = dev_eui
+        client.Get(req, metadata=auth_token)
+    with grpc.insecure_channel(host) as channel:
+        client = api.DeviceServiceStub(channel)
+        req = api.GetDeviceActivationRequest()
+        req.dev_eui = dev_eui
+        client.GetActivation(req, metadata=auth_token)
+
+
+def shared_channel(cs_client: ChirpstackClient, dev_eui: str):
+    cs_client.get_device(dev_eui)
+    cs_client.get_device_activation(dev_eui)
+
+
+def run(name: str, fn, calls: int, threads: int):
+    dev_euis = [f'{i:016x}' for i in range(calls)]
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(fn, dev_euis))
+    elapsed = time.perf_counter() - start
+    # every device costs two rpcs.
+    print(f'{name:<18} {calls * 2 / elapsed:>10.1f} calls/sec  ({elapsed:.2f}s)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=1000, help='devices to look up')
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+    api.add_DeviceServiceServicer_to_server(DeviceService(), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    host = f'127.0.0.1:{port}'
+
+    auth_token = [('authorization', 'Bearer bench')]
+    cs_client = ChirpstackClient(chirpstack_host=host, chirpstack_token='bench')
+    try:
+        print(f'{args.calls} devices, {args.threads} threads')
+        run('channel per call', lambda dev_eui: per_call_channel(host, auth_token, dev_eui), args.calls, args.threads)
+        run('shared channel', lambda dev_eui: shared_channel(cs_client, dev_eui), args.calls, args.threads)
+    finally:
+        cs_client.close()
+        server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
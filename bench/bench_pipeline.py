@@ -0,0 +1,370 @@
+"""
+stream pipeline throughput, redis stream -> dispatcher -> tenant handlers ->
+dc accumulator -> postgres.
+
+fills device:stream:event and stream:meta with synthetic UplinkEvent,
+JoinEvent, StatusEvent, UplinkMeta and DownlinkMeta payloads for a fleet of
+devices, reads them back through ChirpStreamDispatcher with the
+ChirpstackTenant handlers registered, and reports msgs/sec, p50/p99 handler
+latency per event type and postgres statements per message, including the
+ledger flushes and one final balance rollup.
+
+streams live in an in-process fake unless --redis-host is given. postgres is
+required, point it at a scratch database, helium_tenant and helium_devices are
+created and seeded with the bench fleet.
+
+    python bench/bench_pipeline.py --messages 50000 --devices 1000 --dupes 3
+    python bench/bench_pipeline.py --rate 2000 --redis-host localhost
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+import psycopg2.extensions
+import psycopg2.extras
+import redis
+from chirpstack_api import integration, meta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from ChirpHeliumPool import ChirpPostgresPool  # noqa: E402
+from ChirpHeliumCredits import ChirpDcAccumulator  # noqa: E402
+from ChirpHeliumReader import ChirpStreamDispatcher  # noqa: E402
+from ChirpHeliumRequests import ChirpstackStreams  # noqa: E402
+from ChirpHeliumTenant import ChirpstackTenant  # noqa: E402
+
+
+EVENT_STREAM = 'device:stream:event'
+META_STREAM = 'stream:meta'
+# message kind -> (stream, field)
+KINDS = {
+    'up': (EVENT_STREAM, 'up'),
+    'join': (EVENT_STREAM, 'join'),
+    'status': (EVENT_STREAM, 'status'),
+    'meta_up': (META_STREAM, 'up'),
+    'meta_down': (META_STREAM, 'down'),
+}
+HANDLERS = {
+    'event_up': 'up',
+    'event_join': 'join',
+    'event_status': 'status',
+    'meta_up': 'meta_up',
+    'meta_down': 'meta_down',
+}
+
+
+def entry_seq(entry_id) -> tuple:
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return tuple(int(part) for part in entry_id.split('-'))
+
+
+class FakeStreams:
+    """
+    just enough of redis streams and consumer groups for one dispatcher:
+    XADD, XGROUP CREATE/SETID, XREADGROUP with '>' and a pending start ID, XACK and XINFO.
+    replies are shaped like redis-py's without decode_responses.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.streams = {}
+        # (stream, group) -> [next undelivered index, {pending id: fields}]
+        self.groups = {}
+        self.seq = 0
+
+    def xadd(self, stream: str, fields: dict, **kwargs) -> bytes:
+        with self.cond:
+            self.seq += 1
+            entry_id = f'{int(time.time() * 1000)}-{self.seq}'.encode()
+            entry = (entry_id, {key.encode(): value for key, value in fields.items()})
+            self.streams.setdefault(stream, []).append(entry)
+            self.cond.notify_all()
+        return entry_id
+
+    def xgroup_create(self, stream: str, group: str, id: str = '$', mkstream: bool = False):
+        with self.cond:
+            entries = self.streams.setdefault(stream, [])
+            if (stream, group) in self.groups:
+                raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+            self.groups[(stream, group)] = [len(entries) if id == '$' else 0, {}]
+
+    def xgroup_setid(self, stream: str, group: str, id: str):
+        with self.cond:
+            self.groups[(stream, group)][0] = len(self.streams[stream]) if id == '$' else 0
+
+    def read_stream(self, stream: str, group: str, stream_id: str, count: int) -> list:
+        state = self.groups[(stream, group)]
+        if stream_id != '>':
+            after = entry_seq(stream_id)
+            return [entry for entry in state[1].items() if entry_seq(entry[0]) > after][:count]
+        entries = self.streams[stream][state[0]:state[0] + count]
+        state[0] += len(entries)
+        state[1].update(entries)
+        return entries
+
+    def xreadgroup(self, group: str, consumer: str, streams: dict, count: int = None, block: int = None) -> list:
+        deadline = time.monotonic() + (block or 0) / 1000
+        with self.cond:
+            while True:
+                resp = [[stream.encode(), self.read_stream(stream, group, stream_id, count)]
+                        for stream, stream_id in streams.items()]
+                if any(messages for _, messages in resp) or any(sid != '>' for sid in streams.values()):
+                    return resp
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.cond.wait(remaining)
+
+    def xack(self, stream: str, group: str, *ids) -> int:
+        with self.cond:
+            pending = self.groups[(stream, group)][1]
+            return sum(pending.pop(entry_id, None) is not None for entry_id in ids)
+
+    def xinfo_groups(self, stream: str) -> list:
+        with self.cond:
+            return [{'name': group.encode(), 'lag': len(self.streams[key]) - state[0], 'pending': len(state[1]),
+                     'last-delivered-id': self.streams[key][state[0] - 1][0] if state[0] else b'0-0'}
+                    for (key, group), state in self.groups.items() if key == stream]
+
+    def xinfo_stream(self, stream: str) -> dict:
+        with self.cond:
+            entries = self.streams.get(stream) or [(b'0-0', {})]
+            return {'length': len(self.streams.get(stream, [])), 'last-generated-id': entries[-1][0]}
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    statements = 0
+
+    def execute(self, query, params=None):
+        CountingCursor.statements += 1
+        return super().execute(query, params)
+
+    def copy_expert(self, sql, file, size=8192):
+        CountingCursor.statements += 1
+        return super().copy_expert(sql, file, size)
+
+
+class CountingPool(ChirpPostgresPool):
+    """
+    ChirpPostgresPool counting every statement sent, execute_values pages and COPYs included.
+    """
+    @contextmanager
+    def connection(self):
+        with super().connection() as con:
+            con.cursor_factory = CountingCursor
+            yield con
+
+
+class Fleet:
+    """
+    synthetic devices spread over tenants, builds serialized payloads per kind.
+    """
+    def __init__(self, devices: int, tenants: int, dupes: int, payload_size: int):
+        self.tenant_ids = [str(uuid.uuid4()) for _ in range(tenants)]
+        self.devices = [(f'{i:016x}', self.tenant_ids[i % tenants], f'{0x48000000 + i:08x}') for i in range(devices)]
+        self.dupes = dupes
+        self.payload_size = payload_size
+
+    def device_info(self, pl, device: tuple):
+        dev_eui, tenant_id, _ = device
+        pl.device_info.tenant_id = tenant_id
+        pl.device_info.tenant_name = 'bench tenant'
+        pl.device_info.application_id = '8b8c0c5c-7e4a-4b0e-9b4a-6ad1a1a6a0f1'
+        pl.device_info.device_name = f'bench-{dev_eui}'
+        pl.device_info.dev_eui = dev_eui
+
+    def rx_info(self, pl):
+        for i in range(self.dupes):
+            rx = pl.rx_info.add()
+            rx.gateway_id = f'{i:016x}'
+            rx.rssi = -80 - i
+            rx.snr = 7.5
+
+    def up(self, device: tuple) -> bytes:
+        pl = integration.UplinkEvent()
+        self.device_info(pl, device)
+        pl.dev_addr = device[2]
+        pl.f_cnt = random.randint(0, 65535)
+        pl.f_port = 1
+        pl.data = os.urandom(self.payload_size)
+        self.rx_info(pl)
+        pl.tx_info.frequency = 868100000
+        return pl.SerializeToString()
+
+    def join(self, device: tuple) -> bytes:
+        pl = integration.JoinEvent()
+        self.device_info(pl, device)
+        pl.dev_addr = device[2]
+        return pl.SerializeToString()
+
+    def status(self, device: tuple) -> bytes:
+        pl = integration.StatusEvent()
+        self.device_info(pl, device)
+        pl.margin = 10
+        pl.battery_level = 87.5
+        return pl.SerializeToString()
+
+    def meta_up(self, device: tuple) -> bytes:
+        pl = meta.meta_pb2.UplinkMeta()
+        pl.dev_eui = device[0]
+        pl.phy_payload_byte_count = self.payload_size + 13
+        pl.application_payload_byte_count = self.payload_size
+        self.rx_info(pl)
+        return pl.SerializeToString()
+
+    def meta_down(self, device: tuple) -> bytes:
+        pl = meta.meta_pb2.DownlinkMeta()
+        pl.dev_eui = device[0]
+        pl.phy_payload_byte_count = 17
+        pl.application_payload_byte_count = 4
+        return pl.SerializeToString()
+
+    def message(self, kind: str) -> bytes:
+        return getattr(self, kind)(random.choice(self.devices))
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        if kind not in KINDS:
+            raise SystemExit(f'unknown message kind {kind}, expected one of {", ".join(KINDS)}')
+        mix[kind] = float(weight)
+    return mix
+
+
+def seed(db_pool: ChirpPostgresPool, fleet: Fleet):
+    ChirpstackStreams(route_id='bench', db_pool=db_pool, chirpstack_client=None, route_updater=None).create_tables()
+    with db_pool.connection() as con:
+        with con.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                'INSERT INTO helium_tenant (tenant_id, tenant_name, dc_balance) VALUES %s ON CONFLICT DO NOTHING;',
+                [(tenant_id, 'bench tenant', 10 ** 12) for tenant_id in fleet.tenant_ids]
+            )
+            psycopg2.extras.execute_values(
+                cur,
+                'INSERT INTO helium_devices (dev_eui, dev_addr) VALUES %s ON CONFLICT (dev_eui) DO NOTHING;',
+                [(dev_eui, dev_addr) for dev_eui, _, dev_addr in fleet.devices]
+            )
+
+
+def produce(rdb, fleet: Fleet, mix: dict, messages: int, rate: float):
+    kinds = random.choices(list(mix), weights=list(mix.values()), k=messages)
+    start = time.monotonic()
+    for i, kind in enumerate(kinds):
+        stream, field = KINDS[kind]
+        rdb.xadd(stream, {field: fleet.message(kind)}, maxlen=messages * 2, approximate=True)
+        if rate:
+            delay = start + (i + 1) / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def timing(handler, samples: list):
+    @functools.wraps(handler)
+    def timed(pl, msg_id: str):
+        start = time.perf_counter()
+        handler(pl, msg_id)
+        samples.append(time.perf_counter() - start)
+    return timed
+
+
+def percentile(samples: list, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=50000, help='messages to produce and consume')
+    parser.add_argument('--rate', type=float, default=0, help='produced msgs/sec, 0 prefills the streams first')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--tenants', type=int, default=10)
+    parser.add_argument('--dupes', type=int, default=3, help='rx_info entries per uplink')
+    parser.add_argument('--payload-size', type=int, default=32, help='uplink application payload bytes')
+    parser.add_argument('--mix', default='up=70,status=5,join=5,meta_up=15,meta_down=5',
+                        help='relative weight per message kind')
+    parser.add_argument('--batch-size', type=int, default=100, help='STREAM_BATCH_SIZE')
+    parser.add_argument('--flush-size', type=int, default=1000, help='DC_FLUSH_SIZE')
+    parser.add_argument('--flush-interval', type=float, default=5, help='DC_FLUSH_INTERVAL')
+    parser.add_argument('--redis-host', default='', help='use a real redis instead of the in-process fake')
+    parser.add_argument('--pg-host', default='localhost')
+    parser.add_argument('--pg-user', default='postgres')
+    parser.add_argument('--pg-pass', default='postgres')
+    parser.add_argument('--pg-db', default='helium_bench')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    fleet = Fleet(args.devices, args.tenants, args.dupes, args.payload_size)
+    rdb = redis.Redis(host=args.redis_host, port=6379, db=0) if args.redis_host else FakeStreams()
+    db_pool = CountingPool(
+        postgres_host=args.pg_host,
+        postgres_user=args.pg_user,
+        postgres_pass=args.pg_pass,
+        postgres_name=args.pg_db
+    )
+    seed(db_pool, fleet)
+
+    dc_accumulator = ChirpDcAccumulator(
+        db_pool=db_pool,
+        max_pending=args.flush_size,
+        flush_interval=args.flush_interval
+    )
+    tenant = ChirpstackTenant(route_id='bench', db_pool=db_pool, dc_accumulator=dc_accumulator)
+    samples = {kind: [] for kind in HANDLERS.values()}
+    for name, kind in HANDLERS.items():
+        setattr(tenant, name, timing(getattr(tenant, name), samples[kind]))
+    dispatcher = ChirpStreamDispatcher(
+        rdb=rdb,
+        group=f'bench-{os.getpid()}',
+        consumer='bench',
+        start='$',
+        batch_size=args.batch_size
+    )
+    tenant.register(dispatcher)
+    dispatcher.create_groups()
+
+    producer = threading.Thread(target=produce, args=(rdb, fleet, mix, args.messages, args.rate), daemon=True)
+    producer.start()
+    if not args.rate:
+        producer.join()
+
+    CountingCursor.statements = 0
+    consumed = 0
+    reads = 0
+    start = time.perf_counter()
+    while consumed < args.messages:
+        batches = dispatcher.read()
+        reads += 1
+        for stream_key, messages in batches:
+            dispatcher.dispatch(stream_key, messages)
+            dispatcher.ack(stream_key, messages)
+            consumed += len(messages)
+        for callback in dispatcher.after_batch:
+            callback()
+    dc_accumulator.flush()
+    dc_accumulator.rollup()
+    elapsed = time.perf_counter() - start
+
+    print(f'{consumed} messages, {args.devices} devices, {args.dupes} dupes, '
+          f'{"prefilled" if not args.rate else f"produced at {args.rate:.0f}/s"}, '
+          f'{"redis " + args.redis_host if args.redis_host else "in-process streams"}')
+    print(f'{consumed / elapsed:,.0f} msgs/sec, {reads} reads, {CountingCursor.statements} statements, '
+          f'{CountingCursor.statements / consumed:.4f} statements/msg')
+    print(f'{"handler":<10} {"calls":>8} {"p50 usec":>10} {"p99 usec":>10}')
+    for kind, values in samples.items():
+        if values:
+            print(f'{kind:<10} {len(values):>8} {percentile(values, 0.5) * 1e6:>10.1f} '
+                  f'{percentile(values, 0.99) * 1e6:>10.1f}')
+    db_pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+device sync and skfs reconcile throughput against local stand-ins.
+
+starts fake_chirpstack in-process (or uses --chirpstack-host), syncs the whole
+fleet into helium_devices with the threaded ChirpDeviceSync or the asyncio
+bridge, then optionally reconciles the route's skfs through fake_hpr.py.
+postgres is required, point it at a scratch database.
+
+    python bench/bench_sync.py --devices 10000 --concurrency 32 --latency 0.005
+    python bench/bench_sync.py --devices 100000 --runtime asyncio --concurrency 256 --skfs
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import asyncpg
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from ChirpHeliumPool import ChirpPostgresPool  # noqa: E402
+from ChirpHeliumGrpc import ChirpstackClient  # noqa: E402
+from ChirpHeliumKeys import ChirpDeviceKeys  # noqa: E402
+from ChirpHeliumSync import ChirpDeviceSync  # noqa: E402
+from ChirpHeliumRoute import ChirpHprRunner, ChirpHprBackend, ChirpRouteUpdater  # noqa: E402
+from ChirpHeliumRequests import ChirpstackStreams  # noqa: E402
+from ChirpHeliumAsync import ChirpAsyncBridge, ChirpAsyncChirpstackClient, ChirpAsyncHprRunner  # noqa: E402
+from fake_chirpstack import FakeChirpstack, FakeDeviceService, dev_eui  # noqa: E402
+
+FAKE_HPR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_hpr.py')
+
+
+async def sync_async(bridge: ChirpAsyncBridge, dev_euis: list[str], skfs: bool) -> tuple[dict, dict]:
+    bridge.pg = await asyncpg.create_pool(bridge.postgres_dsn, min_size=1, max_size=bridge.pool_max_size)
+    bridge.cs = ChirpAsyncChirpstackClient(bridge.chirpstack_host, bridge.chirpstack_token, bridge.grpc_timeout)
+    bridge.hpr = ChirpAsyncHprRunner(hpr_path=bridge.hpr_path, concurrency=bridge.hpr_concurrency)
+    bridge.blocking = asyncio.Semaphore(bridge.blocking_concurrency)
+    try:
+        stats = await bridge.sync_devices(dev_euis)
+        skfs_stats = await bridge.helium_skfs_update() if skfs else None
+    finally:
+        await bridge.cs.close()
+        await bridge.pg.close()
+    return stats, skfs_stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--concurrency', type=int, default=8, help='SYNC_CONCURRENCY')
+    parser.add_argument('--rate-limit', type=float, default=0, help='SYNC_RATE_LIMIT, 0 disables the cap')
+    parser.add_argument('--batch-size', type=int, default=500, help='SYNC_BATCH_SIZE')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake chirpstack seconds per call')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--fail', type=float, default=0.0, help='fraction of devices failing with UNAVAILABLE')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chirpstack-host', default='', help='use a running fake_chirpstack.py instead')
+    parser.add_argument('--skfs', action='store_true', help='reconcile the route skfs through fake_hpr.py afterwards')
+    parser.add_argument('--hpr-batch-size', type=int, default=500, help='HPR_BATCH_SIZE')
+    parser.add_argument('--hpr-concurrency', type=int, default=4, help='HPR_CONCURRENCY')
+    parser.add_argument('--pg-host', default='localhost')
+    parser.add_argument('--pg-user', default='postgres')
+    parser.add_argument('--pg-pass', default='postgres')
+    parser.add_argument('--pg-db', default='helium_bench')
+    args = parser.parse_args()
+
+    server = None
+    chirpstack_host = args.chirpstack_host
+    if not chirpstack_host:
+        service = FakeDeviceService(args.devices, args.latency, args.jitter, args.fail, seed=args.seed)
+        server = FakeChirpstack(service).start()
+        chirpstack_host = server.target
+    os.environ.setdefault('FAKE_HPR_STATE', f'/tmp/fake_hpr_bench_{os.getpid()}.json')
+
+    db_pool = ChirpPostgresPool(
+        postgres_host=args.pg_host,
+        postgres_user=args.pg_user,
+        postgres_pass=args.pg_pass,
+        postgres_name=args.pg_db,
+        max_size=max(10, args.hpr_concurrency)
+    )
+    ChirpstackStreams(route_id='bench', db_pool=db_pool, chirpstack_client=None, route_updater=None).create_tables()
+    db_pool.transaction('DELETE FROM helium_devices;')
+
+    cs_client = ChirpstackClient(chirpstack_host=chirpstack_host, chirpstack_token='bench')
+    route_updater = ChirpRouteUpdater(
+        route_id='bench',
+        backend=ChirpHprBackend(runner=ChirpHprRunner(hpr_path=FAKE_HPR), skfs_batch_size=args.hpr_batch_size),
+        concurrency=args.hpr_concurrency
+    )
+    client_keys = ChirpDeviceKeys(
+        route_id='bench',
+        db_pool=db_pool,
+        chirpstack_client=cs_client,
+        route_updater=route_updater
+    )
+    device_sync = ChirpDeviceSync(
+        client_keys=client_keys,
+        concurrency=args.concurrency,
+        rate_limit=args.rate_limit,
+        batch_size=args.batch_size
+    )
+    dev_euis = [dev_eui(i) for i in range(1, args.devices + 1)]
+
+    start = time.perf_counter()
+    if args.runtime == 'asyncio':
+        bridge = ChirpAsyncBridge(
+            route_id='bench',
+            dispatcher=None,
+            client_keys=client_keys,
+            device_sync=device_sync,
+            dc_accumulator=None,
+            postgres_dsn=db_pool.postges,
+            chirpstack_host=chirpstack_host,
+            chirpstack_token='bench',
+            hpr_path=FAKE_HPR,
+            hpr_concurrency=args.hpr_concurrency
+        )
+        stats, skfs_stats = asyncio.run(sync_async(bridge, dev_euis, args.skfs))
+    else:
+        stats = device_sync.sync_devices(dev_euis)
+        skfs_stats = None
+        if args.skfs:
+            skfs_start = time.perf_counter()
+            skfs_stats = client_keys.helium_skfs_update()
+            skfs_stats['duration'] = round(time.perf_counter() - skfs_start, 2)
+    elapsed = time.perf_counter() - start
+
+    print(f'{args.devices} devices, {args.runtime}, concurrency {args.concurrency}, '
+          f'latency {args.latency * 1000:.1f}ms, fail {args.fail:.1%}')
+    print(f'sync: {stats["updated"]} updated, {stats["failed"]} failed in {stats["duration"]}s, '
+          f'{args.devices / max(stats["duration"], 0.01):,.0f} devices/sec')
+    if skfs_stats:
+        print(f'skfs: {skfs_stats}')
+    print(f'total {elapsed:.2f}s')
+    cs_client.close()
+    db_pool.close()
+    if server is not None:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+stand-in for the chirpstack DeviceService, an in-memory fleet served over grpc.
+
+devices are generated from their index, dev_eui 0000000000000001 onward, each
+with a join_eui, session keys and a dev_addr. every call can be delayed and a
+fraction of devices fails with UNAVAILABLE, derived from the seed and the
+dev_eui so the same devices fail on every run.
+
+    python bench/fake_chirpstack.py --devices 100000 --port 18080 --latency 0.005 --fail 0.01
+
+then point CHIRPSTACK_SERVER at localhost:18080. FakeChirpstack can also be
+started in-process, see bench/bench_sync.py.
+"""
+import asyncio
+import random
+import argparse
+import threading
+import grpc
+from google.protobuf.empty_pb2 import Empty
+from chirpstack_api import api
+
+
+def dev_eui(i: int) -> str:
+    return f'{i:016x}'
+
+
+class FakeDeviceService(api.DeviceServiceServicer):
+    """
+    Get, GetActivation, Create, Update and Delete over an in-memory fleet.
+    """
+    def __init__(
+            self,
+            devices: int,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            fail: float = 0.0,
+            max_copies: int = 0,
+            seed: int = 0,
+    ):
+        self.devices = {dev_eui(i): i for i in range(1, devices + 1)}
+        # devices created or updated through the api, served as sent.
+        self.overrides = {}
+        self.latency = latency
+        self.jitter = jitter
+        self.fail = fail
+        self.max_copies = max_copies
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def delay(self):
+        self.calls += 1
+        wait = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def lookup(self, eui: str, context) -> int:
+        await self.delay()
+        if eui not in self.devices:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f'device {eui} not found')
+        if self.fail and random.Random(f'{self.seed}:{eui}').random() < self.fail:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, 'injected failure')
+        return self.devices[eui]
+
+    def device(self, eui: str, i: int) -> api.Device:
+        if eui in self.overrides:
+            return self.overrides[eui]
+        device = api.Device(
+            dev_eui=eui,
+            name=f'fake-{eui}',
+            application_id='8b8c0c5c-7e4a-4b0e-9b4a-6ad1a1a6a0f1',
+            device_profile_id='5c0a0b0e-8f2a-4c3c-9a6e-0a4a1b2c3d4e',
+            join_eui=f'{i % 16:016x}',
+        )
+        if self.max_copies:
+            device.variables['max_copies'] = str(self.max_copies)
+        return device
+
+    async def Get(self, request, context):
+        i = await self.lookup(request.dev_eui, context)
+        return api.GetDeviceResponse(device=self.device(request.dev_eui, i))
+
+    async def GetActivation(self, request, context):
+        i = await self.lookup(request.dev_eui, context)
+        return api.GetDeviceActivationResponse(device_activation=api.DeviceActivation(
+            dev_eui=request.dev_eui,
+            dev_addr=f'{0x48000000 + (i & 0xffffff):08x}',
+            app_s_key=f'{i:032x}',
+            nwk_s_enc_key=f'{i:032x}'[::-1],
+            f_cnt_up=i % 1000,
+            n_f_cnt_down=i % 100,
+        ))
+
+    async def Create(self, request, context):
+        await self.delay()
+        self.devices[request.device.dev_eui] = len(self.devices) + 1
+        self.overrides[request.device.dev_eui] = request.device
+        return Empty()
+
+    async def Update(self, request, context):
+        await self.lookup(request.device.dev_eui, context)
+        self.overrides[request.device.dev_eui] = request.device
+        return Empty()
+
+    async def Delete(self, request, context):
+        await self.lookup(request.dev_eui, context)
+        self.devices.pop(request.dev_eui, None)
+        self.overrides.pop(request.dev_eui, None)
+        return Empty()
+
+
+class FakeChirpstack:
+    """
+    grpc.aio server for a FakeDeviceService, on its own event loop thread.
+    """
+    def __init__(self, service: FakeDeviceService, port: int = 0, host: str = '127.0.0.1'):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    @property
+    def target(self) -> str:
+        return f'{self.host}:{self.port}'
+
+    async def start_server(self):
+        self.server = grpc.aio.server()
+        api.add_DeviceServiceServicer_to_server(self.service, self.server)
+        self.port = self.server.add_insecure_port(f'{self.host}:{self.port}')
+        await self.server.start()
+
+    async def serve(self):
+        await self.start_server()
+        await self.server.wait_for_termination()
+
+    def start(self) -> 'FakeChirpstack':
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start_server(), self.loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.stop(None), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra seconds per call')
+    parser.add_argument('--fail', type=float, default=0.0, help='fraction of devices failing with UNAVAILABLE')
+    parser.add_argument('--max-copies', type=int, default=0, help='max_copies device variable, 0 leaves it unset')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    service = FakeDeviceService(
+        devices=args.devices,
+        latency=args.latency,
+        jitter=args.jitter,
+        fail=args.fail,
+        max_copies=args.max_copies,
+        seed=args.seed
+    )
+    server = FakeChirpstack(service, port=args.port, host=args.host)
+    print(f'fake chirpstack DeviceService with {args.devices} devices on {args.host}:{args.port}')
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+stand-in for the helium config service route api, euis and skfs kept in memory.
+
+implements the calls ChirpConfigServiceBackend makes (get_euis, update_euis,
+list_skfs, update_skfs). every request must be signed by the route owner
+keypair: the signer has to match its public key and the ed25519 signature
+has to verify over the request serialized with an empty signature, anything
+else is rejected with PERMISSION_DENIED.
+
+    python bench/fake_config_service.py --keypair /tmp/owner.bin --new-keypair --port 18090
+
+then point HELIUM_CONFIG_HOST at localhost:18090 and HELIUM_KEYPAIR_BIN at
+the same keypair. FakeConfigService can also be started in-process.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from concurrent import futures
+import grpc
+from nacl.signing import SigningKey
+from nacl.exceptions import BadSignatureError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from ChirpHeliumConfig import HeliumKeypair, messages, ACTIONS, PACKAGE  # noqa: E402
+
+
+ADD = ACTIONS['add']
+
+
+def new_keypair(path: str):
+    """
+    write a fresh ed25519 keypair in helium-crypto's binary format (mainnet tag).
+    """
+    key = SigningKey.generate()
+    with open(path, 'wb') as fh:
+        fh.write(bytes([0x01]) + bytes(key) + bytes(key.verify_key))
+
+
+class FakeRouteService:
+    """
+    route euis and skfs per route_id, guarded by one lock.
+    """
+    def __init__(self, owner: HeliumKeypair, latency: float = 0.0, fail: float = 0.0, seed: int = 0):
+        self.owner = owner
+        self.latency = latency
+        self.fail = fail
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # route_id -> {'euis': {(dev_eui, app_eui)}, 'skfs': {(devaddr, session_key): max_copies}}
+        self.routes = {}
+        self.calls = 0
+        self.rejected = 0
+
+    def route(self, route_id: str) -> dict:
+        return self.routes.setdefault(route_id, {'euis': set(), 'skfs': {}})
+
+    def verify(self, req, context):
+        """
+        abort unless req is signed by the route owner.
+        """
+        signature = req.signature
+        unsigned = type(req)()
+        unsigned.CopyFrom(req)
+        unsigned.signature = b''
+        try:
+            if req.signer != self.owner.public_key:
+                raise BadSignatureError('signer is not the route owner')
+            self.owner.signing_key.verify_key.verify(unsigned.SerializeToString(), signature)
+        except BadSignatureError as err:
+            with self.lock:
+                self.rejected += 1
+            context.abort(grpc.StatusCode.PERMISSION_DENIED, f'bad signature: {err}')
+
+    def delay(self, context):
+        with self.lock:
+            self.calls += 1
+            failed = self.fail and self.rng.random() < self.fail
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'injected failure')
+
+    def get_euis(self, req, context):
+        self.verify(req, context)
+        self.delay(context)
+        with self.lock:
+            pairs = sorted(self.route(req.route_id)['euis'])
+        for dev_eui, app_eui in pairs:
+            yield messages['eui_pair_v1'](route_id=req.route_id, dev_eui=dev_eui, app_eui=app_eui)
+
+    def update_euis(self, requests, context):
+        self.delay(context)
+        for req in requests:
+            self.verify(req, context)
+            pair = (req.eui_pair.dev_eui, req.eui_pair.app_eui)
+            with self.lock:
+                euis = self.route(req.eui_pair.route_id)['euis']
+                if req.action == ADD:
+                    euis.add(pair)
+                else:
+                    euis.discard(pair)
+        return messages['route_euis_res_v1']()
+
+    def list_skfs(self, req, context):
+        self.verify(req, context)
+        self.delay(context)
+        with self.lock:
+            skfs = sorted(self.route(req.route_id)['skfs'].items())
+        for (devaddr, session_key), max_copies in skfs:
+            yield messages['skf_v1'](route_id=req.route_id, devaddr=devaddr, session_key=session_key,
+                                     max_copies=max_copies)
+
+    def update_skfs(self, req, context):
+        self.verify(req, context)
+        self.delay(context)
+        with self.lock:
+            skfs = self.route(req.route_id)['skfs']
+            for update in req.updates:
+                key = (update.devaddr, update.session_key)
+                if update.action == ADD:
+                    skfs[key] = update.max_copies
+                else:
+                    skfs.pop(key, None)
+        return messages['route_skf_update_res_v1']()
+
+    def handler(self) -> grpc.GenericRpcHandler:
+        def method(kind, fn, request, response):
+            return getattr(grpc, f'{kind}_rpc_method_handler')(
+                fn,
+                request_deserializer=messages[request].FromString,
+                response_serializer=messages[response].SerializeToString,
+            )
+
+        return grpc.method_handlers_generic_handler(f'{PACKAGE}.route', {
+            'get_euis': method('unary_stream', self.get_euis, 'route_get_euis_req_v1', 'eui_pair_v1'),
+            'update_euis': method('stream_unary', self.update_euis, 'route_update_euis_req_v1', 'route_euis_res_v1'),
+            'list_skfs': method('unary_stream', self.list_skfs, 'route_skf_list_req_v1', 'skf_v1'),
+            'update_skfs': method('unary_unary', self.update_skfs, 'route_skf_update_req_v1',
+                                  'route_skf_update_res_v1'),
+        })
+
+
+class FakeConfigService:
+    """
+    grpc server for a FakeRouteService on its own thread pool.
+    """
+    def __init__(self, service: FakeRouteService, port: int = 0, host: str = '127.0.0.1', workers: int = 8):
+        self.service = service
+        self.host = host
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+        self.server.add_generic_rpc_handlers((service.handler(),))
+        self.port = self.server.add_insecure_port(f'{host}:{port}')
+
+    @property
+    def target(self) -> str:
+        return f'{self.host}:{self.port}'
+
+    def start(self) -> 'FakeConfigService':
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keypair', required=True, help='route owner keypair, helium binary format')
+    parser.add_argument('--new-keypair', action='store_true', help='write a fresh keypair to --keypair first')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--fail', type=float, default=0.0, help='fraction of calls failing with UNAVAILABLE')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.new_keypair:
+        new_keypair(args.keypair)
+    service = FakeRouteService(HeliumKeypair(args.keypair), latency=args.latency, fail=args.fail, seed=args.seed)
+    server = FakeConfigService(service, port=args.port, host=args.host).start()
+    print(f'fake helium config service on {args.host}:{server.port}, owner key {args.keypair}')
+    try:
+        server.server.wait_for_termination()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+stand-in for the hpr cli, route euis and skfs kept in a json state file.
+
+implements the calls ChirpHprBackend makes:
+
+    route euis list --route-id R
+    route euis add|remove -d DEV_EUI -a APP_EUI --route-id R --commit
+    route skfs list --route-id R
+    route skfs add|remove -r R -d DEVADDR -s SESSION_KEY [-m MAX_COPIES] --commit
+    route skfs update --route-id R --path FILE --commit
+
+point HPR_PATH at this file. behaviour is set from the environment:
+
+    FAKE_HPR_STATE       state file (default /tmp/fake_hpr.json)
+    FAKE_HPR_LATENCY     seconds per call, or a min-max range (e.g. 0.05-0.2)
+    FAKE_HPR_FAIL        fraction of calls that exit 1 (default 0)
+    FAKE_HPR_FAIL_ON     only fail these commands, e.g. 'skfs update,euis add'
+    FAKE_HPR_SEED        failures and latency are derived from the seed and the
+                         call's arguments, the same call fails on every run
+    FAKE_HPR_MAX_UPDATE  reject skfs update files with more entries than this
+"""
+import os
+import sys
+import csv
+import time
+import fcntl
+import random
+import argparse
+import ujson
+
+
+STATE = os.getenv('FAKE_HPR_STATE', '/tmp/fake_hpr.json')
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='hpr')
+    parser.add_argument('resource', choices=['route'])
+    parser.add_argument('kind', choices=['euis', 'skfs'])
+    parser.add_argument('action', choices=['list', 'add', 'remove', 'update'])
+    parser.add_argument('-r', '--route-id', dest='route_id', required=True)
+    parser.add_argument('-d', dest='device')
+    parser.add_argument('-a', dest='app_eui')
+    parser.add_argument('-s', dest='session_key')
+    parser.add_argument('-m', dest='max_copies', type=int, default=0)
+    parser.add_argument('--path')
+    parser.add_argument('--commit', action='store_true')
+    return parser.parse_args(argv)
+
+
+def latency(rng: random.Random) -> float:
+    value = os.getenv('FAKE_HPR_LATENCY', '0')
+    if '-' in value:
+        low, high = value.split('-', 1)
+        return rng.uniform(float(low), float(high))
+    return float(value)
+
+
+def should_fail(rng: random.Random, command: str) -> bool:
+    rate = float(os.getenv('FAKE_HPR_FAIL', 0))
+    fail_on = [item.strip() for item in os.getenv('FAKE_HPR_FAIL_ON', '').split(',') if item.strip()]
+    if fail_on and command not in fail_on:
+        return False
+    return rng.random() < rate
+
+
+def load(fh) -> dict:
+    fh.seek(0)
+    data = fh.read()
+    return ujson.loads(data) if data else {}
+
+
+def save(fh, state: dict):
+    fh.seek(0)
+    fh.truncate()
+    fh.write(ujson.dumps(state))
+    fh.flush()
+
+
+def update_entries(path: str) -> list[tuple]:
+    with open(path, newline='') as fh:
+        return [(row['action'], row['devaddr'], row['session_key'], int(row['max_copies'] or 0))
+                for row in csv.DictReader(fh)]
+
+
+def apply(args: argparse.Namespace, route: dict):
+    if args.kind == 'euis':
+        pair = [args.device, args.app_eui]
+        if args.action == 'add' and pair not in route['euis']:
+            route['euis'].append(pair)
+        elif args.action == 'remove' and pair in route['euis']:
+            route['euis'].remove(pair)
+        return
+    if args.action == 'update':
+        entries = update_entries(args.path)
+        max_update = int(os.getenv('FAKE_HPR_MAX_UPDATE', 0))
+        if max_update and len(entries) > max_update:
+            raise ValueError(f'update has {len(entries)} entries, max {max_update}')
+    else:
+        entries = [(args.action, args.device, args.session_key, args.max_copies)]
+    skfs = {tuple(entry[:2]): entry[2] for entry in route['skfs']}
+    for action, devaddr, session_key, max_copies in entries:
+        if action == 'add':
+            skfs[(devaddr, session_key)] = max_copies
+        else:
+            skfs.pop((devaddr, session_key), None)
+    route['skfs'] = [[devaddr, session_key, max_copies] for (devaddr, session_key), max_copies in skfs.items()]
+
+
+def main(argv: list[str]) -> int:
+    args = parse_args(argv)
+    command = f'{args.kind} {args.action}'
+    # update files get a temporary name, seed those on their content instead.
+    call = ' '.join(argv)
+    if args.path and os.path.exists(args.path):
+        with open(args.path) as fh:
+            call = f'{command} {fh.read()}'
+    rng = random.Random(f'{os.getenv("FAKE_HPR_SEED", 0)}:{call}')
+    time.sleep(latency(rng))
+    if should_fail(rng, command):
+        print(f'error: injected failure for {command}', file=sys.stderr)
+        return 1
+
+    # concurrent hpr processes serialize on the state file.
+    with open(STATE, 'a+') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        state = load(fh)
+        route = state.setdefault(args.route_id, {'euis': [], 'skfs': []})
+        if args.action == 'list':
+            if args.kind == 'euis':
+                out = [{'dev_eui': dev_eui, 'app_eui': app_eui} for dev_eui, app_eui in route['euis']]
+            else:
+                out = [{'devaddr': devaddr, 'session_key': session_key, 'max_copies': max_copies}
+                       for devaddr, session_key, max_copies in route['skfs']]
+            print(ujson.dumps(out))
+            return 0
+        if not args.commit:
+            return 0
+        try:
+            apply(args, route)
+        except (OSError, ValueError, KeyError) as err:
+            print(f'error: {err}', file=sys.stderr)
+            return 1
+        save(fh, state)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
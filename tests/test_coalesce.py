@@ -0,0 +1,90 @@
+import pytest
+from ChirpHeliumCoalesce import ChirpDeviceCoalescer, net_changes
+
+
+def changes(**lists) -> dict:
+    result = {'remove': [], 'add': [], 'enable': [], 'disable': [], 'update': []}
+    result.update(lists)
+    return result
+
+
+@pytest.mark.parametrize('events, expected', [
+    ([('Create', None)], changes(add=['d'])),
+    ([('Delete', None)], changes(remove=['d'])),
+    ([('Create', None), ('Delete', None)], changes()),
+    ([('Delete', None), ('Create', None)], changes(remove=['d'], add=['d'])),
+    ([('Create', None), ('Update', True)], changes(add=['d'], disable=['d'])),
+    ([('Create', None), ('Update', None)], changes(add=['d'])),
+    ([('Update', True), ('Update', False)], changes(enable=['d'])),
+    ([('Update', False), ('Update', True), ('Update', None)], changes(disable=['d'])),
+    ([('Update', None)], changes(update=['d'])),
+    ([('Update', None), ('Delete', None)], changes(remove=['d'])),
+    ([('Update', True), ('Delete', None), ('Create', None)], changes(remove=['d'], add=['d'])),
+])
+def test_net_changes(events, expected):
+    assert net_changes({'d': events}) == expected
+
+
+def test_net_changes_per_device():
+    result = net_changes({'a': [('Create', None)], 'b': [('Update', True)], 'c': [('Update', None)]})
+    assert result == changes(add=['a'], disable=['b'], update=['c'])
+
+
+class Applier:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.applied = []
+
+    def __call__(self, batch: dict):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('postgres down')
+        self.applied.append(batch)
+
+
+def gated(apply) -> tuple[ChirpDeviceCoalescer, list]:
+    released = []
+    coalescer = ChirpDeviceCoalescer(apply, window=60)
+    coalescer.on_flushed = released.append
+    return coalescer, released
+
+
+def test_acks_are_released_after_the_batch_is_applied():
+    apply = Applier()
+    coalescer, released = gated(apply)
+    coalescer.record('a', 'Create')
+    coalescer.hold('api', [b'1-0'])
+    assert released == []
+    coalescer.flush()
+    assert apply.applied == [changes(add=['a'])]
+    assert released == [{'api': [b'1-0']}]
+    assert coalescer.held('api') == []
+
+
+def test_failed_batch_keeps_events_and_acks():
+    apply = Applier(failures=1)
+    coalescer, released = gated(apply)
+    coalescer.record('a', 'Update', True)
+    coalescer.hold('api', [b'1-0'])
+    with pytest.raises(ConnectionError):
+        coalescer.flush()
+    assert released == []
+    assert coalescer.held('api') == [b'1-0']
+
+    coalescer.record('a', 'Update', False)
+    coalescer.hold('api', [b'2-0'])
+    coalescer.flush()
+    # the restored events go first, so the later toggle wins.
+    assert apply.applied == [changes(enable=['a'])]
+    assert released == [{'api': [b'1-0', b'2-0']}]
+
+
+def test_acks_without_device_events_are_released_on_the_time_trigger():
+    apply = Applier()
+    coalescer, released = gated(apply)
+    coalescer.window = 0
+    coalescer.hold('api', [b'1-0'])
+    assert coalescer.due()
+    coalescer.maybe_flush()
+    assert apply.applied == []
+    assert released == [{'api': [b'1-0']}]
@@ -0,0 +1,157 @@
+import pytest
+from ChirpHeliumCredits import ChirpBalanceIndex, ChirpDcAccumulator
+
+TENANT = '52f14cd4-c6f1-4fbd-8f87-4025e1d49242'
+OTHER = '8b8c0c5c-7e4a-4b0e-9b4a-6ad1a1a6a0f1'
+
+
+class FakePool:
+    """
+    answers BALANCES from rows, before_fetch runs ahead of each fetch.
+    """
+    def __init__(self, rows: list[dict]):
+        self.rows = rows
+        self.before_fetch = None
+        self.fetches = 0
+
+    def fetch(self, query, params=None):
+        self.fetches += 1
+        if self.before_fetch is not None:
+            self.before_fetch()
+        return [dict(row) for row in self.rows]
+
+
+class MemoryAccumulator(ChirpDcAccumulator):
+    def __init__(self, **kwargs):
+        super().__init__(db_pool=None, **kwargs)
+        self.written = []
+        self.fail = False
+
+    def write(self, entries):
+        if self.fail:
+            raise ConnectionError('postgres down')
+        self.written += entries
+
+
+def row(tenant_id: str, balance: int, is_disabled: bool = False) -> dict:
+    return {'tenant_id': tenant_id, 'balance': balance, 'is_disabled': is_disabled}
+
+
+@pytest.fixture
+def crossings():
+    return []
+
+
+def index(pool: FakePool, crossings: list, threshold: int = 10) -> ChirpBalanceIndex:
+    balances = ChirpBalanceIndex(pool, threshold=threshold,
+                                 on_crossing=lambda tenant_id, balance: crossings.append((tenant_id, balance)))
+    balances.load()
+    return balances
+
+
+def test_debit_is_keyed_on_msg_id_and_kind(crossings):
+    balances = index(FakePool([row(TENANT, 100)]), crossings)
+    balances.debit('1-0', 'up', TENANT, 30)
+    balances.debit('1-0', 'up', TENANT, 30)
+    balances.debit('1-0', 'meta_down', TENANT, 5)
+    assert balances.balance(TENANT) == 65
+
+
+def test_debit_of_unknown_tenant_is_ignored(crossings):
+    balances = index(FakePool([row(TENANT, 100)]), crossings)
+    balances.debit('1-0', 'up', OTHER, 30)
+    assert balances.balance(OTHER) is None
+    assert balances.unflushed == {}
+
+
+def test_crossing_fires_once_until_topped_up(crossings):
+    pool = FakePool([row(TENANT, 50)])
+    balances = index(pool, crossings)
+    balances.debit('1-0', 'up', TENANT, 40)
+    balances.debit('2-0', 'up', TENANT, 40)
+    assert crossings == [(TENANT, 10)]
+
+    # still below the threshold after a reload, no second crossing.
+    pool.rows = [row(TENANT, 10)]
+    balances.flush_started()
+    balances.flush_done([('1-0', 'up'), ('2-0', 'up')])
+    balances.load()
+    assert crossings == [(TENANT, 10)]
+
+    pool.rows = [row(TENANT, 100)]
+    balances.load()
+    balances.debit('3-0', 'up', TENANT, 95)
+    assert crossings == [(TENANT, 10), (TENANT, 5)]
+
+
+def test_load_fires_for_new_tenants_below_threshold_only(crossings):
+    pool = FakePool([row(TENANT, 5), row(OTHER, 0, is_disabled=True)])
+    balances = index(pool, crossings)
+    assert crossings == [(TENANT, 5)]
+    balances.load()
+    assert crossings == [(TENANT, 5)]
+
+
+def test_load_keeps_unflushed_debits(crossings):
+    pool = FakePool([row(TENANT, 100)])
+    balances = index(pool, crossings)
+    balances.debit('1-0', 'up', TENANT, 30)
+    balances.load()
+    assert balances.balance(TENANT) == 70
+
+    # once flushed, postgres holds the debit and a re-read of the entry is skipped.
+    balances.flush_started()
+    balances.flush_done([('1-0', 'up', TENANT, None, 30)])
+    pool.rows = [row(TENANT, 70)]
+    balances.load()
+    balances.debit('1-0', 'up', TENANT, 30)
+    assert balances.balance(TENANT) == 70
+
+
+def test_load_overlapping_a_flush_is_retried(crossings):
+    pool = FakePool([row(TENANT, 100)])
+    balances = index(pool, crossings)
+    balances.debit('1-0', 'up', TENANT, 30)
+
+    def flush_during_fetch():
+        # the flush commits while BALANCES runs, its rows may or may not be counted.
+        pool.before_fetch = None
+        balances.flush_started()
+        balances.flush_done([('1-0', 'up')])
+        pool.rows = [row(TENANT, 70)]
+
+    pool.before_fetch = flush_during_fetch
+    pool.fetches = 0
+    balances.load()
+    assert pool.fetches == 2
+    assert balances.balance(TENANT) == 70
+
+
+def test_load_is_skipped_while_a_flush_runs(crossings):
+    pool = FakePool([row(TENANT, 100)])
+    balances = index(pool, crossings)
+    balances.debit('1-0', 'up', TENANT, 30)
+    balances.flush_started()
+    pool.rows = [row(TENANT, 70)]
+    balances.load(attempts=2)
+    assert balances.balance(TENANT) == 70
+    assert balances.unflushed == {('1-0', 'up'): (TENANT, 30)}
+
+
+def test_accumulator_reports_flushes_to_the_index(crossings):
+    balances = index(FakePool([row(TENANT, 100)]), crossings)
+    dc = MemoryAccumulator(balance_index=balances)
+    dc.debit_tenant('1-0', 'up', TENANT, '0102030405060708', 30)
+    balances.debit('1-0', 'up', TENANT, 30)
+
+    dc.fail = True
+    with pytest.raises(ConnectionError):
+        dc.flush()
+    assert balances.flushing == 0
+    assert ('1-0', 'up') in balances.unflushed
+
+    dc.fail = False
+    dc.flush()
+    assert dc.written == [('1-0', 'up', TENANT, '0102030405060708', 30)]
+    assert balances.unflushed == {}
+    assert ('1-0', 'up') in balances.seen
@@ -0,0 +1,60 @@
+from ChirpHeliumKeys import plan_skfs, session_changes, skfs_key
+
+
+def skf(devaddr: str, session_key: str, max_copies: int) -> dict:
+    return {'devaddr': devaddr, 'session_key': session_key, 'max_copies': max_copies}
+
+
+def device(dev_addr, nws_key, max_copies, is_disabled: bool = False) -> dict:
+    return {'dev_addr': dev_addr, 'nws_key': nws_key, 'max_copies': max_copies, 'is_disabled': is_disabled}
+
+
+def merged(dev_eui: str, dev_addr, nws_key, max_copies: int = 3) -> tuple:
+    # merge_keys row: dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down
+    return dev_eui, 'join', dev_addr, max_copies, 'aps', nws_key, 'name', 0, 0
+
+
+def test_plan_skfs_diffs_on_the_whole_key():
+    route = [skf('48000001', 'AA', 3), skf('48000002', 'bb', 3), skf('48000003', 'cc', 1)]
+    devices = [device('48000001', 'aa', 3), device('48000002', 'bb', 5), device('48000004', 'dd', 3),
+               device(None, None, 3), device('48000005', '', 3)]
+    plan = plan_skfs(route, devices)
+    assert plan['unchanged'] == {skfs_key('48000001', 'aa', 3)}
+    # a changed max_copies is a remove of the old entry plus an add.
+    assert plan['add'] == {skfs_key('48000002', 'bb', 5), skfs_key('48000004', 'dd', 3)}
+    assert plan['remove'] == {skfs_key('48000002', 'bb', 3), skfs_key('48000003', 'cc', 1)}
+
+
+def test_plan_skfs_of_an_empty_route_adds_everything():
+    plan = plan_skfs([], [device('48000001', 'aa', None)])
+    assert plan == {'add': {('48000001', 'aa', 0)}, 'remove': set(), 'unchanged': set()}
+
+
+def test_session_changes_only_lists_moved_entries():
+    current = {
+        'a': device('48000001', 'aa', 3),
+        'b': device('48000002', 'bb', 3),
+        'c': device(None, None, 3),
+    }
+    rows = [
+        merged('a', '48000001', 'AA'),
+        merged('b', '48000009', 'b2'),
+        merged('c', '48000003', 'cc'),
+        merged('d', '48000004', 'dd'),
+        merged('e', None, None),
+    ]
+    assert session_changes(rows, current) == {
+        'b': (skfs_key('48000002', 'bb', 3), skfs_key('48000009', 'b2', 3)),
+        'c': (None, skfs_key('48000003', 'cc', 3)),
+        'd': (None, skfs_key('48000004', 'dd', 3)),
+    }
+
+
+def test_session_changes_keeps_disabled_devices_off_the_route():
+    current = {
+        'a': device('48000001', 'aa', 3),
+        'b': device('48000002', 'bb', 3, is_disabled=True),
+    }
+    rows = [merged('a', '48000001', 'aa'), merged('b', '48000009', 'b2')]
+    # disabled in chirpstack: the entry goes. disabled in helium_devices (tenant): nothing to move.
+    assert session_changes(rows, current, disabled={'a'}) == {'a': (skfs_key('48000001', 'aa', 3), None)}